@@ -11,6 +11,8 @@ import dash_bootstrap_components as dbc
 
 from robinhood_sheryl.robinhood_sheryl import *
 
+setup_logging()
+
 external_stylesheets = [dbc.themes.BOOTSTRAP]
 
 app = dash.Dash(__name__, external_stylesheets=external_stylesheets)
@@ -37,8 +39,13 @@ def yf_backtest_wrapper(ticker):
     df = df[cols]
     return pd.Series(df.values[0],index=df.columns)
 
+def backtest_holdings(holdings_df):
+    # one backtest per holding, run side by side on the async loop's thread pool
+    backtests = gather(*[in_thread(yf_backtest_wrapper,x) for x in holdings_df['ticker']])
+    return pd.concat([holdings_df,pd.DataFrame(list(backtests),index=holdings_df.index)],axis=1)
+
 print('generating initial portfolio analytics df...')
-pa_df = pd.concat([holdings_df,holdings_df['ticker'].apply(lambda x: yf_backtest_wrapper(x))],axis=1)
+pa_df = backtest_holdings(holdings_df)
 
 
 def format_columns(df):
@@ -475,7 +482,7 @@ def generate_table(n):
 #     holdings_df[cols_list] = holdings_df[cols_list].apply(lambda x: random.uniform(-2,2)*x ,axis=1)
 #     pa_df = pd.concat([holdings_df,holdings_df.apply(yf_backtest_wrapper,axis=1)],axis=1)
     print("generating portfolio analytics df...")
-    pa_df = pd.concat([holdings_df,holdings_df['ticker'].apply(lambda x: yf_backtest_wrapper(x))],axis=1)
+    pa_df = backtest_holdings(holdings_df)
     
     return pa_df.to_dict('records')
 
@@ -511,9 +518,8 @@ for i,idx in index_items_list:
     [Input('interval-component', 'n_intervals')])
 def generate_cards(n):
     results=[]
-    for i,(k,v) in index_items_list:
-        result = yf_get_latest_price(v)
-        pct = yf_get_pct_change(v)
+    # all index quotes are read concurrently, the tick takes as long as the slowest one
+    for result,pct in yf_get_quotes([v for i,(k,v) in index_items_list]):
         sign = '+' if pct>=0 else ''
         results.extend([f"{result:,.2f}",f"{sign}{pct:.2%}"])
     return(results)
@@ -525,9 +531,10 @@ def generate_cards(n):
     Output('portfolio_text_1','children')],
     [Input('interval-component', 'n_intervals')])
 def generate_card_5(n):
-    result = rs_get_portfolio_equity('total_equity')
-    pct = rs_get_portfolio_equity('total_pct_change')
-    gain = rs_get_portfolio_equity('total_gain')
+    df = rs_get_portfolio_equity()  # one read for all three values
+    result = df['total_equity'].loc[0]
+    pct = df['total_pct_change'].loc[0]
+    gain = df['total_gain'].loc[0]
     sign = '+' if pct>=0 else ''
     return f"{result:,.2f}",f"{sign}{pct:.2%} {sign}{gain:.2f}"
 
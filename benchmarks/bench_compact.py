@@ -0,0 +1,33 @@
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+from robinhood_sheryl.rs_db import *
+
+#### compact equities benchmark
+# bytes per row on disk (row vs compact layout) and in memory (getData vs getData(compact=True))
+# usage: python benchmarks/bench_compact.py [ticker] [start_date]
+
+
+def frame_report(ticker, start_date):
+    results = []
+    for compact in [False, True]:
+        start = time.perf_counter()
+        df = getData(equitiesTable, {'ticker': ticker}, start_date=start_date, extended_hours=True, compact=compact)
+        elapsed = time.perf_counter() - start
+        if df is False or df.empty:
+            print(f'no {ticker} rows (compact={compact})')
+            continue
+        memory = df.memory_usage(deep=True, index=True).sum()
+        results.append({'layout': 'compact' if compact else 'row', 'rows': len(df), 'read_s': elapsed,
+                        'memory_bytes_per_row': memory / len(df)})
+    return pd.DataFrame(results)
+
+
+if __name__ == "__main__":
+    ticker = sys.argv[1] if len(sys.argv) > 1 else '^IXIC'
+    start_date = sys.argv[2] if len(sys.argv) > 2 else str((datetime.today() - timedelta(days=30)).date())
+    with pd.option_context('display.width', 200, 'display.max_columns', 20):
+        print(storageReport())
+        print(frame_report(ticker, start_date))
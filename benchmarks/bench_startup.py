@@ -0,0 +1,72 @@
+import os
+import sys
+import json
+import time
+import statistics
+import subprocess
+from datetime import datetime
+
+#### startup time benchmark
+# imports each entry module in a fresh interpreter and reports the wall time and which heavy
+# packages got pulled in. ingestion modules must not load the dashboard stack.
+# usage: python benchmarks/bench_startup.py [runs] [history.csv]
+
+ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+HEAVY_MODULES = ['yfinance', 'robin_stocks', 'talib', 'plotly', 'dash', 'bs4', 'sqlalchemy', 'pandas']
+ENTRY_MODULES = {'robinhood_sheryl.rs_db': ['yfinance', 'robin_stocks', 'talib', 'plotly', 'dash', 'bs4'],
+                 'robinhood_sheryl.rs_yf': ['robin_stocks', 'talib', 'plotly', 'dash', 'bs4'],
+                 'robinhood_sheryl.rs_portfolio': ['talib', 'plotly', 'dash', 'bs4'],
+                 'robinhood_sheryl.robinhood_sheryl': ['yfinance', 'robin_stocks', 'dash', 'bs4']}  # forbidden imports
+PROBE = '''
+import sys, time, json
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+print(json.dumps({{'seconds': elapsed, 'loaded': [m for m in {heavy!r} if m in sys.modules]}}))
+'''
+
+
+def time_import(module, runs=5):
+    seconds, loaded = [], []
+    for _ in range(runs):
+        start = time.perf_counter()
+        result = subprocess.run([sys.executable, '-c', PROBE.format(module=module, heavy=HEAVY_MODULES)],
+                                cwd=ROOT, capture_output=True, text=True)
+        wall = time.perf_counter() - start
+        if result.returncode != 0:
+            return {'error': result.stderr.strip().splitlines()[-1]}
+        probe = json.loads(result.stdout.strip().splitlines()[-1])
+        seconds.append((probe['seconds'], wall))
+        loaded = probe['loaded']
+    return {'import': statistics.median(s[0] for s in seconds),
+            'process': statistics.median(s[1] for s in seconds),
+            'loaded': loaded}
+
+
+def main(runs=5, history=None):
+    failed = False
+    rows = []
+    print(f"{'module':<36}{'import s':>10}{'process s':>11}  heavy modules loaded")
+    for module, forbidden in ENTRY_MODULES.items():
+        result = time_import(module, runs)
+        if 'error' in result:
+            print(f"{module:<36}{'-':>10}{'-':>11}  import failed: {result['error']}")
+            failed = True
+            continue
+        leaked = [m for m in result['loaded'] if m in forbidden]
+        failed = failed or bool(leaked)
+        print(f"{module:<36}{result['import']:>10.3f}{result['process']:>11.3f}  {', '.join(result['loaded'])}"
+              + (f"  <-- unexpected: {', '.join(leaked)}" if leaked else ''))
+        rows.append(f"{datetime.now().isoformat(timespec='seconds')},{module},{result['import']:.4f},"
+                    f"{result['process']:.4f},{' '.join(result['loaded'])}")
+    if history:
+        new_file = not os.path.exists(history)
+        with open(history, 'a') as f:
+            if new_file:
+                f.write('run_at,module,import_seconds,process_seconds,loaded\n')
+            f.write('\n'.join(rows) + '\n')
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(int(sys.argv[1]) if len(sys.argv) > 1 else 5, sys.argv[2] if len(sys.argv) > 2 else None))
@@ -0,0 +1 @@
+# puts the repository root on sys.path so the tests import robinhood_sheryl without an install
@@ -1,6 +1,11 @@
 from robinhood_sheryl.rs_db import *
+from robinhood_sheryl.login import login
+# moved out of rs_db, the star import above does not carry them
+from robinhood_sheryl.rs_yf import insert_yf_data, get_yf_data
+from robinhood_sheryl.rs_portfolio import insert_portfolio_data
 
 if __name__ == "__main__":
+    setup_logging()
     login()  # location of robinhood login pickle file
     # insert_yf_data()
     print(getLatestData(equitiesTable))
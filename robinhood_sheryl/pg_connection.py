@@ -1,19 +1,81 @@
 import os
 # import pg8000
 import sqlalchemy
+from sqlalchemy import event
 # from robinhood_sheryl.secrets import *
 import logging
+import threading
+import contextvars
+from contextlib import contextmanager
 
 logger = logging.getLogger()
 
-
-def init_connection_engine():
+#### engine profiles
+# each workload gets its own pool so bulk ingestion cannot starve the dashboard of connections.
+# statement_timeout is in ms (0 = none). profiles with read_replica connect to DB_REPLICA_HOST
+# (tcp) or CLOUD_SQL_REPLICA_CONNECTION_NAME (unix socket) when set, the primary otherwise
+
+ENGINE_PROFILES = {
+    'ingest': {'pool_size': 3, 'max_overflow': 2, 'pool_timeout': 60, 'statement_timeout': 0,
+               'read_replica': False},
+    'dashboard': {'pool_size': 5, 'max_overflow': 5, 'pool_timeout': 10, 'statement_timeout': 15000,
+                  'read_replica': True},
+    'analytics': {'pool_size': 2, 'max_overflow': 2, 'pool_timeout': 30, 'statement_timeout': 120000,
+                  'read_replica': True},
+}
+DEFAULT_PROFILE = os.environ.get('RS_ENGINE_PROFILE', 'dashboard')
+
+engines = {}
+engines_lock = threading.Lock()
+current_profile = contextvars.ContextVar('current_profile', default=DEFAULT_PROFILE)
+
+
+def get_engine(profile=None):
+    # created on first use so importing modules never touches the secret manager or the network.
+    # calls without a profile use the one set by use_profile, DEFAULT_PROFILE otherwise
+    profile = profile or current_profile.get()
+    with engines_lock:
+        if profile not in engines:
+            engines[profile] = init_connection_engine(profile)
+    return engines[profile]
+
+
+@contextmanager
+def use_profile(profile):
+    # with use_profile('ingest'): ... routes the unrouted calls of a job to one pool
+    if profile not in ENGINE_PROFILES:
+        raise ValueError(f'unknown engine profile {profile}, expected one of {list(ENGINE_PROFILES)}')
+    token = current_profile.set(profile)
+    try:
+        yield
+    finally:
+        current_profile.reset(token)
+
+
+def replica_target(profile):
+    # (tcp host, cloud sql connection name) of the read replica, None when the profile uses the primary
+    if not ENGINE_PROFILES[profile]['read_replica']:
+        return None, None
+    return os.environ.get("DB_REPLICA_HOST"), os.environ.get("CLOUD_SQL_REPLICA_CONNECTION_NAME")
+
+
+def set_statement_timeout(timeout):
+    def on_connect(dbapi_connection, connection_record):
+        cur = dbapi_connection.cursor()
+        cur.execute(f"SET statement_timeout = {int(timeout)}")
+        cur.close()
+        dbapi_connection.commit()
+    return on_connect
+
+
+def init_connection_engine(profile=DEFAULT_PROFILE):
+    settings = ENGINE_PROFILES[profile]
     db_config = {
         # [START cloud_sql_postgres_sqlalchemy_limit]
         # Pool size is the maximum number of permanent connections to keep.
-        "pool_size": 5,
+        "pool_size": settings['pool_size'],
         # Temporarily exceeds the set pool_size if no connections are available.
-        "max_overflow": 2,
+        "max_overflow": settings['max_overflow'],
         # The total number of concurrent connections for your application will be
         # a total of pool_size and max_overflow.
         # [END cloud_sql_postgres_sqlalchemy_limit]
@@ -27,7 +89,7 @@ def init_connection_engine():
         # 'pool_timeout' is the maximum number of seconds to wait when retrieving a
         # new connection from the pool. After the specified amount of time, an
         # exception will be thrown.
-        "pool_timeout": 30,  # 30 seconds
+        "pool_timeout": settings['pool_timeout'],
         # [END cloud_sql_postgres_sqlalchemy_timeout]
 
         # [START cloud_sql_postgres_sqlalchemy_lifetime]
@@ -37,21 +99,27 @@ def init_connection_engine():
         "pool_recycle": 1800,  # 30 minutes
         # [END cloud_sql_postgres_sqlalchemy_lifetime]
     }
+    replica_host, replica_connection_name = replica_target(profile)
 
     if os.environ.get("DB_HOST"):
-        return init_tcp_connection_engine(db_config)
+        pool = init_tcp_connection_engine(db_config, replica_host)
     else:
-        return init_unix_connection_engine(db_config)
+        pool = init_unix_connection_engine(db_config, replica_connection_name)
+    if settings['statement_timeout']:
+        event.listen(pool, 'connect', set_statement_timeout(settings['statement_timeout']))
+    logger.debug(f"engine profile {profile}: pool_size={settings['pool_size']} "
+                 f"max_overflow={settings['max_overflow']} replica={bool(replica_host or replica_connection_name)}")
+    return pool
 
 
-def init_tcp_connection_engine(db_config):
+def init_tcp_connection_engine(db_config, db_host=None):
     # [START cloud_sql_postgres_sqlalchemy_create_tcp]
     # Remember - storing secrets in plaintext is potentially unsafe. Consider using
     # something like https://cloud.google.com/secret-manager/docs/overview to help keep
     # secrets secret.
     db_user = os.environ["DB_USER"]
     db_name = os.environ["DB_NAME"]
-    db_host = os.environ["DB_HOST"]
+    db_host = db_host or os.environ["DB_HOST"]
 
     # Extract host and port from db_host
     host_args = db_host.split(":")
@@ -76,7 +144,7 @@ def init_tcp_connection_engine(db_config):
     return pool
 
 
-def init_unix_connection_engine(db_config):
+def init_unix_connection_engine(db_config, cloud_sql_connection_name=None):
     # Remember - storing secrets in plaintext is potentially unsafe. Consider using
     # something like https://cloud.google.com/secret-manager/docs/overview to help keep
     # secrets secret.
@@ -85,7 +153,8 @@ def init_unix_connection_engine(db_config):
     db_name = access_secret_version('quantwannabe', 'DB_NAME', 'latest')
 
     db_socket_dir = os.environ.get("DB_SOCKET_DIR", "/cloudsql")
-    cloud_sql_connection_name = os.environ.get("CLOUD_SQL_CONNECTION_NAME", 'quantwannabe:us-central1:quantwannadb')
+    cloud_sql_connection_name = cloud_sql_connection_name or \
+        os.environ.get("CLOUD_SQL_CONNECTION_NAME", 'quantwannabe:us-central1:quantwannadb')
 
     pool = sqlalchemy.create_engine(
 
@@ -112,7 +181,28 @@ def init_unix_connection_engine(db_config):
     return pool
 
 
+def get_connection_params(profile=DEFAULT_PROFILE):
+    # plain driver settings for clients that do not go through sqlalchemy (the asyncpg read pool)
+    replica_host, replica_connection_name = replica_target(profile)
+    if os.environ.get("DB_HOST"):
+        host_args = (replica_host or os.environ["DB_HOST"]).split(":")
+        return {'user': os.environ["DB_USER"],
+                'password': os.environ.get("DB_PASS"),
+                'database': os.environ["DB_NAME"],
+                'host': host_args[0],
+                'port': int(host_args[1])}
+
+    db_socket_dir = os.environ.get("DB_SOCKET_DIR", "/cloudsql")
+    cloud_sql_connection_name = replica_connection_name or \
+        os.environ.get("CLOUD_SQL_CONNECTION_NAME", 'quantwannabe:us-central1:quantwannadb')
+    return {'user': access_secret_version('quantwannabe', 'DB_USER', 'latest'),
+            'password': access_secret_version('quantwannabe', 'DB_PASS', 'latest'),
+            'database': access_secret_version('quantwannabe', 'DB_NAME', 'latest'),
+            'host': "{}/{}".format(db_socket_dir, cloud_sql_connection_name),  # directory of .s.PGSQL.5432
+            'port': 5432}
+
+
 if __name__ == "__main__":
-    init_connection_engine()
+    get_engine()
 
 
@@ -1,7 +1,7 @@
 import math
+import asyncio
 
 import requests
-from bs4 import BeautifulSoup
 
 # import yahoo_fin.stock_info as si
 # import yahoo_fin.options as ops
@@ -17,7 +17,10 @@ from plotly.subplots import make_subplots
 # from sqlite3 import Error
 
 from robinhood_sheryl.rs_db import *
+from robinhood_sheryl.rs_async import gather, in_thread, getDataAsync, getLatestRowDataAsync, \
+    getLatestDataAsync, getLatestDataNamedAsync
 
+from pandas.tseries.offsets import BDay  # Business day, no longer carried by the rs_db star import
 from pandas.tseries.holiday import USFederalHolidayCalendar
 from pandas.tseries.offsets import CustomBusinessDay
 US_BUSINESS_DAY = CustomBusinessDay(calendar=USFederalHolidayCalendar())
@@ -27,6 +30,7 @@ US_BUSINESS_DAY = CustomBusinessDay(calendar=USFederalHolidayCalendar())
 
 
 def ws_get_nasdaq_futures_info(info=None):
+    from bs4 import BeautifulSoup  # only the futures scrape needs bs4, keep it off the import path
     url = "https://liveindex.org/nasdaq-futures/"
     response = requests.get(url)
     if response.status_code == 200:
@@ -45,10 +49,10 @@ def ws_get_nasdaq_futures_info(info=None):
     return d[info] if info else d
 
 
-def yf_get_prev_close_price(ticker):
+def prev_close_window(ticker):
     yesterday = (datetime.today() - US_BUSINESS_DAY).strftime('%Y-%m-%d')
     if ticker in ['^N225']:
-        timezone = 'JST'
+        timezone = 'Asia/Tokyo'  # pandas needs the iana name to convert bounds to UTC
         start_time = ' 14:55'
         end_time = ' 15:00'
     elif ticker in ['^FTSE']:
@@ -59,6 +63,11 @@ def yf_get_prev_close_price(ticker):
         timezone = 'US/Eastern'
         start_time = ' 15:59'
         end_time = ' 16:00'
+    return yesterday, start_time, end_time, timezone
+
+
+def yf_get_prev_close_price(ticker):
+    yesterday, start_time, end_time, timezone = prev_close_window(ticker)
 
     df = getData(equitiesTable, {'ticker': ticker}, start_date=yesterday + start_time,
                  end_date=yesterday + end_time, extended_hours=True, timezone=timezone)
@@ -82,6 +91,26 @@ def yf_get_pct_change(ticker):
     return pct_change
 
 
+async def yf_get_quote_async(ticker):
+    # latest price and pct change, the latest row and the previous close are read concurrently
+    yesterday, start_time, end_time, timezone = prev_close_window(ticker)
+    latest_df, df = await asyncio.gather(
+        getLatestRowDataAsync(equitiesTable, ticker),
+        getDataAsync(equitiesTable, {'ticker': ticker}, start_date=yesterday + start_time,
+                     end_date=yesterday + end_time, extended_hours=True, timezone=timezone))
+    if df.empty:
+        df = await getDataAsync(equitiesTable, {'ticker': ticker}, start_date=yesterday + ' 09:30',
+                                end_date=yesterday + end_time, extended_hours=False, timezone=timezone)
+    latest_price = float(latest_df['close'])
+    prev_close_price = df['close'].resample('B').last().loc[yesterday]
+    return latest_price, latest_price/prev_close_price-1
+
+
+def yf_get_quotes(tickers):
+    # [(latest_price, pct_change)] for every ticker, all of them queried at once
+    return gather(*[yf_get_quote_async(ticker) for ticker in tickers])
+
+
 def convert_period(period):
     period_dict={'d':1,'mo':20,'y':52*5,'ytd':0,'max':0}
     num=''
@@ -127,22 +156,14 @@ def yf_get_moving_average(ticker,interval='1d',period='3mo',price_type='close',w
     interval_days = convert_interval(interval,max(windows+[200]))
     # start_date = period_start_date-BDay(interval_days)
     start_date = period_start_date - US_BUSINESS_DAY*interval_days
-    resample_interval = interval.replace('m','Min').replace('d','B')
-    df = getData(equitiesTable,{'ticker':ticker},start_date=start_date,extended_hours=extended_hours)
-
-    if 'h' in interval:
-        # base=0.5
-        offset='0.5h'
+    # read the coarsest pre-aggregated bars that tile the interval, else minutes bucketed by the database
+    df = getBars(ticker,interval,start_date=start_date,extended_hours=extended_hours)
+    if isinstance(df,pd.DataFrame) and not df.empty:
+        df = resample_frame(df,interval)  # bar rows come at the table's granularity
     else:
-        # base=0
-        offset='0s'
-    # volume_agg = df['volume'].resample(resample_interval,base=base).sum()
-    volume_agg = df['volume'].resample(resample_interval, offset=offset).sum()
-    # df = df[['open', 'high', 'low', 'close', 'dividends', 'stock_splits']].resample(
-    # resample_interval,base=base).last()
-    df = df[['open', 'high', 'low', 'close', 'dividends', 'stock_splits']].resample(
-        resample_interval, offset=offset).last()
-    df['volume'] = volume_agg
+        df = getData(equitiesTable,{'ticker':ticker},start_date=start_date,extended_hours=extended_hours,
+                     interval=interval)
+    df = df[['open', 'high', 'low', 'close', 'dividends', 'stock_splits', 'volume']]
     df = df.dropna()
     if df.empty:
         return df
@@ -523,12 +544,15 @@ def rs_get_portfolio():
     df= getLatestDataNamed(portfolioTable)
     return df
 
-def rs_get_option_portfolio():
-    df = getLatestData(optionsTable)
+def rs_name_options(df):
     df['name'] = df[['ticker','strike_price','option_type','exp_date']].apply(
         lambda x: f"{x[0]} {x[1]} {x[2]} exp {x[3]}", axis=1)
     return df
 
+def rs_get_option_portfolio():
+    df = getLatestData(optionsTable)
+    return rs_name_options(df)
+
 def rs_calc_portfolio(df,option=False,info=None):
     quantity_multiplier = 100 if option else 1
     df['pct_change'] = df['latest_price']/df['prev_close_price']-1
@@ -546,14 +570,16 @@ def rs_calc_portfolio(df,option=False,info=None):
 def rs_calc_agg_portfolio():
     agg_cols = ['name','ticker','average_buy_price','quantity','prev_close_price','latest_price',]
 
-    df = rs_get_portfolio()[agg_cols]
-    df = rs_calc_portfolio(df)
+    # the three holdings tables are independent, read them concurrently
+    df, o_df, c_df = gather(getLatestDataNamedAsync(portfolioTable),
+                            getLatestDataAsync(optionsTable),
+                            getLatestDataAsync(cryptoTable))
+
+    df = rs_calc_portfolio(df[agg_cols])
 
-    o_df = rs_get_option_portfolio()[agg_cols]
-    o_df = rs_calc_portfolio(o_df,option=True)
+    o_df = rs_calc_portfolio(rs_name_options(o_df)[agg_cols],option=True)
 
-    c_df = rs_get_crypto_portfolio()[agg_cols]
-    c_df = rs_calc_portfolio(c_df)
+    c_df = rs_calc_portfolio(c_df[agg_cols])
 
     agg_df = pd.concat([o_df,c_df,df], keys=['options','crypto', 'equities'],
           names=['Series name', 'Row ID'])
@@ -572,7 +598,8 @@ def rs_calc_agg_portfolio():
 
 def rs_plot_portfolio(interval='5m',period='1mo',primary_axis_type='total_equity', secondary_axis_type='',extended_hours=True):
     start_date = str(convert_period(period).date())
-    df = getData(portfolioSummaryTable,start_date=start_date,extended_hours=extended_hours)
+    # one row per interval bucket, aggregated by the database
+    df = getData(portfolioSummaryTable,start_date=start_date,extended_hours=extended_hours,interval=interval)
 
 
     df['crypto_gain'] = df['crypto_equity'] - df['crypto_equity_prev_close']
@@ -588,12 +615,8 @@ def rs_plot_portfolio(interval='5m',period='1mo',primary_axis_type='total_equity
     # reindex to fill in values for missing time periods
     resample_interval = interval.replace('m','Min').replace('d','B')
     if 'h' in interval:
-        # base = 0.5
-        offset = '0.5h'
         freq = '30min'
     else:
-        # base = 0
-        offset = '0'
         freq = resample_interval
     if extended_hours:
         interval_start_time='04:00'
@@ -601,8 +624,6 @@ def rs_plot_portfolio(interval='5m',period='1mo',primary_axis_type='total_equity
     else:
         interval_start_time='09:30'
         interval_end_time='15:59'
-    # df = df.resample(resample_interval,base=base).last()
-    df = df.resample(resample_interval, offset=offset).last()
 
 #     .between_time('9:31', '15:59')
 #     return df
@@ -0,0 +1,142 @@
+import asyncio
+import logging
+import threading
+from datetime import date
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+
+from robinhood_sheryl.pg_connection import get_connection_params, ENGINE_PROFILES
+from robinhood_sheryl.rs_db import *
+
+try:
+    import asyncpg
+    HAS_ASYNCPG = True
+except ImportError:
+    HAS_ASYNCPG = False
+
+#### async read path
+# the dash callbacks are synchronous, so the coroutines run on one background event loop and the
+# callbacks block on gather(). independent reads share an asyncpg pool and finish in the time of
+# the slowest one. without asyncpg (or with the pool down) queries run on the sqlalchemy engine in
+# the loop's thread pool, which still overlaps them
+
+ASYNC_POOL_SIZE = 10
+ASYNC_COMMAND_TIMEOUT = 30  # seconds
+
+loop = None
+loop_lock = threading.Lock()
+pool_tasks = {}  # profile: task creating its asyncpg pool
+
+
+def get_loop():
+    global loop
+    with loop_lock:
+        if loop is None:
+            loop = asyncio.new_event_loop()
+            loop.set_default_executor(ThreadPoolExecutor(max_workers=ASYNC_POOL_SIZE, thread_name_prefix='rs_async'))
+            threading.Thread(target=loop.run_forever, name='rs_async', daemon=True).start()
+    return loop
+
+
+def run(coro):
+    # block the calling thread until the coroutine finishes on the background loop
+    return asyncio.run_coroutine_threadsafe(coro, get_loop()).result()
+
+
+async def gather_all(coros):
+    return await asyncio.gather(*coros)
+
+
+def gather(*coros):
+    # asyncio.gather has to be created on the loop that runs it
+    return run(gather_all(coros))
+
+
+async def in_thread(func, *args, **kwargs):
+    return await asyncio.get_event_loop().run_in_executor(None, partial(func, *args, **kwargs))
+
+
+async def get_pool(profile='dashboard'):
+    # only ever called on the background loop, so the shared tasks need no lock
+    if not HAS_ASYNCPG:
+        return None
+    if profile not in pool_tasks:
+        params = await in_thread(get_connection_params, profile)
+        timeout = ENGINE_PROFILES[profile]['statement_timeout']
+        pool_tasks[profile] = asyncio.ensure_future(asyncpg.create_pool(
+            min_size=1, max_size=ASYNC_POOL_SIZE, command_timeout=ASYNC_COMMAND_TIMEOUT,
+            server_settings={'statement_timeout': str(timeout)} if timeout else None, **params))
+    try:
+        return await asyncio.shield(pool_tasks[profile])
+    except Exception as e:
+        pool_tasks.pop(profile, None)  # retried on the next call
+        print(f'==============\nException at get_pool: {e}\n==============')
+        return None
+
+
+def bind_param(value, pg_type):
+    # Query params are strings where the sync drivers let postgres cast them, asyncpg wants python types
+    if isinstance(value, (str, pd.Timestamp)) and pg_type in ('timestamptz', 'timestamp'):
+        ts = pd.Timestamp(value)
+        if ts.tzinfo is not None and pg_type == 'timestamp':  # postgres drops the offset of utc bounds too
+            ts = ts.tz_convert('UTC').tz_localize(None)
+        return ts.to_pydatetime()
+    if isinstance(value, str) and pg_type == 'date':
+        return date.fromisoformat(value)
+    return value
+
+
+async def executeQueryAsync(query, profile='dashboard'):
+    logging.debug(query)
+    key, tables = result_key(query, profile)  # shares the result cache of executeQuery
+    if key is not None:
+        df = RESULT_CACHE.get(key)
+        if df is not None:
+            return df
+        generation = RESULT_CACHE.generation(tables)
+    pool = await get_pool(profile)
+    if pool is not None:
+        try:
+            async with pool.acquire() as connection:
+                # asyncpg keeps a per connection cache of prepared statements
+                stmt = await connection.prepare(query.numbered())
+                args = [bind_param(v, t.name) for v, t in zip(query.params, stmt.get_parameters())]
+                records = await stmt.fetch(*args)
+                columns = [a.name for a in stmt.get_attributes()]
+            df = format_result(pd.DataFrame.from_records([tuple(r) for r in records], columns=columns))
+            if key is not None:
+                RESULT_CACHE.put(key, df, tables, generation)
+            return df
+        except Exception as e:
+            print(f'==============\nException at executeQueryAsync: {e}\n==============')
+    return await in_thread(executeQuery, query, True, profile)
+
+
+#### async versions of the dashboard reads
+
+async def getDataAsync(table, rows={}, column='*', start_date='', end_date='',
+                       extended_hours=False, market_hours=MARKET_HOURS, timezone='US/Eastern'):
+    if is_cached_read(table, rows, column):  # the parquet cache is file based, served from a thread
+        return await in_thread(getData, table, rows, column, start_date, end_date,
+                               extended_hours, market_hours, timezone)
+    query = await in_thread(data_query, table, rows, column, start_date, end_date,
+                            extended_hours, market_hours, timezone)
+    try:
+        return format_data(table, await executeQueryAsync(query, table_profile(table)), column)
+    except Exception as e:
+        print(f'==============\nException at getDataAsync: {e}\n==============')
+        return False
+
+
+async def getLatestRowDataAsync(table, value, key='ticker'):
+    return await executeQueryAsync(await in_thread(latest_row_query, table, value, key))
+
+
+async def getLatestDataAsync(table, key='ticker'):
+    return await executeQueryAsync(await in_thread(latest_data_query, table, key))
+
+
+async def getLatestDataNamedAsync(table):
+    return await executeQueryAsync(await in_thread(latest_named_query, table))
@@ -0,0 +1,157 @@
+import os
+import json
+import time
+import logging
+import tempfile
+import threading
+
+import pandas as pd
+
+try:
+    import pyarrow  # parquet engine
+    HAS_PYARROW = True
+except ImportError:
+    HAS_PYARROW = False
+
+#### local parquet cache of bar rows
+# one directory per ticker, one parquet file per US/Eastern trading day. the cache remembers the
+# range it holds (low/high water marks) and only asks the database for rows outside of it, so
+# history that never changes is read from disk after the first load. writes that rewrite older rows
+# (dividend upserts) pull the high water mark of the ticker back, see invalidate_ticker
+
+CACHE_DIR = os.environ.get('RS_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'robinhood_sheryl'))
+SYNC_INTERVAL = 60  # seconds between forward syncs of the same ticker
+MAX_STALENESS = 3600  # seconds stale data is still served while the database is unreachable
+DAY_TIMEZONE = 'US/Eastern'
+
+
+class CacheUnavailable(Exception):
+    pass
+
+
+def atomic_write(path, write):
+    # write(tmp_path) fills a temp file unique to this writer, renamed over path when complete, so
+    # concurrent writers (threads or dash worker processes) never interleave in one file
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=os.path.basename(path) + '.', suffix='.tmp')
+    os.close(fd)
+    try:
+        write(tmp)
+        os.replace(tmp, path)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+
+def invalidate_ticker(ticker, since, cache_dir=CACHE_DIR):
+    # moves the high water mark of every cache holding ticker back to since, the next sync re-reads the
+    # rewritten rows. works across processes sharing cache_dir, the meta file is replaced atomically
+    for name in os.listdir(cache_dir) if os.path.isdir(cache_dir) else []:
+        cache = BarCache(name, cache_dir=cache_dir)
+        if os.path.exists(os.path.join(cache.ticker_dir(ticker), '_meta.json')):
+            cache.invalidate(ticker, since)
+
+
+class BarCache:
+    def __init__(self, name, overlap=pd.Timedelta(minutes=10), cache_dir=CACHE_DIR):
+        # overlap re-reads the newest rows on every sync to pick up revised bars and buckets
+        self.root = os.path.join(cache_dir, name)
+        self.overlap = overlap
+        self.locks = {}  # ticker: lock, reads of different tickers (and their db loads) run concurrently
+        self.locks_lock = threading.Lock()
+
+    def ticker_lock(self, ticker):
+        with self.locks_lock:
+            return self.locks.setdefault(ticker, threading.Lock())
+
+    def ticker_dir(self, ticker):
+        return os.path.join(self.root, ticker.replace('/', '_'))
+
+    def read_meta(self, ticker):
+        path = os.path.join(self.ticker_dir(ticker), '_meta.json')
+        if not os.path.exists(path):
+            return {}
+        with open(path) as f:
+            meta = json.load(f)
+        return {k: (pd.Timestamp(v) if k in ('low', 'high') and v else v) for k, v in meta.items()}
+
+    def write_meta(self, ticker, meta):
+        path = os.path.join(self.ticker_dir(ticker), '_meta.json')
+        meta = {k: (v.isoformat() if isinstance(v, pd.Timestamp) else v) for k, v in meta.items()}
+
+        def write(tmp):
+            with open(tmp, 'w') as f:
+                json.dump(meta, f)
+        atomic_write(path, write)
+
+    def write_rows(self, ticker, df):
+        if df.empty:
+            return
+        os.makedirs(self.ticker_dir(ticker), exist_ok=True)
+        days = df['datetime'].dt.tz_convert(DAY_TIMEZONE).dt.strftime('%Y-%m-%d')
+        for day, rows in df.groupby(days):
+            path = os.path.join(self.ticker_dir(ticker), f'{day}.parquet')
+            if os.path.exists(path):
+                rows = pd.concat([pd.read_parquet(path), rows])
+            rows = rows.drop_duplicates(subset=['datetime'], keep='last').sort_values('datetime')
+            rows = rows.reset_index(drop=True)
+            atomic_write(path, lambda tmp: rows.to_parquet(tmp, index=False))
+
+    def invalidate(self, ticker, since):
+        with self.ticker_lock(ticker):
+            meta = self.read_meta(ticker)
+            if not meta or meta.get('high') is None or meta['high'] < since:
+                return
+            low = meta.get('low')
+            meta.update(high=max(since, low) if low is not None else since, synced_at=0)
+            self.write_meta(ticker, meta)
+
+    def read_rows(self, ticker, start=None, end=None):
+        directory = self.ticker_dir(ticker)
+        first = (start.tz_convert(DAY_TIMEZONE) - pd.Timedelta(days=1)).strftime('%Y-%m-%d') if start is not None else ''
+        last = (end.tz_convert(DAY_TIMEZONE) + pd.Timedelta(days=1)).strftime('%Y-%m-%d') if end is not None else '9999'
+        files = sorted(f for f in os.listdir(directory) if f.endswith('.parquet') and first <= f[:10] <= last) \
+            if os.path.isdir(directory) else []
+        if not files:
+            return None
+        df = pd.concat([pd.read_parquet(os.path.join(directory, f)) for f in files], ignore_index=True)
+        if start is not None:
+            df = df[df['datetime'] >= start]
+        if end is not None:
+            df = df[df['datetime'] <= end]
+        return df.reset_index(drop=True)
+
+    def get(self, ticker, start, end, loader):
+        # loader(ticker, start, end) returns the database rows in [start, end) with a utc 'datetime'
+        # column, or False when the database is unavailable
+        with self.ticker_lock(ticker):
+            meta = self.read_meta(ticker)
+            low, high = meta.get('low'), meta.get('high')
+            complete = meta.get('complete', False)  # holds the full history back to the first row
+
+            if not meta or (start is None and not complete) or (start is not None and not complete and start < low):
+                gap_end = low if meta else None
+                rows = loader(ticker, start, gap_end)
+                if rows is False:
+                    raise CacheUnavailable(f'cannot load {ticker} rows before {gap_end}')
+                self.write_rows(ticker, rows)
+                low = start if start is not None else (rows['datetime'].min() if not rows.empty else low)
+                complete = start is None
+                if high is None:
+                    high = rows['datetime'].max() if not rows.empty else start
+                meta.update(low=low, high=high, complete=complete, synced_at=time.time())
+
+            if time.time() - meta.get('synced_at', 0) > SYNC_INTERVAL:
+                since = high - self.overlap if high is not None else None
+                rows = loader(ticker, since, None)
+                if rows is False:
+                    if time.time() - meta.get('synced_at', 0) > MAX_STALENESS:
+                        raise CacheUnavailable(f'{ticker} cache is older than {MAX_STALENESS}s and the db is unreachable')
+                    logging.warning(f'serving stale cached rows for {ticker}, database unreachable')
+                else:
+                    self.write_rows(ticker, rows)
+                    if not rows.empty:
+                        high = max(high, rows['datetime'].max()) if high is not None else rows['datetime'].max()
+                    meta.update(high=high, synced_at=time.time())
+            if low is not None or high is not None:
+                self.write_meta(ticker, meta)
+            return self.read_rows(ticker, start, end)
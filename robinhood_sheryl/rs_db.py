@@ -1,12 +1,19 @@
 # sqlalchemy imports
-from sqlalchemy import Column, Float, BigInteger, Boolean, DateTime, Text, Date
+from sqlalchemy import Table, Column, Float, Integer, BigInteger, Boolean, DateTime, Text, Date, SmallInteger, REAL, \
+    PrimaryKeyConstraint
 from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.schema import CreateTable
+from sqlalchemy.sql import text
+from sqlalchemy import exc
 # from sqlalchemy.orm import relationship, sessionmaker
 
 from robinhood_sheryl.pg_connection import *
+from robinhood_sheryl.rs_query import Query
+from robinhood_sheryl.rs_result_cache import ResultCache
 
 # postgres imports
 from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.dialects import postgresql
 
 # data analysis imports
 import pandas as pd
@@ -17,28 +24,31 @@ import time
 from datetime import datetime, timedelta
 import pytz
 import pendulum
-from pandas.tseries.offsets import BDay  # Business day
-
-# yfinance imports
-import yfinance as yf
-
-# robinhood imports
-import robin_stocks as r
-from robinhood_sheryl.login import login
 
 # system imports
 import logging
+import importlib
+import importlib.util
 import os
 import io
+import re
+import gzip
+import struct
 import tempfile
+import threading
+from contextlib import nullcontext
 
 #### logging setup
-logging.basicConfig(level=logging.DEBUG, format=' %(asctime)s - %(levelname)s - %(message)s: %(lineno)d')
+# configured by the entry points (setup_logging), importing the module leaves the root logger alone
 date_time = ' %(asctime)s - %(levelname)s - %(message)s'
-logging.debug('Start of program')
 logger = logging.getLogger()
 # logger.disabled = True
 
+
+def setup_logging(level=logging.DEBUG):
+    logging.basicConfig(level=level, format=' %(asctime)s - %(levelname)s - %(message)s: %(lineno)d')
+    logging.debug('Start of program')
+
 # #### set timezone
 local_tz = pendulum.timezone("US/Eastern")
 
@@ -73,7 +83,7 @@ INDEXES = {'Nasdaq': '^IXIC',
 # DATABASE
 ##################
 
-conn = init_connection_engine()
+# the engine is created on first use by get_engine(), importing the module does not connect
 Base = declarative_base()
 # meta = MetaData(conn).reflect()
 
@@ -104,6 +114,19 @@ class tickersTable(Base):
     hold = Column(Boolean)
 
 
+# static robinhood instrument metadata, ticker is the symbol of equities and the chain symbol of options
+class instrumentsTable(Base):
+    __tablename__ = 'instruments'
+
+    id = Column(Text, primary_key=True)
+    t_type = Column(Text)
+    ticker = Column(Text)
+    name = Column(Text)
+    option_type = Column(Text)
+    strike_price = Column(Float)
+    exp_date = Column(Date)
+
+
 class portfolioTable(Base):
     __tablename__ = 'portfolio'
 
@@ -184,12 +207,341 @@ class portfolioSummaryTable(Base):
     excess_maintenance = Column(Float)
 
 
-def initTables():
+#### latest snapshot tables
+# one row per position holding its most recent snapshot, so latest holdings reads cost O(positions)
+
+def snapshot_columns(table, key):
+    return [Column(c.name, c.type, primary_key=c.name == key) for c in table.__table__.columns]
+
+
+class portfolioCurrentTable(Base):
+    __table__ = Table('portfolio_current', Base.metadata, *snapshot_columns(portfolioTable, 'ticker'))
+
+
+class cryptoCurrentTable(Base):
+    __table__ = Table('crypto_current', Base.metadata, *snapshot_columns(cryptoTable, 'name'))
+
+
+class optionsCurrentTable(Base):
+    __table__ = Table('options_current', Base.metadata, *snapshot_columns(optionsTable, 'option_id'))
+
+
+class portfolioSummaryCurrentTable(Base):
+    __table__ = Table('portfolio_summary_current', Base.metadata,
+                      *snapshot_columns(portfolioSummaryTable, 'username'))
+
+
+# history table name: (current table, key)
+CURRENT_TABLES = {
+    'portfolio': (portfolioCurrentTable, 'ticker'),
+    'crypto': (cryptoCurrentTable, 'name'),
+    'options': (optionsCurrentTable, 'option_id'),
+    'portfolio_summary': (portfolioSummaryCurrentTable, 'username'),
+}
+
+
+#### pre-aggregated bar tables
+# one row per (ticker, extended_hours, bucket). extended_hours=False rows aggregate only the regular
+# session minutes, extended_hours=True rows aggregate every minute in the bucket
+
+class barsColumns:
+    ticker = Column(Text, primary_key=True)
+    extended_hours = Column(Boolean, primary_key=True)
+    datetime = Column(DateTime(timezone=True), primary_key=True)
+    open = Column(Float)
+    high = Column(Float)
+    low = Column(Float)
+    close = Column(Float)
+    volume = Column(BigInteger)
+    dividends = Column(Float)
+    stock_splits = Column(BigInteger)
+
+
+class equities5mTable(barsColumns, Base):
+    __tablename__ = 'equities_5m'
+
+
+class equities30mTable(barsColumns, Base):
+    __tablename__ = 'equities_30m'
+
+
+class equities1hTable(barsColumns, Base):
+    __tablename__ = 'equities_1h'
+
+
+class equities1dTable(barsColumns, Base):
+    __tablename__ = 'equities_1d'
+
+
+#### downsampled history horizons
+# compactBars deletes minute rows older than the 'minute' horizon of a ticker (the bar tables hold
+# them aggregated) and intraday bar rows older than its 'intraday' horizon (the daily table holds them)
+
+class barHorizonsTable(Base):
+    __tablename__ = 'bar_horizons'
+
+    ticker = Column(Text, primary_key=True)
+    tier = Column(Text, primary_key=True)  # 'minute' or 'intraday'
+    horizon = Column(DateTime(timezone=True))
+
+
+# interval: (table, bucket seconds, bucket offset seconds), daily buckets start at local midnight.
+# hourly buckets start on the half hour, same as the 0.5h resample offset in the analytics functions
+BARS_TABLES = {
+    '5m': (equities5mTable, 300, 0),
+    '30m': (equities30mTable, 1800, 0),
+    '1h': (equities1hTable, 3600, 1800),
+    '1d': (equities1dTable, None, None),
+}
+
+
+#### compact equities tables
+# optional narrow layout of the minute history: a smallint ticker id instead of the ticker text and
+# float4 prices (~7 significant digits, cents stay exact below 100,000). columns are ordered 8, 4, 2
+# bytes wide so postgres adds no alignment padding, and the primary key leads with ticker_id so it
+# also serves the per ticker range reads. ticker_ids joins to tickers on ticker
+
+COMPACT_EQUITIES = os.environ.get('RS_COMPACT_EQUITIES') == '1'  # also write ingested minutes to equities_compact
+REAL_CENT_LIMIT = 100000
+
+
+class tickerIdsTable(Base):
+    __tablename__ = 'ticker_ids'
+
+    ticker_id = Column(SmallInteger, primary_key=True, autoincrement=True)
+    ticker = Column(Text, unique=True, nullable=False)
+
+
+class equitiesCompactTable(Base):
+    __tablename__ = 'equities_compact'
+    __table_args__ = (PrimaryKeyConstraint('ticker_id', 'datetime'),)
+
+    datetime = Column(DateTime(timezone=True), nullable=False)
+    volume = Column(BigInteger)
+    open = Column(REAL)
+    high = Column(REAL)
+    low = Column(REAL)
+    close = Column(REAL)
+    dividends = Column(REAL)
+    ticker_id = Column(SmallInteger, nullable=False)
+    stock_splits = Column(SmallInteger)
+
+
+#### time range predicates
+
+MARKET_HOURS = ('09:30', '15:59:59')
+MARKET_TIMEZONE = 'US/Eastern'
+
+
+def to_utc_bound(value, timezone='US/Eastern'):
+    # wall clock bounds are interpreted in the given timezone and converted once in python,
+    # so the predicate compares the raw datetime column and can use the (key, datetime) indexes
+    ts = pd.Timestamp(value)
+    if ts.tzinfo is None:
+        ts = ts.tz_localize(timezone, ambiguous=False, nonexistent='shift_forward')
+    return ts.tz_convert('UTC').isoformat()
+
+
+def market_hours_clause(timezone=MARKET_TIMEZONE, market_hours=MARKET_HOURS):
+    # must stay textually identical to the partial index predicate below for the planner to use it
+    return f"(datetime AT TIME ZONE '{timezone}')::time BETWEEN '{market_hours[0]}' AND '{market_hours[1]}'"
+
+
+#### managed indexes
+# the primary keys lead with datetime, so per ticker range reads need (key, datetime) indexes.
+# the partial index only holds regular session rows and matches the getData market hours predicate
+
+TABLE_INDEXES = {
+    'equities_ticker_datetime_idx':
+        "CREATE INDEX IF NOT EXISTS equities_ticker_datetime_idx ON equities (ticker, datetime)",
+    'equities_ticker_datetime_market_hours_idx':
+        "CREATE INDEX IF NOT EXISTS equities_ticker_datetime_market_hours_idx ON equities (ticker, datetime) "
+        f"WHERE {market_hours_clause()}",
+    'portfolio_ticker_datetime_idx':
+        "CREATE INDEX IF NOT EXISTS portfolio_ticker_datetime_idx ON portfolio (ticker, datetime)",
+    'portfolio_summary_username_datetime_idx':
+        "CREATE INDEX IF NOT EXISTS portfolio_summary_username_datetime_idx ON portfolio_summary (username, datetime)",
+}
+
+
+def initIndexes():
+    try:
+        dwhConnection = get_engine('ingest').connect()
+        for index_name, ddl in TABLE_INDEXES.items():
+            dwhConnection.execute(ddl)
+        index_names = ', '.join(f"'{name}'" for name in TABLE_INDEXES)
+        valid = {row[0] for row in dwhConnection.execute(f"""
+            SELECT c.relname FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid
+            WHERE c.relname IN ({index_names}) AND i.indisvalid""")}
+        dwhConnection.close()
+        missing = [name for name in TABLE_INDEXES if name not in valid]
+        if missing:
+            print(f'==============\nMISSING OR INVALID INDEXES: {missing}\n==============')
+            return False
+        print(f'==============\nverified indexes: {list(TABLE_INDEXES)}\n==============')
+        return True
+    except Exception as e:
+        print(f'==============\nException at initIndexes: {e}\n==============')
+        return False
+
+
+#### monthly partitions
+# range partitioning by month on datetime, partitions are created ahead of time and a default
+# partition catches anything outside them. recent-window queries are pruned to recent partitions
+
+PARTITION_MONTHS_AHEAD = 3
+PARTITION_PATTERN = re.compile(r'_y(\d{4})m(\d{2})$')
+
+
+def month_start(value=None):
+    ts = pd.Timestamp(value) if value is not None else pd.Timestamp.utcnow()
+    if ts.tzinfo is not None:
+        ts = ts.tz_convert('UTC').tz_localize(None)
+    return ts.normalize().replace(day=1)
+
+
+def partition_name(table, month):
+    return f'{table.__tablename__}_y{month.year}m{month.month:02d}'
+
+
+def tableExists(dwhConnection, name):
+    return dwhConnection.execute(f"SELECT to_regclass('{name}') IS NOT NULL").scalar()
+
+
+def isPartitioned(table):
+    dwhConnection = get_engine('ingest').connect()
+    partitioned = dwhConnection.execute(f"""
+        SELECT EXISTS (SELECT 1 FROM pg_partitioned_table p JOIN pg_class c ON c.oid = p.partrelid
+                       WHERE c.relname = '{table.__tablename__}')""").scalar()
+    dwhConnection.close()
+    return partitioned
+
+
+def create_partitioned_table(dwhConnection, table):
+    ddl = str(CreateTable(table.__table__).compile(bind=get_engine('ingest'))).strip()
+    dwhConnection.execute(f"{ddl} PARTITION BY RANGE (datetime)")
+    dwhConnection.execute(f"CREATE TABLE {table.__tablename__}_default PARTITION OF {table.__tablename__} DEFAULT")
+
+
+def create_month_partitions(dwhConnection, table, start, months_ahead):
+    month = month_start(start)
+    last = month_start() + pd.DateOffset(months=months_ahead)
+    while month <= last:
+        next_month = month + pd.DateOffset(months=1)
+        dwhConnection.execute(f"""
+            CREATE TABLE IF NOT EXISTS {partition_name(table, month)} PARTITION OF {table.__tablename__}
+            FOR VALUES FROM ('{month.isoformat()}+00:00') TO ('{next_month.isoformat()}+00:00')""")
+        month = next_month
+
+
+def createPartitions(table, start=None, months_ahead=PARTITION_MONTHS_AHEAD):
+    try:
+        dwhConnection = get_engine('ingest').connect()
+        with dwhConnection.begin():
+            create_month_partitions(dwhConnection, table, start, months_ahead)
+        dwhConnection.close()
+        return True
+    except Exception as e:
+        print(f'==============\nException at createPartitions: {e}\n==============')
+        return False
+
+
+ensured_partitions = {}
+
+
+def ensurePartitions(table, months_ahead=PARTITION_MONTHS_AHEAD):
+    # once per process per month, a no-op for unpartitioned tables
+    month = month_start()
+    if ensured_partitions.get(table.__tablename__) == month:
+        return True
+    try:
+        status = createPartitions(table, months_ahead=months_ahead) if isPartitioned(table) else True
+    except Exception as e:
+        print(f'==============\nException at ensurePartitions: {e}\n==============')
+        return False
+    if status:
+        ensured_partitions[table.__tablename__] = month
+    return status
+
+
+def initPartitions(table, months_ahead=PARTITION_MONTHS_AHEAD, keep_old=False):
+    # create the table partitioned, or convert an existing heap by copying it into a new partitioned table
+    name = table.__tablename__
+    try:
+        dwhConnection = get_engine('ingest').connect()
+        with dwhConnection.begin():
+            if not tableExists(dwhConnection, name):
+                create_partitioned_table(dwhConnection, table)
+                create_month_partitions(dwhConnection, table, None, months_ahead)
+            elif not isPartitioned(table):
+                old = f'{name}_unpartitioned'
+                first = dwhConnection.execute(f"SELECT MIN(datetime) FROM {name}").scalar()
+                dwhConnection.execute(f"ALTER TABLE {name} RENAME TO {old}")
+                dwhConnection.execute(f"ALTER TABLE {old} RENAME CONSTRAINT {name}_pkey TO {old}_pkey")
+                for index_name in TABLE_INDEXES:
+                    if index_name.startswith(f'{name}_'):
+                        dwhConnection.execute(f"DROP INDEX IF EXISTS {index_name}")
+                create_partitioned_table(dwhConnection, table)
+                create_month_partitions(dwhConnection, table, first, months_ahead)
+                dwhConnection.execute(f"INSERT INTO {name} SELECT * FROM {old}")
+                if not keep_old:
+                    dwhConnection.execute(f"DROP TABLE {old}")
+                print(f'==============\nconverted {name} table to monthly partitions\n==============')
+            else:
+                create_month_partitions(dwhConnection, table, None, months_ahead)
+        dwhConnection.close()
+        invalidate_results(table)
+        return True
+    except Exception as e:
+        print(f'==============\nException at initPartitions: {e}\n==============')
+        return False
+
+
+def applyRetention(table, keep_months, archive_dir=None, db_name=DATABASE):
+    # detach, optionally archive to gzipped csv, and drop partitions that end before the retention cutoff
+    cutoff = month_start() - pd.DateOffset(months=keep_months)
+    try:
+        dwhConnection = get_engine('ingest').connect()
+        partitions = [row[0] for row in dwhConnection.execute(f"""
+            SELECT c.relname FROM pg_inherits i
+            JOIN pg_class c ON c.oid = i.inhrelid JOIN pg_class p ON p.oid = i.inhparent
+            WHERE p.relname = '{table.__tablename__}' ORDER BY c.relname""")]
+        dropped = []
+        for partition in partitions:
+            match = PARTITION_PATTERN.search(partition)
+            if not match:  # default partition
+                continue
+            month = pd.Timestamp(year=int(match.group(1)), month=int(match.group(2)), day=1)
+            if month + pd.DateOffset(months=1) > cutoff:
+                continue
+            dwhConnection.execute(f"ALTER TABLE {table.__tablename__} DETACH PARTITION {partition}")
+            if archive_dir:
+                raw_conn = get_engine('ingest').raw_connection()
+                cur = raw_conn.cursor()
+                with gzip.open(os.path.join(archive_dir, f'{partition}.csv.gz'), 'wb') as f:
+                    copy_to_stdout(cur, f"COPY {partition} TO STDOUT WITH CSV HEADER", f)
+                cur.close()
+                raw_conn.close()
+            dwhConnection.execute(f"DROP TABLE {partition}")
+            dropped.append(partition)
+        dwhConnection.close()
+        print(f'==============\n{len(dropped)} partitions older than {cutoff.date()} dropped from {db_name} db '
+              f'{table.__tablename__} table: {dropped}\n==============')
+        invalidate_results(table)
+        return True
+    except Exception as e:
+        print(f'==============\nException at applyRetention: {e}\n==============')
+        return False
+
+
+def initTables(partition_equities=False):
     isRun = False
-    Base.metadata.create_all(bind=conn)
+    if partition_equities and not initPartitions(equitiesTable):
+        return isRun
+    Base.metadata.create_all(bind=get_engine('ingest'))
     print(Base.metadata.sorted_tables)
-    isRun = True
-    return isRun
+    isRun = initIndexes()
+    return ensureCurrentTables(DATABASE) and isRun
 
 
 #### read sql fast
@@ -231,99 +583,994 @@ def read_sql_tmpfile(query, db_engine):
         return False
 
 
+#### read sql binary
+# COPY (query) TO STDOUT WITH BINARY decoded straight into typed numpy columns, no csv text stage.
+# timestamps come back as int64 unix epoch microseconds
+
+PG_BINARY_SIGNATURE = b'PGCOPY\n\xff\r\n\x00'
+PG_EPOCH_US = 946684800 * 1000000  # postgres binary timestamps count microseconds from 2000-01-01
+PG_FIXED_TYPES = {
+    16: '?',  # bool
+    20: '>i8',  # int8
+    21: '>i2',  # int2
+    23: '>i4',  # int4
+    700: '>f4',  # float4
+    701: '>f8',  # float8
+    1082: '>i4',  # date, days since 2000-01-01
+    1114: '>i8',  # timestamp
+    1184: '>i8',  # timestamptz
+}
+PG_TEXT_TYPES = {19, 25, 1042, 1043}  # name, text, bpchar, varchar
+PG_TIMESTAMP_TYPES = {1114, 1184}
+
+
+def copy_to_stdout(cur, copy_sql, store):
+    if hasattr(cur, 'copy_expert'):  # psycopg2
+        cur.copy_expert(copy_sql, store)
+    else:  # pg8000 streams COPY data through execute
+        cur.execute(copy_sql, stream=store)
+
+
+def convert_binary_column(values, oid):
+    # values is a big-endian numpy array straight off the wire
+    if oid in PG_TEXT_TYPES:
+        return np.char.decode(values, 'utf-8').astype(object)
+    values = values.astype(values.dtype.newbyteorder('='))
+    if oid in PG_TIMESTAMP_TYPES:
+        return values + PG_EPOCH_US
+    if oid == 1082:
+        return (np.datetime64('2000-01-01', 'D') + values.astype('timedelta64[D]')).astype(str).astype(object)
+    return values
+
+
+def decode_binary_fixed_layout(body, oids):
+    # fast path: every row has the same field widths (no NULLs, constant-width text such as a single ticker),
+    # so the whole body can be viewed as one structured numpy array
+    if not body:
+        return [convert_binary_column(np.array([], dtype='S1' if oid in PG_TEXT_TYPES else PG_FIXED_TYPES[oid]), oid)
+                for oid in oids]
+    pos = 2
+    lengths = []
+    for oid in oids:
+        length = struct.unpack_from('>i', body, pos)[0]
+        if length <= 0 and (length < 0 or oid in PG_TEXT_TYPES):  # NULL or empty string
+            return None
+        lengths.append(length)
+        pos += 4 + length
+    row_size = pos
+    if len(body) % row_size:
+        return None
+    fields = [('n', '>i2')]
+    for i, (oid, length) in enumerate(zip(oids, lengths)):
+        fields += [(f'l{i}', '>i4'), (f'v{i}', f'S{length}' if oid in PG_TEXT_TYPES else PG_FIXED_TYPES[oid])]
+    rows = np.frombuffer(body, dtype=np.dtype(fields), count=len(body) // row_size)
+    if (rows['n'] != len(oids)).any() or any((rows[f'l{i}'] != length).any() for i, length in enumerate(lengths)):
+        return None
+    return [convert_binary_column(rows[f'v{i}'], oid) for i, oid in enumerate(oids)]
+
+
+def decode_binary_rows(body, oids):
+    # slow path: walk the tuples one field at a time, NULLs become NaN/None like the csv reader
+    raw = [[] for _ in oids]
+    pos = 0
+    while pos < len(body):
+        pos += 2
+        for values in raw:
+            length = struct.unpack_from('>i', body, pos)[0]
+            pos += 4
+            if length < 0:
+                values.append(None)
+            else:
+                values.append(body[pos:pos + length])
+                pos += length
+
+    columns = []
+    for values, oid in zip(raw, oids):
+        nulls = np.array([v is None for v in values], dtype=bool)
+        if oid in PG_TEXT_TYPES:
+            columns.append(np.array([np.nan if v is None else v.decode('utf-8') for v in values], dtype=object))
+            continue
+        dtype = np.dtype(PG_FIXED_TYPES[oid])
+        filler = bytes(dtype.itemsize)
+        array = convert_binary_column(
+            np.frombuffer(b''.join(filler if v is None else v for v in values), dtype=dtype), oid)
+        if nulls.any():
+            if oid in PG_TIMESTAMP_TYPES:
+                array = pd.array(array, dtype='Int64')
+                array[nulls] = pd.NA
+            elif array.dtype == object:
+                array[nulls] = np.nan
+            else:
+                array = array.astype(float)
+                array[nulls] = np.nan
+        columns.append(array)
+    return columns
+
+
+BINARY_PROBES = {}  # query shape: (names, oids), or None when a column has no binary decoder
+BINARY_PROBES_MAX = 1024
+
+
+def read_sql_binary(query, db_engine, shape=None):
+    # shape: the query text without its parameter values, one column probe per shape
+    query = query.strip().rstrip(';')
+    shape = shape or ' '.join(query.split())
+    probe = BINARY_PROBES.get(shape, False)
+    if probe is None:
+        return False  # known unsupported shape, the caller uses the csv reader
+    raw_conn = None
+    try:
+        raw_conn = db_engine.raw_connection()
+        cur = raw_conn.cursor()
+        if probe is False:
+            # column names and type oids without running the query
+            cur.execute(f"SELECT * FROM ({query}) q LIMIT 0")
+            names = [d[0].decode() if isinstance(d[0], bytes) else d[0] for d in cur.description]
+            oids = [d[1] for d in cur.description]
+            unsupported = [n for n, oid in zip(names, oids) if oid not in PG_FIXED_TYPES and oid not in PG_TEXT_TYPES]
+            if len(BINARY_PROBES) >= BINARY_PROBES_MAX:
+                BINARY_PROBES.clear()
+            BINARY_PROBES[shape] = None if unsupported else (names, oids)
+            if unsupported:
+                logging.debug(f'no binary decoder for columns {unsupported}, using the csv reader')
+                return False
+        else:
+            names, oids = probe
+
+        store = io.BytesIO()
+        copy_to_stdout(cur, f"COPY ({query}) TO STDOUT WITH BINARY", store)
+        cur.close()
+        buf = store.getvalue()
+        if buf[:11] != PG_BINARY_SIGNATURE:
+            raise ValueError('invalid COPY BINARY header')
+        header_size = 19 + struct.unpack_from('>i', buf, 15)[0]
+        body = buf[header_size:-2]  # trailer is a single int16 -1
+
+        columns = decode_binary_fixed_layout(body, oids)
+        if columns is None:
+            columns = decode_binary_rows(body, oids)
+        df = pd.DataFrame(dict(enumerate(columns)))
+        df.columns = names
+        return df
+    except Exception as e:
+        BINARY_PROBES.pop(shape, None)  # the table may have changed under a cached probe
+        print(f'==============\nException at read_sql_binary: {e}\n==============')
+        return False
+    finally:
+        if raw_conn is not None:
+            raw_conn.close()
+
+
+#### read sql prepared
+# small, hot queries run as server-side prepared statements so postgres stops re-planning them.
+# statements are cached per pooled dbapi connection in its info dict, keyed by the query shape
+
+def read_sql_prepared(query, db_engine, retry=True):
+    raw_conn = None
+    try:
+        raw_conn = db_engine.raw_connection()
+        statements = raw_conn.info.setdefault('prepared_statements', {})
+        sql = query.numbered()
+        cur = raw_conn.cursor()
+        name = statements.get(sql)
+        if name is None:
+            name = f'rs_stmt_{len(statements) + 1}'
+            cur.execute(f"PREPARE {name} AS {sql}")
+            statements[sql] = name
+        args = f" ({', '.join(['%s'] * len(query.params))})" if query.params else ''
+        cur.execute(f"EXECUTE {name}{args}", tuple(query.params))
+        names = [d[0].decode() if isinstance(d[0], bytes) else d[0] for d in cur.description]
+        df = pd.DataFrame.from_records(cur.fetchall(), columns=names)
+        cur.close()
+        raw_conn.commit()
+        if 'datetime' in df.columns:
+            df['datetime'] = pd.to_datetime(df['datetime'], utc=True)
+        return df
+    except Exception as e:
+        if raw_conn is not None:
+            raw_conn.rollback()
+            if retry and 'does not exist' in str(e):  # connection was replaced under the cached statement names
+                raw_conn.info.pop('prepared_statements', None)
+                raw_conn.close()
+                raw_conn = None
+                return read_sql_prepared(query, db_engine, retry=False)
+        print(f'==============\nException at read_sql_prepared: {e}\n==============')
+        return False
+    finally:
+        if raw_conn is not None:
+            raw_conn.close()
+
+
+def measurePlanningTime(query, runs=10):
+    # mean planning time in ms of a query run as plain sql vs through the prepared statement cache
+    def planning_ms(rows):
+        for row in rows:
+            match = re.search(r'Planning Time: ([\d.]+) ms', row[0])
+            if match:
+                return float(match.group(1))
+        return float('nan')
+
+    raw_conn = get_engine().raw_connection()
+    cur = raw_conn.cursor()
+    plain, prepared = [], []
+    name = 'rs_stmt_explain'
+    cur.execute(f"PREPARE {name} AS {query.numbered()}")
+    args = f" ({', '.join(['%s'] * len(query.params))})" if query.params else ''
+    for _ in range(runs):
+        cur.execute(f"EXPLAIN (ANALYZE, SUMMARY) {query.literal()}")
+        plain.append(planning_ms(cur.fetchall()))
+        cur.execute(f"EXPLAIN (ANALYZE, SUMMARY) EXECUTE {name}{args}", tuple(query.params))
+        prepared.append(planning_ms(cur.fetchall()))
+    cur.execute(f"DEALLOCATE {name}")
+    cur.close()
+    raw_conn.rollback()
+    raw_conn.close()
+    return {'plain_ms': float(np.nanmean(plain)), 'prepared_ms': float(np.nanmean(prepared))}
+
+
 #### execute sql query
 
-def executeQuery(query):
+READ_ENGINE = 'binary'  # 'binary' decodes COPY BINARY into typed columns, 'csv' uses the csv text round-trip
+
+
+#### read routing
+# minute and bar history scans run on the analytics pool, the small snapshot reads behind the
+# dashboard on the dashboard pool, and reads that must see the latest writes (watermarks) on ingest
+
+def table_profile(table):
+    name = table.__tablename__
+    if name in ['equities', 'equities_compact'] or name in [t.__tablename__ for t, _, _ in BARS_TABLES.values()]:
+        return 'analytics'
+    return 'dashboard'
+
+
+#### query result cache
+# identical dashboard reads within RS_RESULT_CACHE_TTL seconds are answered from memory. entries are
+# tagged with the tables named in the query and dropped by the write functions after they commit.
+# reads on the ingest profile (watermarks, backfill bounds) always go to the database
+
+RESULT_CACHE = ResultCache()
+TABLE_NAME_PATTERN = re.compile(r'\b(?:FROM|JOIN)\s+([a-z_0-9]+)', re.IGNORECASE)
+
+
+def query_tables(sql):
+    return tuple(sorted(set(name.lower() for name in TABLE_NAME_PATTERN.findall(sql)) & set(Base.metadata.tables)))
+
+
+def result_key(query, profile=None):
+    # (cache key, tables read), key is None when the result must not be cached
+    if not RESULT_CACHE.enabled or (profile or current_profile.get()) == 'ingest':
+        return None, ()
+    sql = query.normalized() if isinstance(query, Query) else ' '.join(query.split())
+    tables = query_tables(sql)
+    if not tables:  # nothing would invalidate it
+        return None, ()
+    return (sql, repr(query.params) if isinstance(query, Query) else ''), tables
+
+
+def invalidate_results(*tables):
+    names = []
+    for table in tables:
+        names.append(table.__tablename__)
+        if table.__tablename__ == 'tickers':
+            with ticker_map_lock:
+                ticker_map.clear()
+        if table.__tablename__ in CURRENT_TABLES:
+            names.append(CURRENT_TABLES[table.__tablename__][0].__tablename__)
+    RESULT_CACHE.invalidate(*names)
+
+
+def resultCacheStats():
+    return RESULT_CACHE.stats()
+
+
+def executeQuery(query, prepared=False, profile=None):
     logging.debug(query)
+    key, tables = result_key(query, profile)
+    if key is not None:
+        df = RESULT_CACHE.get(key)
+        if df is not None:
+            return df
+        generation = RESULT_CACHE.generation(tables)
     try:
-        # dwhConnection = conn.connect()
+        db_engine = get_engine(profile)
+        # dwhConnection = get_engine().connect()
         # df = pd.read_sql(query, con=dwhConnection)
-        df = read_sql_inmem_uncompressed(query, conn)
-        # df = read_sql_tmpfile(query, conn)
-        # columns from cloud sql are byte form
-        if isinstance(df.columns[0], bytes):
-            df.columns = [c.decode() for c in df.columns]
-        if not df.empty:
-            if 'datetime' in df.columns:
-                df['datetime'] = pd.to_datetime(df['datetime'])
-                if df['datetime'].iloc[0].tzinfo is None:  # not tz aware, used in yf analysis functions
-                    df['datetime'] = df['datetime'].dt.tz_localize('UTC').dt.tz_convert('US/Eastern')
-                else: # already tz aware, downloaded data from yf
-                    df['datetime'] = df['datetime'].dt.tz_convert('US/Eastern')
+        df = False
+        shape = None
+        if isinstance(query, Query):
+            if prepared:
+                df = read_sql_prepared(query, db_engine)
+            shape = query.normalized()
+            query = query.literal()  # COPY takes no bind parameters
+        if df is False and READ_ENGINE == 'binary':
+            df = read_sql_binary(query, db_engine, shape)
+        if df is False:  # unsupported column types fall back to the csv reader
+            df = read_sql_inmem_uncompressed(query, db_engine)
+        # df = read_sql_tmpfile(query, db_engine)
         # dwhConnection.close()
+        df = format_result(df)
+        if key is not None:
+            RESULT_CACHE.put(key, df, tables, generation)
         return df
     except Exception as e:
         print(f'==============\nException at executeQuery: {e}\n==============')
         return False
 
 
+def format_result(df):
+    # columns from cloud sql are byte form
+    if isinstance(df.columns[0], bytes):
+        df.columns = [c.decode() for c in df.columns]
+    if 'datetime' in df.columns and pd.api.types.is_integer_dtype(df['datetime']):
+        # epoch microseconds from the binary reader, no string parsing needed
+        df['datetime'] = pd.to_datetime(df['datetime'], unit='us', utc=True).dt.tz_convert('US/Eastern')
+    elif not df.empty:
+        if 'datetime' in df.columns:
+            df['datetime'] = pd.to_datetime(df['datetime'])
+            if df['datetime'].iloc[0].tzinfo is None:  # not tz aware, used in yf analysis functions
+                df['datetime'] = df['datetime'].dt.tz_localize('UTC').dt.tz_convert('US/Eastern')
+            else: # already tz aware, downloaded data from yf
+                df['datetime'] = df['datetime'].dt.tz_convert('US/Eastern')
+    return df
+
+
 #### get column data
 
 def getColumns(table):
-    df = executeQuery(f"SELECT column_name FROM INFORMATION_SCHEMA.COLUMNS WHERE TABLE_NAME = '{table.__tablename__}';")
+    df = executeQuery(Query("SELECT column_name FROM INFORMATION_SCHEMA.COLUMNS WHERE TABLE_NAME = %s",
+                            table.__tablename__), prepared=True, profile='dashboard')
     return df['column_name'].to_list()
 
 
 #### get data
 
-def getData(table, rows={}, column='*', start_date='', end_date='',
-            extended_hours=False,market_hours=('09:30','15:59:59'), timezone='US/Eastern'):
-    has_datetime = table.__tablename__ in ['equities', 'portfolio', 'portfolio_summary']
+#### local bar cache
+# minute and bar rows are served from the on-disk parquet cache, which only reads rows newer than
+# its high water mark from the database. disabled without pyarrow or with RS_BAR_CACHE=0. the caches
+# (and pyarrow) are loaded on first use, importing the module stays light
+
+BAR_CACHE_ENABLED = importlib.util.find_spec('pyarrow') is not None and os.environ.get('RS_BAR_CACHE', '1') != '0'
+OVERLAP_WINDOW = timedelta(minutes=40)  # how far behind its watermark ingestion rewrites revised minutes,
+# every cache sync re-reads at least this much
+MINUTE_CACHE = None  # BarCache of the equities table, see minute_cache
+BARS_CACHES = {}  # (bar table name, extended_hours): BarCache
+bar_cache_lock = threading.Lock()  # dash serves reads from several threads, one BarCache per table
+
+
+def minute_cache():
+    global MINUTE_CACHE
+    with bar_cache_lock:
+        if MINUTE_CACHE is None and BAR_CACHE_ENABLED:
+            from robinhood_sheryl.rs_bar_cache import BarCache
+            MINUTE_CACHE = BarCache('equities', overlap=pd.Timedelta(OVERLAP_WINDOW))
+    return MINUTE_CACHE
+
+
+def rewritten_since(table, df):
+    # first datetime per ticker of an upsert rewriting stored minutes, e.g. a dividend on an old row
+    if table.__tablename__ != 'equities' or df.empty or 'datetime' not in df.columns:
+        return {}
+    return pd.to_datetime(df['datetime'], utc=True).groupby(df['ticker'].values).min().to_dict()
+
+
+def invalidate_bar_caches(since):
+    # since: {ticker: first rewritten datetime}, the caches re-read the ticker from there on their next sync
+    if not BAR_CACHE_ENABLED or not since:
+        return
+    from robinhood_sheryl.rs_bar_cache import invalidate_ticker
+    for ticker, first in since.items():
+        try:
+            invalidate_ticker(ticker, pd.Timestamp(first))
+        except Exception as e:
+            logging.warning(f'bar cache invalidation failed for {ticker}: {e}')
+
+
+def read_minutes(ticker, start=None, end=None):
+    query = Query("SELECT * FROM equities WHERE ticker = %s", ticker)
+    if start is not None:
+        query.add("AND datetime >= %s", start.isoformat())
+    if end is not None:
+        query.add("AND datetime < %s", end.isoformat())
+    df = executeQuery(query, profile='analytics')
+    if df is False:
+        return False
+    df['datetime'] = df['datetime'].dt.tz_convert('UTC')
+    return df
+
+
+def getCachedData(cache, loader, ticker, start_date='', end_date='', extended_hours=False,
+                  market_hours=MARKET_HOURS, timezone='US/Eastern'):
+    from robinhood_sheryl.rs_bar_cache import CacheUnavailable
+    start = pd.Timestamp(to_utc_bound(start_date, timezone)) if start_date else None
+    end = pd.Timestamp(to_utc_bound(end_date, timezone)) if end_date else None
+    try:
+        df = cache.get(ticker, start, end, loader)
+    except CacheUnavailable as e:
+        print(f'==============\nException at getCachedData: {e}\n==============')
+        return False
+    except Exception as e:  # corrupt parquet or meta file, disk errors: the caller reads the database instead
+        logging.warning(f'bar cache read failed for {ticker}, falling back to the database: {e}')
+        return False
+    if df is None:
+        return False
+    if not extended_hours:
+        local_time = df['datetime'].dt.tz_convert(timezone).dt.strftime('%H:%M:%S')
+        df = df[(local_time >= pd.Timestamp(market_hours[0]).strftime('%H:%M:%S')) &
+                (local_time <= pd.Timestamp(market_hours[1]).strftime('%H:%M:%S'))]
+    df = df.copy()
+    df['datetime'] = df['datetime'].dt.tz_convert('US/Eastern')
+    return df.set_index('datetime')
+
+
+PREPARED_MAX_SPAN = pd.Timedelta(days=1)
 
-    query = f" SELECT {column} FROM {table.__tablename__} WHERE TRUE "
+
+def is_small_read(table, start_date, end_date, timezone):
+    # bounded reads go through prepared statements, long equities history reads through binary COPY
+    if table.__tablename__ not in ['equities', 'equities_compact']:
+        return True
+    if not (start_date and end_date):
+        return False
+    return pd.Timestamp(to_utc_bound(end_date, timezone)) - pd.Timestamp(to_utc_bound(start_date, timezone)) \
+        <= PREPARED_MAX_SPAN
+
+
+DATETIME_TABLES = ['equities', 'equities_compact', 'portfolio', 'portfolio_summary']
+
+
+def data_query(table, rows={}, column='*', start_date='', end_date='',
+               extended_hours=False, market_hours=MARKET_HOURS, timezone='US/Eastern'):
+    query = Query(f"SELECT {column} FROM {table.__tablename__} WHERE TRUE")
 
     for k in rows:
-        query += f" AND {k} = '{rows[k]}' "
+        query.add(f"AND {k} = %s", rows[k])
 
-    if has_datetime:
+    if table.__tablename__ in DATETIME_TABLES:
         if start_date:
-            query += f" AND datetime AT TIME ZONE '{timezone}' >= '{start_date}'"
+            query.add("AND datetime >= %s", to_utc_bound(start_date, timezone))
         if end_date:
-            query += f" AND datetime AT TIME ZONE '{timezone}' <= '{end_date}'"
+            query.add("AND datetime <= %s", to_utc_bound(end_date, timezone))
         if not extended_hours:
-            query += f" AND (datetime AT TIME ZONE '{timezone}')::time BETWEEN '{market_hours[0]}' and '{market_hours[1]}' "
+            # kept literal so the planner can match the partial market hours index
+            query.add(f"AND {market_hours_clause(timezone, market_hours)}")
+    return query
+
+
+def is_cached_read(table, rows, column):
+    return table.__tablename__ == 'equities' and column == '*' and list(rows) == ['ticker'] \
+        and BAR_CACHE_ENABLED
+
+
+def format_data(table, df, column='*'):
+    if column != '*':
+        ret_value = df[column]
+        return ret_value if len(ret_value) == 1 else list(ret_value)  # if single value return the value
+    if table.__tablename__ in DATETIME_TABLES:
+        df['datetime'] = pd.to_datetime(df['datetime'])
+        return df.set_index('datetime')
+    else:
+        return df
+
+
+def getData(table, rows={}, column='*', start_date='', end_date='',
+            extended_hours=False,market_hours=MARKET_HOURS, timezone='US/Eastern', compact=False, interval=None,
+            profile=None):
+    # profile: engine profile of the read, by default the replica profile of the table (table_profile).
+    # ingestion passes 'ingest' to read the primary
+    if interval is not None and column == '*' and table.__tablename__ in DATETIME_TABLES:
+        return getBucketedData(table, rows, interval, start_date, end_date, extended_hours, market_hours, timezone,
+                               compact)
+    if compact and table.__tablename__ == 'equities':
+        return getCompactData(rows, column, start_date, end_date, extended_hours, market_hours, timezone)
+    if table.__tablename__ == 'equities' and column == '*' and list(rows) == ['ticker']:
+        df = getTieredData(rows['ticker'], start_date, end_date, extended_hours, market_hours, timezone)
+        if df is not None:
+            return df
+    query = data_query(table, rows, column, start_date, end_date, extended_hours, market_hours, timezone)
+    if is_cached_read(table, rows, column):
+        df = getCachedData(minute_cache(), read_minutes, rows['ticker'], start_date, end_date,
+                           extended_hours, market_hours, timezone)
+        if df is not False:
+            return df
     try:
-        df = executeQuery(query)
-        if column != '*':
-            ret_value = df[column]
-            return ret_value if len(ret_value) == 1 else list(ret_value)  # if single value return the value
-        if has_datetime:
-            df['datetime'] = pd.to_datetime(df['datetime'])
-            return df.set_index('datetime')
+        df = executeQuery(query, prepared=is_small_read(table, start_date, end_date, timezone),
+                          profile=profile or table_profile(table))
+        return format_data(table, df, column)
+    except Exception as e:
+        print(f'==============\nException at getData: {e}\n==============')
+        return False
+
+
+#### get bucketed data
+# getData(..., interval='5m') aggregates into time buckets in postgres and ships one row per bucket:
+# first open, max high, min low, last close, summed volume and the last non null value of every other
+# column (dividends and the summary columns). buckets are the resample bins of the analytics functions:
+# hourly ones start on the half hour, daily ones are business days of `timezone` (weekend rows fall
+# into the friday before, like resample('B')). the minute tier of a tiered read is bucketed in
+# postgres too. rows already local (parquet cache) are not shipped again, they and the bar tiers are
+# aggregated with the same rules in pandas, as are intervals postgres cannot bucket (days > 1, weeks, months)
+
+BUCKET_AGGREGATES = {'open': 'first', 'high': 'max', 'low': 'min', 'close': 'last', 'volume': 'sum'}
+
+
+def business_day_expr(timezone=MARKET_TIMEZONE):
+    local = f"(datetime AT TIME ZONE '{timezone}')"
+    return (f"((date_trunc('day', {local}) - make_interval(days => GREATEST(extract(isodow FROM {local})::int - 5, 0)))"
+            f" AT TIME ZONE '{timezone}')")
+
+
+def interval_bucket(interval, timezone=MARKET_TIMEZONE):
+    # sql bucket start expression for a resample interval, None when postgres cannot bucket it
+    seconds, offset = interval_seconds(interval)
+    if seconds is not None:
+        return bucket_expr(seconds, offset, timezone)
+    if interval in ['d', '1d']:
+        return business_day_expr(timezone)
+    return None
+
+
+def bucket_select(table, bucket):
+    keys = [c.name for c in table.__table__.primary_key if c.name != 'datetime']
+    parts = [f'{bucket} AS datetime'] + keys
+    for c in [c.name for c in table.__table__.columns if c.name not in keys and c.name != 'datetime']:
+        how = BUCKET_AGGREGATES.get(c, 'last')
+        if how in ['first', 'last']:
+            order = 'datetime' if how == 'first' else 'datetime DESC'
+            parts.append(f"(array_agg({c} ORDER BY {order}) FILTER (WHERE {c} IS NOT NULL))[1] AS {c}")
+        elif how == 'sum':
+            # sum of a bigint is numeric, cast back so the binary and prepared readers get the column's type
+            sql_type = table.__table__.c[c].type.compile(dialect=postgresql.dialect())
+            parts.append(f"sum({c})::{sql_type} AS {c}")
         else:
+            parts.append(f"{how}({c}) AS {c}")
+    # GROUP BY / ORDER BY by position, the bucket alias shadows the datetime column name
+    return ', '.join(parts), ', '.join(str(i + 1) for i in range(len(keys) + 1))
+
+
+def resample_frame(df, interval, timezone='US/Eastern'):
+    if not isinstance(df, pd.DataFrame) or df.empty:
+        return df
+    rule = interval.replace('m', 'Min').replace('d', 'B')
+    if df.index.tz is not None:
+        df = df.tz_convert(timezone)  # daily bins are days of timezone
+    resampler = df.resample(rule, offset='0.5h') if 'h' in interval else df.resample(rule)
+    out = resampler.agg({c: BUCKET_AGGREGATES.get(c, 'last') for c in df.columns})
+    return out[resampler.size() > 0]  # sql only returns buckets that have rows
+
+
+def getBucketedData(table, rows={}, interval='5m', start_date='', end_date='', extended_hours=False,
+                    market_hours=MARKET_HOURS, timezone='US/Eastern', compact=False):
+    bucket = interval_bucket(interval, timezone)
+    if bucket is None or compact:
+        return resample_frame(getData(table, rows, '*', start_date, end_date, extended_hours, market_hours, timezone,
+                                      compact), interval, timezone)
+    if table.__tablename__ == 'equities' and list(rows) == ['ticker']:
+        df = getTieredData(rows['ticker'], start_date, end_date, extended_hours, market_hours, timezone, interval)
+        if df is not None:
             return df
+    if is_cached_read(table, rows, '*'):
+        df = getCachedData(minute_cache(), read_minutes, rows['ticker'], start_date, end_date,
+                           extended_hours, market_hours, timezone)
+        if df is not False:
+            return resample_frame(df, interval, timezone)
+    select, positions = bucket_select(table, bucket)
+    query = data_query(table, rows, select, start_date, end_date, extended_hours, market_hours, timezone)
+    query.add(f"GROUP BY {positions} ORDER BY {positions}")
+    try:
+        df = executeQuery(query, prepared=is_small_read(table, start_date, end_date, timezone),
+                          profile=table_profile(table))
+        return format_data(table, df)
     except Exception as e:
-        print(f'==============\nException at getData: {e}\n==============')
+        print(f'==============\nException at getBucketedData: {e}\n==============')
+        return False
+
+
+#### get compact equities data
+# same rows as getData(equitiesTable) read from equities_compact, with a categorical ticker column
+# and float32 prices
+
+ticker_ids = {}  # ticker: ticker_id
+ticker_names = {}  # ticker_id: ticker
+
+
+def getTickerIds(tickers, create=True):
+    # ids are only inserted for tickers not in the table yet, so no smallserial values are burnt on conflicts
+    missing = [t for t in set(tickers) if t not in ticker_ids]
+    if missing:
+        try:
+            dwhConnection = get_engine('ingest').connect()
+            select = text("SELECT ticker_id, ticker FROM ticker_ids WHERE ticker = ANY(CAST(:tickers AS text[]))")
+            found = dict((t, i) for i, t in dwhConnection.execute(select, tickers=missing))
+            new = [t for t in missing if t not in found]
+            if new and create:
+                dwhConnection.execute(text("""INSERT INTO ticker_ids (ticker) SELECT unnest(CAST(:tickers AS text[]))
+                    ON CONFLICT (ticker) DO NOTHING"""), tickers=new)
+                found.update((t, i) for i, t in dwhConnection.execute(select, tickers=new))
+                invalidate_results(tickerIdsTable)
+            dwhConnection.close()
+            ticker_ids.update(found)
+            ticker_names.update((i, t) for t, i in found.items())
+        except Exception as e:
+            print(f'==============\nException at getTickerIds: {e}\n==============')
+            return False
+    return {t: ticker_ids[t] for t in tickers if t in ticker_ids}
+
+
+def getTickerNames(ids):
+    missing = [int(i) for i in set(ids) if i not in ticker_names]
+    if missing:
+        df = executeQuery(Query("SELECT ticker_id, ticker FROM ticker_ids WHERE ticker_id = ANY(%s::smallint[])",
+                                missing), prepared=True, profile='dashboard')
+        if df is False:
+            return False
+        ticker_names.update(zip(df['ticker_id'], df['ticker']))
+        ticker_ids.update(zip(df['ticker'], df['ticker_id']))
+    return {i: ticker_names[i] for i in ids if i in ticker_names}
+
+
+def compact_frame(df):
+    # ticker_id -> categorical ticker without materialising a python string per row
+    names = getTickerNames(df['ticker_id'].unique())
+    ids = np.array(sorted(names), dtype=np.int64)
+    codes = np.searchsorted(ids, df['ticker_id'].to_numpy(dtype=np.int64))
+    df['ticker'] = pd.Categorical.from_codes(codes, categories=[names[i] for i in ids])
+    for c in ['open', 'high', 'low', 'close', 'dividends']:
+        df[c] = df[c].astype(np.float32)
+    return df[[c.name for c in equitiesTable.__table__.columns]]
+
+
+def getCompactData(rows={}, column='*', start_date='', end_date='',
+                   extended_hours=False, market_hours=MARKET_HOURS, timezone='US/Eastern'):
+    rows = dict(rows)
+    if 'ticker' in rows:
+        ticker = rows.pop('ticker')
+        ids = getTickerIds([ticker], create=False)
+        rows['ticker_id'] = ids.get(ticker, -1) if ids is not False else -1  # unknown ticker, no rows
+    query = data_query(equitiesCompactTable, rows, column, start_date, end_date, extended_hours, market_hours, timezone)
+    try:
+        df = executeQuery(query, prepared=is_small_read(equitiesCompactTable, start_date, end_date, timezone),
+                          profile='analytics')
+        if column != '*':
+            return format_data(equitiesCompactTable, df, column)
+        return compact_frame(df).set_index('datetime')
+    except Exception as e:
+        print(f'==============\nException at getCompactData: {e}\n==============')
+        return False
+
+
+#### get bar data
+
+def interval_seconds(interval):
+    # bucket size and offset of a resample interval, (None, None) for daily and longer
+    num = int(''.join(c for c in interval if c.isdigit()) or 1)
+    unit = ''.join(c for c in interval if not c.isdigit())
+    if unit == 'm':
+        return num * 60, 0
+    if unit == 'h':
+        return num * 3600, 1800
+    return None, None
+
+
+def choose_bars_table(interval):
+    # coarsest bar table whose buckets tile the requested interval, None if only minute data will do
+    seconds, offset = interval_seconds(interval)
+    candidates = []
+    for table, table_seconds, table_offset in BARS_TABLES.values():
+        if seconds is None:
+            if table_seconds is None:
+                return table
+        elif table_seconds is not None and seconds % table_seconds == 0 \
+                and (offset - table_offset) % table_seconds == 0:
+            candidates.append((table_seconds, table))
+    return max(candidates, key=lambda x: x[0])[1] if candidates else None
+
+
+def bars_cache(table, extended_hours):
+    from robinhood_sheryl.rs_bar_cache import BarCache
+    key = (table.__tablename__, bool(extended_hours))
+    with bar_cache_lock:
+        if key not in BARS_CACHES:
+            seconds = [s for t, s, o in BARS_TABLES.values() if t is table][0]
+            # the newest bucket keeps changing until it closes, so always re-read at least one bucket
+            # plus the minutes ingestion may still revise
+            overlap = pd.Timedelta(seconds=seconds) if seconds else pd.Timedelta(days=1)
+            BARS_CACHES[key] = BarCache(f"{key[0]}_{'ext' if key[1] else 'reg'}",
+                                        overlap=overlap + pd.Timedelta(OVERLAP_WINDOW))
+    return BARS_CACHES[key]
+
+
+def bars_query(table, ticker, extended_hours):
+    return Query(f"""SELECT datetime, ticker, open, high, low, close, volume, dividends, stock_splits
+        FROM {table.__tablename__} WHERE ticker = %s AND extended_hours = %s""", ticker, bool(extended_hours))
+
+
+def read_bars(table, ticker, extended_hours, start=None, end=None):
+    query = bars_query(table, ticker, extended_hours)
+    if start is not None:
+        query.add("AND datetime >= %s", start.isoformat())
+    if end is not None:
+        query.add("AND datetime < %s", end.isoformat())
+    df = executeQuery(query, profile='analytics')
+    if df is False:
+        return False
+    df['datetime'] = df['datetime'].dt.tz_convert('UTC')
+    return df
+
+
+#### get tiered data
+# ranges reaching below the minute horizon are stitched together from daily bars (below the
+# intraday horizon), 5m bars (down to the minute horizon) and minute rows, so long horizons read
+# a fraction of the rows. minute rows still come through the local cache
+
+def horizons_from_frame(df):
+    horizons = {}
+    for ticker, tier, horizon in zip(df['ticker'], df['tier'], df['horizon']):
+        if not pd.isnull(horizon):
+            horizons.setdefault(ticker, {})[tier] = pd.Timestamp(horizon).tz_convert('UTC')
+    return horizons
+
+
+def getHorizons(tickers, profile='dashboard'):
+    df = executeQuery(Query("SELECT ticker, tier, horizon FROM bar_horizons WHERE ticker = ANY(%s::text[])",
+                            list(tickers)), prepared=True, profile=profile)
+    if df is False:
+        return False
+    return horizons_from_frame(df)
+
+
+#### horizons of the dashboard reads
+# every per ticker equities read asks for its horizons, the whole (small) table is kept per process.
+# refreshBars/compactBars drop it, horizons moved by another process are picked up after HORIZONS_TTL
+
+HORIZONS_TTL = 300  # seconds
+horizon_cache = {}  # 'horizons': {ticker: {tier: utc timestamp}}, 'loaded_at': time.monotonic()
+horizon_lock = threading.Lock()
+
+
+def invalidate_horizons():
+    with horizon_lock:
+        horizon_cache.clear()
+
+
+def cached_horizons():
+    # {} while the bar_horizons table does not exist (no tiers), False when the database is unreachable
+    with horizon_lock:
+        if horizon_cache and time.monotonic() - horizon_cache['loaded_at'] < HORIZONS_TTL:
+            return horizon_cache['horizons']
+    present = executeQuery(Query("SELECT (to_regclass('bar_horizons') IS NOT NULL)::int AS present"), profile='dashboard')
+    if present is False:
+        return False
+    horizons = {}
+    if int(present['present'].iloc[0]):
+        df = executeQuery(Query("SELECT ticker, tier, horizon FROM bar_horizons"), profile='dashboard')
+        if df is False:
+            return False
+        horizons = horizons_from_frame(df)
+    with horizon_lock:
+        horizon_cache.update(horizons=horizons, loaded_at=time.monotonic())
+    return horizons
+
+
+def getTieredData(ticker, start_date='', end_date='', extended_hours=False,
+                  market_hours=MARKET_HOURS, timezone='US/Eastern', interval=None):
+    # None when the range does not reach below the minute horizon (or on an old schema). with an
+    # interval the rows come bucketed, the minute tier by getBucketedData
+    horizons = cached_horizons()
+    if not horizons or 'minute' not in horizons.get(ticker, {}):
+        return None
+    minute_horizon = horizons[ticker]['minute']
+    intraday_horizon = horizons[ticker].get('intraday')
+    start = pd.Timestamp(to_utc_bound(start_date, timezone)) if start_date else None
+    end = pd.Timestamp(to_utc_bound(end_date, timezone)) if end_date else None
+    if start is not None and start >= minute_horizon:
+        return None
+
+    parts = []
+    # bar rows carry their session in extended_hours, market_hours only applies to the minute tier
+    if intraday_horizon is not None and (start is None or start < intraday_horizon):
+        parts.append(read_bars(equities1dTable, ticker, extended_hours, start,
+                               min(intraday_horizon, end) if end is not None else intraday_horizon))
+    five_start = max(start, intraday_horizon) if start is not None and intraday_horizon is not None \
+        else (start if start is not None else intraday_horizon)
+    parts.append(read_bars(equities5mTable, ticker, extended_hours, five_start,
+                           min(minute_horizon, end) if end is not None else minute_horizon))
+    if any(part is False for part in parts):
+        return False
+    bars = pd.concat(parts, ignore_index=True) if parts else pd.DataFrame()
+    bars['datetime'] = bars['datetime'].dt.tz_convert('US/Eastern')
+    bars = bars.set_index('datetime')[[c.name for c in equitiesTable.__table__.columns if c.name != 'datetime']]
+    if end is not None and end < minute_horizon:
+        return resample_frame(bars.sort_index(), interval, timezone) if interval else bars.sort_index()
+
+    minutes = getData(equitiesTable, {'ticker': ticker}, start_date=minute_horizon.isoformat(), end_date=end_date,
+                      extended_hours=extended_hours, market_hours=market_hours, timezone=timezone, interval=interval)
+    if minutes is False:
+        return False
+    df = pd.concat([bars, minutes]).sort_index()
+    # a bucket straddling the minute horizon comes from both tiers, the aggregates merge its two halves
+    return resample_frame(df, interval, timezone) if interval else df
+
+
+covered_bars = set()  # (bar table name, ticker, extended_hours) known to reach back as far as the minutes
+
+
+def bars_cover(table, ticker, extended_hours, start_date='', timezone='US/Eastern'):
+    # a bar table not backfilled yet only holds recent buckets, reading it would silently truncate history.
+    # it covers a read when its first bar is at or before the start, or before the first stored minute
+    key = (table.__tablename__, ticker, bool(extended_hours))
+    if key in covered_bars:
+        return True
+    df = executeQuery(Query(f"""SELECT
+        (SELECT MIN(datetime) FROM {table.__tablename__} WHERE ticker = %s AND extended_hours = %s) AS bars_start,
+        (SELECT MIN(datetime) FROM equities WHERE ticker = %s) AS minutes_start""",
+        ticker, bool(extended_hours), ticker), profile='analytics')
+    if df is False or df.empty:
+        return False
+    bars_start, minutes_start = (pd.to_datetime(df[c].iloc[0], utc=True) for c in ('bars_start', 'minutes_start'))
+    if pd.isnull(bars_start):
+        return False
+    if not pd.isnull(minutes_start) and bars_start <= minutes_start:
+        covered_bars.add(key)  # backfilled, later backfills and compactions only ever add older bars
+        return True
+    return bool(start_date) and bars_start <= pd.Timestamp(to_utc_bound(start_date, timezone))
+
+
+def getBars(ticker, interval, start_date='', end_date='', extended_hours=False, timezone='US/Eastern'):
+    table = choose_bars_table(interval)
+    if table is None:
+        return None
+    if not bars_cover(table, ticker, extended_hours, start_date, timezone):
+        logging.debug(f'{table.__tablename__} does not cover {ticker} from {start_date or "the first minute"}')
+        return None
+    if BAR_CACHE_ENABLED:
+        df = getCachedData(bars_cache(table, extended_hours), lambda t, lo, hi: read_bars(table, t, extended_hours, lo, hi),
+                           ticker, start_date, end_date, extended_hours=True, timezone=timezone)
+        if df is not False:
+            return df
+    query = bars_query(table, ticker, extended_hours)
+    if start_date:
+        query.add("AND datetime >= %s", to_utc_bound(start_date, timezone))
+    if end_date:
+        query.add("AND datetime <= %s", to_utc_bound(end_date, timezone))
+    try:
+        df = executeQuery(query, profile='analytics')
+        df['datetime'] = pd.to_datetime(df['datetime'])
+        return df.set_index('datetime')
+    except Exception as e:
+        print(f'==============\nException at getBars: {e}\n==============')
         return False
 
 
 #### get latest row data
 
+def latest_row_query(table, value, key='ticker'):
+    if table.__tablename__ in CURRENT_TABLES and CURRENT_TABLES[table.__tablename__][1] == key:
+        return Query(f"SELECT * FROM {snapshot_source(table)} WHERE {key} = %s", value)
+    return Query(
+        f"SELECT * FROM {table.__tablename__} WHERE {key} = %s AND datetime = (SELECT MAX(datetime) FROM {table.__tablename__} WHERE {key} = %s)",
+        value, value)
+
+
 def getLatestRowData(table, value, key='ticker'):
-    return executeQuery(
-        f"SELECT * FROM {table.__tablename__} WHERE {key} = '{value}' AND datetime = (SELECT MAX(datetime) FROM {table.__tablename__} WHERE {key} = '{value}')")
+    return executeQuery(latest_row_query(table, value, key), prepared=True, profile='dashboard')
+
+
+#### get watermarks
+# last ingested rows of every ticker in one round trip, each lateral MAX is a single backward
+# probe of the (ticker, datetime) index and the rows after it a short range scan of the same index
+
+def getOverlapRows(table, values, window, key='ticker'):
+    # the stored rows of the last `window` up to each key's watermark, in one lateral query. both probes use
+    # the (ticker, datetime) index, the primary key leads with datetime
+    if len(values) == 0:
+        return pd.DataFrame()
+    df = executeQuery(Query(f"""
+        SELECT r.* FROM unnest(%s::text[]) AS k({key})
+        CROSS JOIN LATERAL (
+            SELECT MAX(datetime) AS hi FROM {table.__tablename__} t WHERE t.{key} = k.{key}
+        ) w
+        CROSS JOIN LATERAL (
+            SELECT * FROM {table.__tablename__} t
+            WHERE t.{key} = k.{key} AND t.datetime > w.hi - %s::interval AND t.datetime <= w.hi
+        ) r""", list(values), f'{int(window.total_seconds())} seconds'), prepared=True, profile='ingest')
+    if df is False:
+        return False
+    if 'datetime' in df.columns:
+        df['datetime'] = df['datetime'].dt.tz_convert('UTC')
+    return df
+
+
+#### tickers table map
+# the tickers table (ids, tickers and names of holdings and watchlists) is small, it is read in one
+# query and kept in memory for the collection cycle. every write to it drops the map (invalidate_results)
+
+ticker_map = {}  # 'df': tickers table frame, empty until loaded
+ticker_map_lock = threading.Lock()  # the portfolio collectors share the map across threads
+
+
+def getTickerMap(refresh=False):
+    with ticker_map_lock:
+        df = None if refresh else ticker_map.get('df')
+    if df is None:
+        # primary, the map is reloaded right after update_portfolio_tickers writes new ids
+        df = executeQuery(data_query(tickersTable), prepared=True, profile='ingest')
+        if df is False:
+            return False
+        with ticker_map_lock:
+            ticker_map['df'] = df
+    return df
+
+
+def lookupTickers(ids, column='ticker'):
+    # vectorized id -> ticker (or name) lookup, unknown ids map to NaN
+    df = getTickerMap()
+    if df is False:
+        return False
+    return pd.Series(ids, dtype=object).map(df.drop_duplicates(subset=['id']).set_index('id')[column]).to_numpy()
+
+
+#### instruments cache
+
+def getInstruments(ids):
+    # cached instrument metadata rows of the given ids, ids never seen are missing from the frame
+    if len(ids) == 0:
+        return pd.DataFrame(columns=[c.name for c in instrumentsTable.__table__.columns])
+    return executeQuery(Query("SELECT * FROM instruments WHERE id = ANY(%s::text[])", list(ids)),
+                        prepared=True, profile='ingest')
+
+
+#### latest snapshot source
+
+verified_current_tables = set()
+
+
+def snapshot_source(table, profile='dashboard'):
+    # the maintained current table once it holds rows, the history table until then. the latest-per-key
+    # queries below return the same rows on either source. read only, the current tables are built on
+    # the ingest side (initTables, insert_portfolio_data -> ensureCurrentTables)
+    name = table.__tablename__
+    if name not in CURRENT_TABLES:
+        return name
+    if name not in verified_current_tables:
+        current = CURRENT_TABLES[name][0].__tablename__
+        df = executeQuery(Query(f"SELECT (EXISTS (SELECT 1 FROM {current}))::int AS present"), profile=profile)
+        if df is False or df.empty or not df['present'].iloc[0]:
+            return name  # current table missing or not built yet, read history and check again on the next call
+        verified_current_tables.add(name)
+    return CURRENT_TABLES[name][0].__tablename__
 
 
 #### get latest data
 
 
+def latest_data_query(table, key='ticker'):
+    source = snapshot_source(table)
+    return Query(
+        f"SELECT * FROM {source} WHERE {key} NOT LIKE '^%%' AND (datetime,{key}) IN (SELECT MAX(datetime),{key} FROM {source} GROUP BY {key})")
+
+
 def getLatestData(table, key='ticker'):
-    return executeQuery(
-        f"SELECT * FROM {table.__tablename__} WHERE {key} NOT LIKE '^%%' AND (datetime,{key}) IN (SELECT MAX(datetime),{key} FROM {table.__tablename__} GROUP BY {key})")
+    return executeQuery(latest_data_query(table, key), prepared=True, profile='dashboard')
 
 
 #### get latest data with name
 
-def getLatestDataNamed(table):
-    return executeQuery(f"""
+def latest_named_query(table):
+    source = snapshot_source(table)
+    return Query(f"""
             SELECT t1.*, t2.name FROM
-            (SELECT * FROM {table.__tablename__}
-            WHERE (datetime,ticker) IN (SELECT MAX(datetime),ticker FROM {table.__tablename__} GROUP BY ticker)) t1
+            (SELECT * FROM {source}
+            WHERE (datetime,ticker) IN (SELECT MAX(datetime),ticker FROM {source} GROUP BY ticker)) t1
             JOIN (select distinct ticker, name from tickers) t2
             ON t1.ticker = t2.ticker
         """)
 
 
+def getLatestDataNamed(table):
+    return executeQuery(latest_named_query(table), prepared=True, profile='dashboard')
+
+
 #### write data
 
 def split_dataframe(df, chunk_size=2500):
@@ -334,30 +1581,133 @@ def split_dataframe(df, chunk_size=2500):
     return chunks
 
 
-def insertData(table, df, db_name):
+def insertData(table, df, db_name, bulk=False, spool=True, connection=None):
+    # with a connection the rows are written in the caller's transaction: exceptions propagate and
+    # the caller commits, spools and invalidates the result cache
+    if bulk and connection is None:
+        return copyData(table, df, db_name, conflict='nothing', spool=spool)
+    if connection is None and spool and spool_pending():
+        return spool_behind(table, df, db_name, 'nothing')
     try:
-        dwhConnection = conn.connect()
+        start = time.time()
+        dwhConnection = connection or get_engine('ingest').connect()
         # cloud sql doesn't convert python datetime object properly
         if 'datetime' in df.columns:
             df['datetime'] = df['datetime'].dt.tz_convert('UTC').dt.strftime('%Y-%m-%d %H:%M:%S%z')
         chunks = split_dataframe(df)
-        for chunk in chunks:
-            pg_sql = insert(table.__table__, chunk.to_dict("records")).on_conflict_do_nothing()
-            dwhConnection.execute(pg_sql)
+        with dwhConnection.begin() if connection is None else nullcontext():
+            for chunk in chunks:
+                pg_sql = insert(table.__table__, chunk.to_dict("records")).on_conflict_do_nothing()
+                dwhConnection.execute(pg_sql)
+            if table.__tablename__ in CURRENT_TABLES:
+                upsertCurrent(dwhConnection, table, df)
         # print(pg_sql) # will give error 'The 'default' dialect with current database version settings does not support in-place multirow inserts.' bc print is not dialect aware
-        print(f'==============\n{len(df)} rows written to {db_name} db {table.__tablename__} table in {len(chunks)} chunks\n==============')
+        elapsed = max(time.time() - start, 1e-6)
+        print(f'==============\n{len(df)} rows written to {db_name} db {table.__tablename__} table in {len(chunks)} chunks '
+              f'({len(df) / elapsed:,.0f} rows/sec)\n==============')
         # logging.debug(f'{len(df)} rows written to {db_name} db {table.__tablename__} table in {len(chunks)} chunks')
-        dwhConnection.close()
+        if connection is None:
+            dwhConnection.close()
+            invalidate_results(table)
         return True
     except Exception as e:
+        if connection is not None:
+            raise
         print(f'==============\nException at insertData: {e}\n==============')
+        if spool and SPOOL_ENABLED and is_connection_error(e):
+            return spoolWrite(table, df, db_name, 'nothing')
+        return False
+
+
+#### write a snapshot of several tables
+# one transaction for all tables, so readers never see a snapshot half written
+
+def insertSnapshot(frames, db_name):
+    # frames: [(table, df)], written in order
+    if spool_pending():  # older batches are waiting, the snapshot queues behind them table by table
+        return all([insertData(table, df, db_name) for table, df in frames])
+    dwhConnection = None
+    try:
+        start = time.time()
+        dwhConnection = get_engine('ingest').connect()
+        with dwhConnection.begin():
+            for table, df in frames:
+                insertData(table, df, db_name, connection=dwhConnection)
+        invalidate_results(*[table for table, _ in frames])
+        print(f'==============\nsnapshot of {len(frames)} tables committed to {db_name} db in {time.time() - start:.2f}s\n==============')
+        return True
+    except Exception as e:
+        print(f'==============\nException at insertSnapshot: {e}\n==============')
+        if SPOOL_ENABLED and is_connection_error(e):
+            return all([spoolWrite(table, df, db_name) for table, df in frames])
+        return False
+    finally:
+        if dwhConnection is not None:
+            dwhConnection.close()
+
+
+#### latest snapshot upsert
+# runs inside the caller's transaction so history and current tables never disagree
+
+def upsertCurrent(dwhConnection, table, df):
+    current, key = CURRENT_TABLES[table.__tablename__]
+    # datetime is already a uniform utc string here, so it sorts chronologically
+    latest = df.sort_values('datetime').drop_duplicates(subset=[key], keep='last')
+    stmt = insert(current.__table__, latest.to_dict("records"))
+    dwhConnection.execute(stmt.on_conflict_do_update(
+        index_elements=[key],
+        set_=dict(stmt.excluded),
+        where=current.__table__.c.datetime <= stmt.excluded.datetime
+    ))
+
+
+built_current_tables = set()  # history table names whose current table this process has checked or rebuilt
+
+
+def ensureCurrentTables(db_name=DATABASE):
+    # rebuilds the empty current tables from history, once per process, on the primary
+    isRun = True
+    for name in CURRENT_TABLES:
+        if name in built_current_tables:
+            continue
+        if rebuildCurrentTable(write_table(name), db_name, only_if_empty=True):
+            built_current_tables.add(name)
+        else:
+            isRun = False
+    return isRun
+
+
+def rebuildCurrentTable(table, db_name, only_if_empty=False):
+    current, key = CURRENT_TABLES[table.__tablename__]
+    cols = ', '.join(c.name for c in current.__table__.columns)
+    try:
+        dwhConnection = get_engine('ingest').connect()
+        if only_if_empty and dwhConnection.execute(
+                f"SELECT EXISTS (SELECT 1 FROM {current.__tablename__})").scalar():
+            dwhConnection.close()
+            return True
+        with dwhConnection.begin():
+            dwhConnection.execute(f"DELETE FROM {current.__tablename__}")
+            dwhConnection.execute(f"""INSERT INTO {current.__tablename__} ({cols})
+                SELECT DISTINCT ON ({key}) {cols} FROM {table.__tablename__} ORDER BY {key}, datetime DESC""")
+        dwhConnection.close()
+        print(f'==============\nrebuilt {db_name} db {current.__tablename__} table from {table.__tablename__} history\n==============')
+        invalidate_results(table)
+        return True
+    except Exception as e:
+        print(f'==============\nException at rebuildCurrentTable: {e}\n==============')
         return False
 
 
 #### update Tickers data
-def updateData(table, df, db_name, index_elements):
+def updateData(table, df, db_name, index_elements, bulk=False, spool=True):
+    if bulk:
+        return copyData(table, df, db_name, conflict='update', index_elements=index_elements, spool=spool)
+    if spool and spool_pending():
+        return spool_behind(table, df, db_name, 'update', index_elements)
     try:
-        dwhConnection = conn.connect()
+        start = time.time()
+        dwhConnection = get_engine('ingest').connect()
         if 'datetime' in df.columns:
             df['datetime'] = df['datetime'].dt.tz_convert('UTC').dt.strftime('%Y-%m-%d %H:%M:00%z')
         chunks = split_dataframe(df)
@@ -372,18 +1722,29 @@ def updateData(table, df, db_name, index_elements):
             dwhConnection.execute(pg_sql)
             # print(pg_sql) # will give error 'The 'default' dialect with current database version settings does not support in-place multirow inserts.' bc print is not dialect aware
         # logging.debug(f'{len(df)} rows updated/written to {db_name} db {table.__tablename__} table in {len(chunks)} chunks')
+        elapsed = max(time.time() - start, 1e-6)
         print(
-            f'==============\n{len(df)} rows updated/written to {db_name} db {table.__tablename__} table in {len(chunks)} chunks\n==============')
+            f'==============\n{len(df)} rows updated/written to {db_name} db {table.__tablename__} table in {len(chunks)} chunks '
+            f'({len(df) / elapsed:,.0f} rows/sec)\n==============')
         dwhConnection.close()
+        invalidate_results(table)
         return True
     except Exception as e:
         print(f'==============\nException at updateData: {e}\n==============')
+        if spool and SPOOL_ENABLED and is_connection_error(e):
+            return spoolWrite(table, df, db_name, 'update', index_elements)
         return False
 
 #### update yf Dividend data
-def updateDividendsData(table, df, db_name, index_elements):
+def updateDividendsData(table, df, db_name, index_elements, bulk=False, spool=True):
+    if bulk:
+        return copyData(table, df, db_name, conflict='dividends', index_elements=index_elements, spool=spool)
+    if spool and spool_pending():
+        return spool_behind(table, df, db_name, 'dividends', index_elements)
     try:
-        dwhConnection = conn.connect()
+        start = time.time()
+        dwhConnection = get_engine('ingest').connect()
+        rewritten = rewritten_since(table, df)
         if 'datetime' in df.columns:
             df['datetime'] = df['datetime'].dt.tz_convert('UTC').dt.strftime('%Y-%m-%d %H:%M:00%z')
         chunks = split_dataframe(df)
@@ -398,346 +1759,498 @@ def updateDividendsData(table, df, db_name, index_elements):
             dwhConnection.execute(pg_sql)
             # print(pg_sql) # will give error 'The 'default' dialect with current database version settings does not support in-place multirow inserts.' bc print is not dialect aware
         # logging.debug(f'{len(df)} rows updated/written to {db_name} db {table.__tablename__} table in {len(chunks)} chunks')
+        elapsed = max(time.time() - start, 1e-6)
         print(
-            f'==============\n{len(df)} dividend rows updated to {db_name} db {table.__tablename__} table in {len(chunks)} chunks\n==============')
+            f'==============\n{len(df)} dividend rows updated to {db_name} db {table.__tablename__} table in {len(chunks)} chunks '
+            f'({len(df) / elapsed:,.0f} rows/sec)\n==============')
         dwhConnection.close()
+        invalidate_results(table)
+        invalidate_bar_caches(rewritten)
         return True
     except Exception as e:
         print(f'==============\nException at updateDividendsData: {e}\n==============')
+        if spool and SPOOL_ENABLED and is_connection_error(e):
+            return spoolWrite(table, df, db_name, 'dividends', index_elements)
         return False
 
 
-#### update Tickers data
-def deleteRow(table, row, value, db_name):
-    try:
-        dwhConnection = conn.connect()
-        pg_sql = f"""DELETE FROM {table.__tablename__}
-                    WHERE {row} = '{value}' AND t_type='equity';"""
+#### bulk write data
+# stream the dataframe through COPY FROM STDIN into a temp staging table and merge it
+# into the target table with a single INSERT ... SELECT ... ON CONFLICT statement. nulls are written as \N,
+# an empty text value stays an empty string like on the row insert path (csv COPY reads '' as NULL)
 
-        # print(pg_sql) # will give error 'The 'default' dialect with current database version settings does not support in-place multirow inserts.' bc print is not dialect aware
-        dwhConnection.execute(pg_sql)
-        logging.debug(f'{value} deleted from {db_name} db {table.__tablename__} table')
-        dwhConnection.close()
-        return True
-    except Exception as e:
-        print(f'==============\nException at deleteRow: {e}\n==============')
-        return False
+COPY_NULL = '\\N'
+CONFLICT_ACTIONS = ('nothing', 'update', 'dividends')
 
 
-##################
-# YFINANCE
-##################
+def copy_from_stdin(cur, copy_sql, store):
+    if hasattr(cur, 'copy_expert'):  # psycopg2
+        cur.copy_expert(copy_sql, store)
+    else:  # pg8000 streams COPY data through execute
+        cur.execute(copy_sql, stream=store)
+
+
+def frame_to_copy_buffer(table, df):
+    # integer columns holding floats (e.g. stock_splits 0.0) are rejected by COPY, cast them back
+    int_cols = [c.name for c in table.__table__.columns
+                if c.name in df.columns and isinstance(c.type, Integer) and pd.api.types.is_float_dtype(df[c.name])]
+    if int_cols:
+        df = df.assign(**{c: df[c].round().astype('Int64') for c in int_cols})
+    store = io.StringIO()
+    df.to_csv(store, index=False, header=False, na_rep=COPY_NULL)
+    store.seek(0)
+    return store
+
+
+def build_merge_sql(table, staging, columns, conflict, index_elements):
+    cols = ', '.join(columns)
+    keys = ', '.join(index_elements)
+    if conflict == 'dividends':
+        action = 'DO UPDATE SET dividends = EXCLUDED.dividends'
+    elif conflict == 'update':
+        update_cols = [c for c in columns if c not in index_elements]
+        action = ('DO UPDATE SET ' + ', '.join(f'{c} = EXCLUDED.{c}' for c in update_cols)
+                  if update_cols else 'DO NOTHING')
+    else:
+        action = 'DO NOTHING'
+    return f"INSERT INTO {table.__tablename__} ({cols}) SELECT {cols} FROM {staging} ON CONFLICT ({keys}) {action}"
 
-#### get yfinance data and read tickers
 
-def get_yf_data(ticker, start_date):
-    stock = yf.Ticker(ticker)
-    # df = stock.history(period='ytd', prepost=True)
-    if start_date:
-        df = stock.history(interval="1m", start=start_date, prepost=True)[:-1]  # drop duplicate data with non 0 seconds
-    else:  # catchup
-        df = stock.history(interval='1m', period='5d', prepost=True)[:-1]
+def build_current_merge_sql(table, staging, columns):
+    current, key = CURRENT_TABLES[table.__tablename__]
+    cols = ', '.join(columns)
+    return f"""INSERT INTO {current.__tablename__} ({cols})
+        SELECT DISTINCT ON ({key}) {cols} FROM {staging} ORDER BY {key}, datetime DESC
+        ON CONFLICT ({key}) DO UPDATE SET {', '.join(f'{c} = EXCLUDED.{c}' for c in columns)}
+        WHERE {current.__tablename__}.datetime <= EXCLUDED.datetime"""
 
-    # logging.debug(f'getting data for {ticker}')
-    if df.empty:
-        logging.debug(f'{ticker}: No data found for this date range, symbol may be delisted')
-        return df
 
-    df = df.reset_index()
-    df.insert(1, 'ticker', ticker)
-    logging.debug(f"columns for {ticker} are: {','.join(df.columns)}")
-    df.columns = ['datetime', 'ticker', 'open', 'high', 'low', 'close', 'volume', 'dividends', 'stock_splits']
-    df['datetime'] = df['datetime'].dt.tz_convert('US/Eastern').dt.tz_convert('UTC')
-    # df['datetime'] = df['datetime'].dt.tz_localize(None)
-    return df
+def copyData(table, df, db_name, conflict='nothing', index_elements=None, spool=True):
+    if spool and spool_pending():
+        return spool_behind(table, df, db_name, conflict, index_elements)
+    raw_conn = None
+    try:
+        start = time.time()
+        if conflict not in CONFLICT_ACTIONS:
+            raise ValueError(f'conflict must be one of {CONFLICT_ACTIONS}, got {conflict}')
+        if index_elements is None:
+            index_elements = [c.name for c in table.__table__.primary_key]
+        df = df.copy()
+        rewritten = rewritten_since(table, df) if conflict == 'dividends' else {}
+        # same datetime formatting as the insert/update paths
+        if 'datetime' in df.columns:
+            fmt = '%Y-%m-%d %H:%M:%S%z' if conflict == 'nothing' else '%Y-%m-%d %H:%M:00%z'
+            df['datetime'] = df['datetime'].dt.tz_convert('UTC').dt.strftime(fmt)
+        if conflict != 'nothing':
+            # ON CONFLICT DO UPDATE cannot touch the same row twice in one statement
+            df = df.drop_duplicates(subset=index_elements, keep='last')
+        columns = list(df.columns)
+        staging = f'{table.__tablename__}_staging'
+
+        raw_conn = get_engine('ingest').raw_connection()
+        cur = raw_conn.cursor()
+        cur.execute(f"CREATE TEMP TABLE {staging} (LIKE {table.__tablename__} INCLUDING DEFAULTS) ON COMMIT DROP")
+        copy_from_stdin(cur, f"COPY {staging} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv, NULL '{COPY_NULL}')",
+                        frame_to_copy_buffer(table, df))
+        cur.execute(build_merge_sql(table, staging, columns, conflict, index_elements))
+        if table.__tablename__ in CURRENT_TABLES:
+            cur.execute(build_current_merge_sql(table, staging, columns))
+        raw_conn.commit()
+        cur.close()
 
+        elapsed = max(time.time() - start, 1e-6)
+        print(f'==============\n{len(df)} rows copied/merged ({conflict}) to {db_name} db {table.__tablename__} table '
+              f'in {elapsed:.2f}s ({len(df) / elapsed:,.0f} rows/sec)\n==============')
+        invalidate_results(table)
+        invalidate_bar_caches(rewritten)
+        return True
+    except Exception as e:
+        if raw_conn is not None:
+            raw_conn.rollback()
+        print(f'==============\nException at copyData: {e}\n==============')
+        if spool and SPOOL_ENABLED and is_connection_error(e):
+            return spoolWrite(table, df, db_name, conflict, index_elements)
+        return False
+    finally:
+        if raw_conn is not None:
+            raw_conn.close()
 
-#### insert yfinance data
 
-def insert_yf_data(tickers_list=None, catchup=False, print_details=False):
-    if tickers_list is None:
-        tickers_list = getData(tickersTable, column='ticker')
-        tickers_list = list(set(tickers_list))
-        tickers_list.extend(list(INDEXES.values()))
-    if catchup is True:
-        print(f"\n==============\nCATCHUP: getting data for equities for catchup run from period 5d\n==============")
-    for ticker in tickers_list:
-        # get max datetime of last ticker scrape
-        start_time = getLatestRowData(equitiesTable, ticker)['datetime'].iloc[0]
-        if pd.isnull(start_time) or catchup is True:  # no prior data, first time catchup run
-            start_date = ''
-            if print_details:
-                print(f"\n==============\nREQUEST: getting data for equities {ticker} from period 5d\n==============")
-        else:
-            start_date = start_time.replace(tzinfo=None) - timedelta(minutes=5)
-            if print_details:
-                print(
-                    f"\n==============\nREQUEST: getting data for equities {ticker} from {start_date}\n==============")
-        df = get_yf_data(ticker, start_date)
-        if df.empty:
-            # no data for ticker, remove from ticker list
-            # deleteRow(tickersTable,'ticker',ticker,DATABASE)
-            print(f"\n==============\nSKIPPED: no data for {ticker}\n==============")
-            status = True
-        else:
-            logging.debug(f'formatted data for {ticker}')
-            df_dividends = df[df.isna().any(axis=1)]  # get dividends row if any
-            if df_dividends.empty is False:
-                df_dividends = df_dividends.fillna(0)
-                status = updateDividendsData(equitiesTable, df_dividends, DATABASE, ['datetime', 'ticker'])
-                if not status:
-                    print(f"\n==============\nTERMINATED: Exception at {ticker} during update dividends\n==============")
-                    return False
-                df = df.dropna()  #drop na dividend rows
-            status = insertData(equitiesTable, df, DATABASE)
-            time.sleep(0.25)
-        if not status:
-            print(f"\n==============\nTERMINATED: Exception at {ticker} during insert\n==============")
-            return False
-    return True
+#### write spool
+# batches that fail because the database is unreachable are parked in the local spool and replayed
+# in order through copyData once it is back. while anything is spooled new writes queue behind it,
+# so an older replayed upsert can never overwrite a newer one. every conflict action is idempotent,
+# a batch replayed twice (crash between commit and segment removal) writes the same rows
 
+SPOOL_ENABLED = os.environ.get('RS_WRITE_SPOOL', '1') != '0'
+SPOOL_REPLAY_ROWS = 200000  # max rows merged by one replayed copyData
+WRITE_SPOOL = None  # WriteSpool, created on first use so importing the module does not load pyarrow
+write_spool_lock = threading.Lock()
+WRITE_TABLES = {}  # table name: declarative class, replay target lookup
 
-##################
-# PORTFOLIO
-##################
 
-#### update portfolio tickers
+def is_connection_error(e):
+    # refused/dropped connections and pool timeouts on both drivers. data errors are not spooled,
+    # their replay would fail forever and hold back everything queued behind them
+    if isinstance(e, (exc.OperationalError, exc.InterfaceError, exc.DisconnectionError, exc.TimeoutError,
+                      ConnectionError, TimeoutError)):
+        return True
+    return type(e).__name__ in ('OperationalError', 'InterfaceError')  # raw dbapi errors from raw_connection
 
-def update_portfolio_tickers(hold_ids, prev_hold_ids, t_type):
-    logging.debug(f're-loading tickers for portfolio')
-    # d = r.account.get_open_stock_positions()
-    # df = pd.DataFrame.from_dict(d)
-    current_tickers_df = getData(tickersTable, rows={'t_type': t_type})
-    if isinstance(current_tickers_df,pd.DataFrame):
-        current_tickers_df['hold'] = current_tickers_df['id'].apply(
-            lambda x: True if x in hold_ids else False)
-    else:
-        current_tickers_df = pd.DataFrame()
 
-    new_ids = np.setdiff1d(hold_ids, prev_hold_ids)
-    print(f"\n==============\nNEW IDS TO INSERT:\n{new_ids}\n==============")
+def write_spool():
+    global WRITE_SPOOL
+    with write_spool_lock:
+        if WRITE_SPOOL is None:
+            from robinhood_sheryl.rs_spool import WriteSpool
+            WRITE_SPOOL = WriteSpool()
+    return WRITE_SPOOL
 
-    tickers_df = pd.DataFrame()
-    tickers_df['id'] = new_ids
-    if t_type == 'option':
-        tickers_df['ticker'] = tickers_df['id'].apply(
-            lambda x: r.options.get_option_instrument_data_by_id(x, info='chain_symbol'))
-    else:
-        tickers_df['ticker'] = tickers_df['id'].apply(lambda x: r.stocks.get_stock_quote_by_id(x, info='symbol'))
-        insert_yf_data(list(tickers_df['ticker']))
 
-    tickers_df['name'] = tickers_df['ticker'].apply(lambda x: r.stocks.get_name_by_symbol(x))
-    tickers_df['hold'] = True
-    tickers_df['t_type'] = t_type
+def spool_pending():
+    return SPOOL_ENABLED and write_spool().pending()
 
-    tickers_df = pd.concat([tickers_df, current_tickers_df]).drop_duplicates().reset_index(drop=True)
-    print(f"\n==============\nTOTAL WATCHLIST:\n{tickers_df[tickers_df['hold'] == False]}\n==============")
-    status = updateData(tickersTable, tickers_df, DATABASE, ['ticker', 't_type', 'id'])
 
-    if not status:
-        print(f"\n==============\nTERMINATED: Exception at insert portfolio tickers\n==============")
+def spoolWrite(table, df, db_name, conflict='nothing', index_elements=None):
+    try:
+        if 'datetime' in df.columns and not pd.api.types.is_datetime64_any_dtype(df['datetime']):
+            # the insert/update paths format datetimes to strings in place before they fail
+            df = df.assign(datetime=pd.to_datetime(df['datetime'], utc=True))
+        spool = write_spool()
+        spool.append(df, {'table': table.__table__.name, 'conflict': conflict,
+                          'index_elements': index_elements, 'db_name': db_name})
+        print(f'==============\nSPOOLED: {len(df)} rows ({conflict}) for {db_name} db {table.__table__.name} table, '
+              f'spool depth {spool.depth()["segments"]}\n==============')
+        return True
+    except Exception as e:
+        print(f'==============\nException at spoolWrite: {e}\n==============')
         return False
 
-    return tickers_df[['id', 'ticker', 'name']]
 
+def spool_behind(table, df, db_name, conflict='nothing', index_elements=None):
+    # older batches are still waiting, queue this one after them and try to drain
+    if not spoolWrite(table, df, db_name, conflict, index_elements):
+        return False
+    replaySpool(db_name)
+    return True
 
-#### get portfolio data
 
-def get_portfolio_data():
-    logging.debug(f'getting data for portfolio')
-    # get data
-    d = r.account.get_open_stock_positions()
-    df = pd.DataFrame.from_dict(d)
-    df['id'] = df['instrument'].apply(lambda x: x.split('/')[-2])
-    hold_ids = list(df['id'])
+def write_table(name):
+    if not WRITE_TABLES:
+        WRITE_TABLES.update({cls.__table__.name: cls for cls in Base.__subclasses__()})
+    return WRITE_TABLES[name]
 
-    prev_hold_ids = getData(tickersTable, rows={'hold': True, 't_type': 'equity'}, column='id')
-    if not prev_hold_ids:  # empty table
-        prev_hold_ids = []
-    if sorted(hold_ids) != sorted(prev_hold_ids):
-        update_portfolio_tickers(hold_ids, prev_hold_ids, t_type='equity')
 
-    all_ids = getData(tickersTable, rows={'t_type': 'equity'}, column='id')
-    watchlist_df = pd.DataFrame(np.setdiff1d(all_ids, hold_ids), columns=['id'])
-    df = df.append(watchlist_df).reset_index(drop=True)
-    print(f"\n==============\nEQUITIES WATCHLIST:\n{watchlist_df}\n==============")
-    df['ticker'] = df['id'].apply(lambda x: getData(tickersTable, rows={'id': x}, column='ticker'))
-    df['latest_price'] = r.stocks.get_latest_price(list(df['ticker']), priceType=None, includeExtendedHours=True)
-    df = df[['ticker', 'average_buy_price', 'quantity', 'latest_price']]
+def replay_key(df, meta):
+    # only batches with the same target, action and columns can be merged in one statement
+    return meta['table'], meta['conflict'], tuple(meta['index_elements'] or ()), tuple(df.columns)
 
-    info_df = pd.DataFrame(r.stocks.get_quotes(list(df['ticker'])))
-    df = pd.concat([df, info_df], axis=1)
-    df['prev_close_price'] = df['adjusted_previous_close']
-    df['prev_close_unadjusted'] = df['previous_close']
-    df['datetime'] = pd.to_datetime(df['updated_at']).dt.tz_convert('US/Eastern')  #.dt.tz_localize(None)
-    df['previous_close_date'] = pd.to_datetime(df['previous_close_date']).dt.date
 
-    # convert type
-    numerical_cols = ['average_buy_price', 'quantity', 'prev_close_price', 'prev_close_unadjusted',
-                      'ask_price', 'ask_size', 'bid_price', 'bid_size', 'latest_price', 'last_trade_price',
-                      'last_extended_hours_trade_price']
-    df[numerical_cols] = df[numerical_cols].apply(pd.to_numeric)
+def replay_batch(batch, db_name):
+    segments = [segment for segment, _, _ in batch]
+    meta = batch[0][2]
+    df = pd.concat([frame for _, frame, _ in batch], ignore_index=True)
+    table = write_table(meta['table'])
+    start = time.time()
+    # copyData keeps the last row per key for upserts, i.e. the newest spooled value wins
+    status = copyData(table, df, db_name, meta['conflict'], meta['index_elements'], spool=False)
+    write_spool().record_replay(len(batch) if status else 0, len(df) if status else 0, time.time() - start,
+                              failed=not status)
+    if not status:
+        return False
+    write_spool().remove(segments)
+    if table is equitiesTable and not df.empty:
+        refreshBars(df['ticker'].unique(), df['datetime'].min(), df['datetime'].max(), db_name)
+    return True
 
-    df = df[['datetime', 'ticker'] + numerical_cols + ['previous_close_date']]
-    # df = df[['ticker'] + numerical_cols + ['previous_close_date']]
 
-    # insert one row at a time to prevent sqlite database malformed error
-    # for row in df.to_dict('records'):
-    #     dbms.write_row('portfolio',row)
-    # logging.debug(f'written to {DATABASE} db')
+def replaySpool(db_name=DATABASE, max_rows=SPOOL_REPLAY_ROWS):
+    # drain the spool oldest first, stops at the first failed batch so the write order is kept
+    spool = write_spool()
+    segments = spool.segments()
+    if not segments:
+        return True
+    start, replayed = time.time(), spool.metrics['replayed_rows']
+    batch, rows = [], 0
+    for segment in segments:
+        try:
+            df, meta = spool.read(segment)
+        except Exception as e:
+            # segments are renamed into place complete, an unreadable one is set aside rather than blocking the spool
+            print(f'==============\nException at replaySpool: {segment} unreadable, moved aside: {e}\n==============')
+            os.replace(os.path.join(spool.directory, segment),
+                       os.path.join(spool.directory, segment + '.corrupt'))
+            continue
+        if batch and (replay_key(df, meta) != replay_key(batch[0][1], batch[0][2]) or rows + len(df) > max_rows):
+            if not replay_batch(batch, db_name):
+                return False
+            batch, rows = [], 0
+        batch.append((segment, df, meta))
+        rows += len(df)
+    if batch and not replay_batch(batch, db_name):
+        return False
+    elapsed = max(time.time() - start, 1e-6)
+    replayed = spool.metrics['replayed_rows'] - replayed
+    print(f'==============\nreplayed {len(segments)} spooled batches ({replayed} rows) to {db_name} db '
+          f'in {elapsed:.2f}s ({replayed / elapsed:,.0f} rows/sec)\n==============')
+    return True
 
-    return df
 
+def spoolStats():
+    return write_spool().stats()
 
-#### get crypto data
-
-def get_crypto_data():
-    def get_yesterday_midnight_price(ticker):
-        df = pd.DataFrame(
-            r.crypto.get_crypto_historicals(
-                ticker, interval='5minute', span='week'))
-        df['datetime'] = pd.to_datetime(df['begins_at']).dt.tz_convert('US/Eastern').dt.tz_localize(None)
-        df = df.set_index('datetime')['close_price'].resample('D').last()
-        yesterday = (datetime.today() - BDay(1)).strftime('%Y-%m-%d')
-        return df.loc[yesterday]
-
-    df = pd.DataFrame()
-    crypto_df = pd.DataFrame(r.crypto.get_crypto_positions())
-    df['id'] = crypto_df['currency'].apply(lambda x: x['id'])
-    df['datetime'] = datetime.now(tz=pytz.timezone('US/Eastern'))#.replace(tzinfo=None)
-    df['name'] = crypto_df['currency'].apply(lambda x: x['name'])
-    df['ticker'] = crypto_df['currency'].apply(lambda x: x['code'])
-    df['average_buy_price'] = crypto_df['cost_bases'].apply(lambda x: x[0]['direct_cost_basis'])
-    df['quantity'] = crypto_df['quantity']
-    df['prev_close_price'] = df['ticker'].apply(lambda x: get_yesterday_midnight_price(x))
-    df['latest_price'] = df['ticker'].apply(lambda x: r.crypto.get_crypto_quote(x, info='mark_price'))
-
-    # convert type
-    numerical_cols = ['average_buy_price', 'quantity', 'prev_close_price', 'latest_price']
-    df[numerical_cols] = df[numerical_cols].apply(pd.to_numeric)
-    df['average_buy_price'] = df['average_buy_price'] / df['quantity']
-
-    df = df[['datetime', 'name', 'ticker', 'average_buy_price', 'quantity', 'prev_close_price', 'latest_price']]
-    # df = df[['name', 'ticker', 'average_buy_price', 'quantity', 'prev_close_price', 'latest_price']]
 
-    return df
+#### write compact equities
 
+def insertCompactData(df, db_name, conflict='nothing'):
+    ids = getTickerIds(df['ticker'].unique())
+    if ids is False:
+        return False
+    compact = df.drop(columns=['ticker']).assign(ticker_id=df['ticker'].map(ids))
+    return copyData(equitiesCompactTable, compact[[c.name for c in equitiesCompactTable.__table__.columns]],
+                    db_name, conflict=conflict)
 
-#### get options data
-
-def get_options_data():
-    # get data
-    d = r.options.get_open_option_positions()
-    df = pd.DataFrame.from_dict(d)
-    df['option_id'] = df['option'].apply(lambda x: x.split('/')[-2])
-    df = df.rename(columns={'chain_symbol': 'ticker', 'average_price': 'average_buy_price'})
-
-    hold_ids = list(df['option_id'])
-
-    prev_hold_ids = getData(tickersTable, rows={'hold': True, 't_type': 'option'}, column='id')
-    if sorted(hold_ids) != sorted(prev_hold_ids):
-        update_portfolio_tickers(hold_ids, prev_hold_ids, 'option')
-
-    all_ids = getData(tickersTable, rows={'t_type': 'option'}, column='id')
-    watchlist_df = pd.DataFrame(np.setdiff1d(all_ids, hold_ids), columns=['option_id'])
-    watchlist_df['ticker'] = watchlist_df['option_id'].apply(
-        lambda x: getData(tickersTable, rows={'id': x}, column='ticker'))
-    df = df.append(watchlist_df).reset_index(drop=True)
-    print(f"\n==============\nOPTIONS WATCHLIST:\n{watchlist_df}\n==============")
-    info_df = pd.DataFrame([r.options.get_option_instrument_data_by_id(x) for x in df['option_id']])
-    df['exp_date'] = info_df['expiration_date']
-    df['strike_price'] = info_df['strike_price']
-    df['option_type'] = info_df['type']
-    df = df[['option_id', 'ticker', 'option_type', 'exp_date', 'strike_price',
-             'quantity', 'average_buy_price']]
-
-    market_data_df = pd.DataFrame()
-    for option_id in df['option_id'].to_list():
-        market_data_df = market_data_df.append(pd.DataFrame(r.options.get_option_market_data_by_id(option_id)),
-                                               ignore_index=True)
-    df = pd.concat([df, market_data_df], axis=1)
-    df = df.rename(columns={'previous_close_price': 'prev_close_price', 'adjusted_mark_price': 'latest_price'})
-
-    # convert type
-    numerical_cols = ['strike_price', 'quantity', 'average_buy_price', 'latest_price', 'prev_close_price',
-                      'break_even_price', 'ask_price', 'ask_size', 'bid_price', 'bid_size', 'high_price',
-                      'last_trade_price', 'last_trade_size', 'low_price', 'open_interest', 'volume',
-                      'chance_of_profit_long', 'chance_of_profit_short', 'delta', 'gamma',
-                      'implied_volatility', 'rho', 'theta', 'vega']
-    df[numerical_cols] = df[numerical_cols].apply(pd.to_numeric)
-
-    df['average_buy_price'] = df['average_buy_price'] / 100
-
-    df['datetime'] = datetime.now(tz=pytz.timezone('US/Eastern'))  #.replace(tzinfo=None)
-    df['exp_date'] = pd.to_datetime(df['exp_date']).dt.date
-    df['previous_close_date'] = pd.to_datetime(df['previous_close_date']).dt.date
-
-    df = df[['datetime', 'option_id', 'ticker', 'option_type', 'exp_date'] + numerical_cols + ['previous_close_date']]
-    # df = df[['option_id', 'ticker', 'option_type', 'exp_date'] + numerical_cols + ['previous_close_date']]
-    return df
 
+def migrateCompactEquities(tickers_list=None, db_name=DATABASE):
+    # copy the minute history into equities_compact one ticker at a time, rows already there are kept
+    if tickers_list is None:
+        tickers_list = list(set(getData(tickersTable, column='ticker', profile='ingest'))) + list(INDEXES.values())
+    ids = getTickerIds(tickers_list)
+    if ids is False:
+        return False
+    columns = ', '.join(c.name for c in equitiesCompactTable.__table__.columns)
+    source = ', '.join('i.ticker_id' if c.name == 'ticker_id' else f'e.{c.name}'
+                       for c in equitiesCompactTable.__table__.columns)
+    try:
+        dwhConnection = get_engine('ingest').connect()
+        for ticker in tickers_list:
+            start = time.time()
+            result = dwhConnection.execute(text(f"""INSERT INTO equities_compact ({columns})
+                SELECT {source} FROM equities e JOIN ticker_ids i ON i.ticker = e.ticker
+                WHERE e.ticker = :ticker ON CONFLICT DO NOTHING"""), ticker=ticker)
+            logging.debug(f'{result.rowcount} {ticker} rows migrated to {db_name} db equities_compact '
+                          f'in {time.time() - start:.2f}s')
+        # float4 keeps cents exact only below REAL_CENT_LIMIT
+        wide = dwhConnection.execute(text("""SELECT i.ticker, MAX(c.high) FROM equities_compact c
+            JOIN ticker_ids i ON i.ticker_id = c.ticker_id GROUP BY i.ticker HAVING MAX(c.high) >= :limit"""),
+                                     limit=REAL_CENT_LIMIT).fetchall()
+        dwhConnection.close()
+        if wide:
+            print(f"==============\nWARNING: float4 prices lose cents for {', '.join(t for t, _ in wide)}\n==============")
+        invalidate_results(equitiesCompactTable)
+        return True
+    except Exception as e:
+        print(f'==============\nException at migrateCompactEquities: {e}\n==============')
+        return False
 
-#### get portfolio summary data
 
-def get_portfolio_summary_data():
-    d = {}
-    d['datetime'] = datetime.now(tz=pytz.timezone('US/Eastern'))#.replace(tzinfo=None)
-    # d['datetime'] = pd.to_datetime(d['datetime'])
-    d['username'] = 'sheryl'
+#### storage report
+# on-disk bytes per row of the row and compact layouts, summed over partitions
+
+def storageReport(tables=None, sample_rows=10000):
+    if tables is None:
+        tables = [equitiesTable, equitiesCompactTable]
+    reports = []
+    for table in tables:
+        name = table.__tablename__
+        df = executeQuery(Query(f"""
+            SELECT SUM(pg_table_size(p.relid)) AS table_bytes, SUM(pg_indexes_size(p.relid)) AS index_bytes,
+                   SUM(GREATEST(c.reltuples, 0))::bigint AS est_rows,
+                   (SELECT AVG(pg_column_size(t.*)) FROM (SELECT * FROM {name} LIMIT %s) t) AS tuple_bytes
+            FROM pg_partition_tree(%s) p JOIN pg_class c ON c.oid = p.relid WHERE p.isleaf""",
+                                sample_rows, name), profile='analytics')
+        if df is False:
+            return False
+        row = df.iloc[0].to_dict()
+        rows = max(row['est_rows'] or 0, 1)
+        reports.append({'table': name, 'est_rows': row['est_rows'], 'tuple_bytes': row['tuple_bytes'],
+                        'table_bytes_per_row': (row['table_bytes'] or 0) / rows,
+                        'index_bytes_per_row': (row['index_bytes'] or 0) / rows,
+                        'total_bytes_per_row': ((row['table_bytes'] or 0) + (row['index_bytes'] or 0)) / rows})
+    return pd.DataFrame(reports).set_index('table')
+
+
+#### refresh bar tables
+# re-aggregate only the buckets touched by a batch of minute rows
+
+def bucket_expr(seconds, offset, timezone=MARKET_TIMEZONE):
+    if seconds is None:
+        return f"(date_trunc('day', datetime AT TIME ZONE '{timezone}') AT TIME ZONE '{timezone}')"
+    return f"to_timestamp(floor((extract(epoch FROM datetime) - {offset}) / {seconds}) * {seconds} + {offset})"
+
+
+def bucket_bounds(start, end, seconds, offset, timezone=MARKET_TIMEZONE):
+    # [first bucket start, last bucket end) covering start..end
+    start, end = pd.Timestamp(start), pd.Timestamp(end)
+    if seconds is None:
+        lo = start.tz_convert(timezone).normalize()
+        hi = end.tz_convert(timezone).normalize() + pd.Timedelta(days=1)
+        return lo.tz_convert('UTC'), hi.tz_convert('UTC')
+    size = pd.Timedelta(seconds=seconds)
+    shift = pd.Timedelta(seconds=offset)
+    lo = (start.tz_convert('UTC') - shift).floor(size) + shift
+    hi = (end.tz_convert('UTC') - shift).floor(size) + shift + size
+    return lo, hi
+
+
+def refreshBars(tickers, start, end, db_name=DATABASE):
+    value_cols = ['open', 'high', 'low', 'close', 'volume', 'dividends', 'stock_splits']
+    try:
+        dwhConnection = get_engine('ingest').connect()
+        with dwhConnection.begin():
+            for interval, (table, seconds, offset) in BARS_TABLES.items():
+                lo, hi = bucket_bounds(start, end, seconds, offset)
+                dwhConnection.execute(text(f"""
+                    INSERT INTO {table.__tablename__}
+                        (ticker, extended_hours, datetime, {', '.join(value_cols)})
+                    SELECT m.ticker, session.extended_hours, bucket,
+                        (array_agg(open ORDER BY datetime))[1], max(high), min(low),
+                        (array_agg(close ORDER BY datetime DESC))[1],
+                        sum(volume), sum(dividends), max(stock_splits)
+                    FROM (SELECT *, {bucket_expr(seconds, offset)} AS bucket, {market_hours_clause()} AS regular
+                          FROM equities
+                          WHERE ticker = ANY(:tickers) AND datetime >= :lo AND datetime < :hi) m
+                    LEFT JOIN bar_horizons hz ON hz.ticker = m.ticker AND hz.tier = 'minute'
+                    CROSS JOIN (VALUES (TRUE), (FALSE)) AS session(extended_hours)
+                    WHERE (session.extended_hours OR m.regular)
+                        -- buckets starting below the minute horizon lost their minutes, keep the stored bars
+                        AND (hz.horizon IS NULL OR bucket >= hz.horizon)
+                    GROUP BY m.ticker, session.extended_hours, bucket
+                    ON CONFLICT (ticker, extended_hours, datetime) DO UPDATE SET
+                        {', '.join(f'{c} = EXCLUDED.{c}' for c in value_cols)}"""),
+                    tickers=list(tickers), lo=lo.to_pydatetime(), hi=hi.to_pydatetime())
+        dwhConnection.close()
+        logging.debug(f'refreshed {db_name} db bar tables for {tickers} from {start} to {end}')
+        invalidate_horizons()
+        invalidate_results(*[t for t, _, _ in BARS_TABLES.values()])
+        return True
+    except Exception as e:
+        print(f'==============\nException at refreshBars: {e}\n==============')
+        return False
 
-    crypto_df = get_crypto_data()
-    d['crypto_equity'] = (crypto_df['latest_price'] * crypto_df['quantity']).sum()
-    d['crypto_equity_prev_close'] = (crypto_df['prev_close_price'] * crypto_df['quantity']).sum()
 
-    stock_portfolio = r.profiles.load_portfolio_profile()
+def backfillBars(tickers_list=None, db_name=DATABASE):
+    # rebuild every bucket from the full minute history, one ticker at a time
+    if tickers_list is None:
+        tickers_list = list(set(getData(tickersTable, column='ticker', profile='ingest'))) + list(INDEXES.values())
+    for ticker in tickers_list:
+        bounds = executeQuery(Query("""
+            SELECT MIN(datetime) AS datetime FROM equities WHERE ticker = %s
+            UNION ALL SELECT MAX(datetime) FROM equities WHERE ticker = %s""", ticker, ticker), prepared=True,
+            profile='ingest')
+        if bounds is False or bounds['datetime'].isnull().any():
+            continue
+        if not refreshBars([ticker], bounds['datetime'].iloc[0], bounds['datetime'].iloc[1], db_name):
+            return False
+    return True
 
-    equity_ext_hrs = stock_portfolio['extended_hours_equity']
-    equity = stock_portfolio['equity']
-    d['equity_latest'] = float(equity_ext_hrs if equity_ext_hrs else equity)
-    d['equity_prev_close'] = float(stock_portfolio['adjusted_equity_previous_close'])
 
-    #     d['equity_after_hrs_gain'] = d['equity_extended_hrs'] - float(stock_portfolio['equity'])
-    d['withdrawable_amount'] = float(stock_portfolio['withdrawable_amount'])
-    d['excess_margin'] = float(stock_portfolio['excess_margin'])
-    d['excess_maintenance'] = float(stock_portfolio['excess_maintenance'])
+#### downsample old minute history
+# minute rows older than minute_age are dropped once every bucket they feed is aggregated, and
+# 5m/30m/1h rows older than intraday_age once the daily bars hold them. cutoffs fall on US/Eastern
+# midnights so no daily bucket is split, and the horizons in bar_horizons stop refreshBars from
+# re-aggregating buckets whose minutes are gone
 
-    return pd.DataFrame(d, index=[0])
+MINUTE_BARS_AGE = pd.Timedelta(days=int(os.environ.get('RS_MINUTE_BARS_DAYS', 30)))
+INTRADAY_BARS_AGE = pd.Timedelta(days=int(os.environ.get('RS_INTRADAY_BARS_DAYS', 730)))
+INTRADAY_BARS_TABLES = [equities5mTable, equities30mTable, equities1hTable]
 
 
-#### insert portfolio data
-def insert_portfolio_data():
-    login()  # custom robinhood login function
+def set_horizon(dwhConnection, ticker, tier, horizon):
+    dwhConnection.execute(text("""INSERT INTO bar_horizons (ticker, tier, horizon) VALUES (:ticker, :tier, :horizon)
+        ON CONFLICT (ticker, tier) DO UPDATE SET horizon = GREATEST(bar_horizons.horizon, EXCLUDED.horizon)"""),
+                          ticker=ticker, tier=tier, horizon=horizon.to_pydatetime())
 
-    portfolio_df = get_portfolio_data()
-    status = insertData(portfolioTable, portfolio_df, DATABASE)
-    if not status:
-        print(f"==============\nTERMINATED: Exception at insert portfolio data\n==============")
-        return False
 
-    crypto_df = get_crypto_data()
-    status = insertData(cryptoTable, crypto_df, DATABASE)
-    if not status:
-        print(f"==============\nTERMINATED: Exception at insert crypto data\n==============")
+def compactBars(tickers_list=None, minute_age=MINUTE_BARS_AGE, intraday_age=INTRADAY_BARS_AGE, db_name=DATABASE):
+    if intraday_age <= minute_age:
+        print(f'==============\nException at compactBars: intraday_age must be longer than minute_age\n==============')
         return False
-
-    options_df = get_options_data()
-    status = insertData(optionsTable, options_df, DATABASE)
-    if not status:
-        print(f"==============\nTERMINATED: Exception at insert options data\n==============")
+    if tickers_list is None:
+        tickers_list = list(set(getData(tickersTable, column='ticker', profile='ingest'))) + list(INDEXES.values())
+    today = pd.Timestamp.now(tz=MARKET_TIMEZONE).normalize()
+    minute_cutoff = (today - minute_age).normalize().tz_convert('UTC')
+    intraday_cutoff = (today - intraday_age).normalize().tz_convert('UTC')
+    horizons = getHorizons(tickers_list, profile='ingest')
+    if horizons is False:
+        return False
+    try:
+        for ticker in tickers_list:
+            start = time.time()
+            current = horizons.get(ticker, {})
+            if 'minute' not in current or current['minute'] < minute_cutoff:
+                # aggregate everything about to lose its minutes, from the previous horizon on
+                since = current.get('minute', pd.Timestamp('1970-01-01', tz='UTC'))
+                if not refreshBars([ticker], since, minute_cutoff, db_name):
+                    return False
+            dwhConnection = get_engine('ingest').connect()
+            with dwhConnection.begin():
+                minutes = dwhConnection.execute(text("DELETE FROM equities WHERE ticker = :ticker AND datetime < :cutoff"),
+                                                ticker=ticker, cutoff=minute_cutoff.to_pydatetime()).rowcount
+                set_horizon(dwhConnection, ticker, 'minute', minute_cutoff)
+                bars = 0
+                for table in INTRADAY_BARS_TABLES:
+                    bars += dwhConnection.execute(text(f"""DELETE FROM {table.__tablename__}
+                        WHERE ticker = :ticker AND datetime < :cutoff"""),
+                                                  ticker=ticker, cutoff=intraday_cutoff.to_pydatetime()).rowcount
+                set_horizon(dwhConnection, ticker, 'intraday', intraday_cutoff)
+            dwhConnection.close()
+            logging.debug(f'{ticker}: {minutes} minute rows before {minute_cutoff} and {bars} intraday bar rows before '
+                          f'{intraday_cutoff} removed from {db_name} db in {time.time() - start:.2f}s')
+        invalidate_results(equitiesTable, barHorizonsTable, *INTRADAY_BARS_TABLES)
+        invalidate_horizons()
+        return True
+    except Exception as e:
+        print(f'==============\nException at compactBars: {e}\n==============')
         return False
 
-    summary_df = get_portfolio_summary_data()
-    status = insertData(portfolioSummaryTable, summary_df, DATABASE)
-    if not status:
-        print(f"==============\nTERMINATED: Exception at insert portfolio summary data\n==============")
+
+#### update Tickers data
+def deleteRow(table, row, value, db_name):
+    try:
+        dwhConnection = get_engine('ingest').connect()
+        pg_sql = text(f"""DELETE FROM {table.__tablename__}
+                    WHERE {row} = :value AND t_type='equity';""")
+
+        # print(pg_sql) # will give error 'The 'default' dialect with current database version settings does not support in-place multirow inserts.' bc print is not dialect aware
+        dwhConnection.execute(pg_sql, value=value)
+        logging.debug(f'{value} deleted from {db_name} db {table.__tablename__} table')
+        dwhConnection.close()
+        invalidate_results(table)
+        return True
+    except Exception as e:
+        print(f'==============\nException at deleteRow: {e}\n==============')
         return False
 
-    # status = insert_yf_data()
-    # if not status:
-    #     print(f"==============\nTERMINATED: Exception at insert yf data\n==============")
-    #     return False
 
-    return True
+##################
+# LAZY ATTRIBUTES
+##################
+
+#### names that moved out of rs_db
+# the yfinance and robinhood collectors live in their own modules so that importing the database
+# layer does not pull in yfinance / robin_stocks. old imports from rs_db keep working through
+# module __getattr__, which loads the owning module on first access
+
+# attribute access only (rs_db.insert_yf_data), `from rs_db import *` never calls __getattr__, modules
+# using these names import them from rs_yf / rs_portfolio / login directly
+MOVED_ATTRIBUTES = {'get_yf_data': 'robinhood_sheryl.rs_yf',
+                    'insert_yf_data': 'robinhood_sheryl.rs_yf',
+                    'login': 'robinhood_sheryl.login',
+                    'update_portfolio_tickers': 'robinhood_sheryl.rs_portfolio',
+                    'get_portfolio_data': 'robinhood_sheryl.rs_portfolio',
+                    'get_crypto_data': 'robinhood_sheryl.rs_portfolio',
+                    'get_options_data': 'robinhood_sheryl.rs_portfolio',
+                    'get_portfolio_summary_data': 'robinhood_sheryl.rs_portfolio',
+                    'insert_portfolio_data': 'robinhood_sheryl.rs_portfolio'}
+
+
+def __getattr__(name):
+    if name == 'conn':
+        return get_engine()
+    if name in MOVED_ATTRIBUTES:
+        return getattr(importlib.import_module(MOVED_ATTRIBUTES[name]), name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 ##################
@@ -745,10 +2258,11 @@ def insert_portfolio_data():
 ##################
 
 if __name__ == "__main__":
+    from robinhood_sheryl.login import login
+    from robinhood_sheryl.rs_yf import insert_yf_data
+
+    setup_logging()
     # initTables()
     login()  # location of robinhood login pickle file
     insert_yf_data()
     # insert_portfolio_data()
-
-# else:
-#     print("imported rs_db")
\ No newline at end of file
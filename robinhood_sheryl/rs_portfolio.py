@@ -0,0 +1,412 @@
+# database imports
+from robinhood_sheryl.rs_db import *
+from robinhood_sheryl.rs_yf import insert_yf_data
+
+# time imports
+from pandas.tseries.offsets import BDay  # Business day
+
+# robinhood imports
+import robin_stocks as r
+from robinhood_sheryl.login import login
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+##################
+# PORTFOLIO
+##################
+
+#### update portfolio tickers
+
+tickers_update_lock = threading.Lock()
+
+
+def update_portfolio_tickers(hold_ids, prev_hold_ids, t_type):
+    # the equity and option collectors run concurrently, their read-modify-write cycles on the
+    # tickers table take turns so neither upserts a frame read before the other's write
+    with tickers_update_lock:
+        return write_portfolio_tickers(hold_ids, prev_hold_ids, t_type)
+
+
+def write_portfolio_tickers(hold_ids, prev_hold_ids, t_type):
+    logging.debug(f're-loading tickers for portfolio')
+    # d = r.account.get_open_stock_positions()
+    # df = pd.DataFrame.from_dict(d)
+    ticker_map = getTickerMap()
+    if isinstance(ticker_map, pd.DataFrame):
+        current_tickers_df = ticker_map[ticker_map['t_type'] == t_type].copy()
+        current_tickers_df['hold'] = current_tickers_df['id'].isin(hold_ids)
+    else:
+        current_tickers_df = pd.DataFrame()
+
+    new_ids = np.setdiff1d(hold_ids, prev_hold_ids)
+    print(f"\n==============\nNEW IDS TO INSERT:\n{new_ids}\n==============")
+
+    tickers_df = get_instruments(list(new_ids), t_type)[['id', 'ticker', 'name']]
+    unresolved = tickers_df['ticker'].isna()
+    if unresolved.any():  # ticker is part of the tickers key, retried on the next cycle
+        print(f"\n==============\nSKIPPED: unresolved {t_type} ids {list(tickers_df.loc[unresolved, 'id'])}\n==============")
+        tickers_df = tickers_df[~unresolved].reset_index(drop=True)
+    if t_type != 'option' and not tickers_df.empty:
+        insert_yf_data(list(tickers_df['ticker']))
+
+    tickers_df['hold'] = True
+    tickers_df['t_type'] = t_type
+
+    tickers_df = pd.concat([tickers_df, current_tickers_df]).drop_duplicates().reset_index(drop=True)
+    print(f"\n==============\nTOTAL WATCHLIST:\n{tickers_df[tickers_df['hold'] == False]}\n==============")
+    status = updateData(tickersTable, tickers_df, DATABASE, ['ticker', 't_type', 'id'])
+
+    if not status:
+        print(f"\n==============\nTERMINATED: Exception at insert portfolio tickers\n==============")
+        return False
+
+    return tickers_df[['id', 'ticker', 'name']]
+
+
+#### tickers of the portfolio collectors
+
+def tickers_of_type(t_type):
+    # tickers table rows of one type, False when the table cannot be read
+    tickers = getTickerMap()
+    if not isinstance(tickers, pd.DataFrame):
+        print(f"\n==============\nException at tickers_of_type: cannot load {t_type} tickers\n==============")
+        return False
+    return tickers[tickers['t_type'] == t_type]
+
+
+#### get portfolio data
+
+def get_portfolio_data(now=None):
+    logging.debug(f'getting data for portfolio')
+    # get data
+    d = r.account.get_open_stock_positions()
+    df = pd.DataFrame.from_dict(d)
+    df['id'] = df['instrument'].apply(lambda x: x.split('/')[-2])
+    hold_ids = list(df['id'])
+
+    equities = tickers_of_type('equity')
+    if equities is False:
+        return False
+    prev_hold_ids = list(equities.loc[equities['hold'] == True, 'id'])
+    if sorted(hold_ids) != sorted(prev_hold_ids):
+        update_portfolio_tickers(hold_ids, prev_hold_ids, t_type='equity')
+        equities = tickers_of_type('equity')  # reloaded after the update
+        if equities is False:
+            return False
+
+    all_ids = list(equities['id'])
+    watchlist_df = pd.DataFrame(np.setdiff1d(all_ids, hold_ids), columns=['id'])
+    df = df.append(watchlist_df).reset_index(drop=True)
+    print(f"\n==============\nEQUITIES WATCHLIST:\n{watchlist_df}\n==============")
+    df['ticker'] = lookupTickers(df['id'])
+    if df['ticker'].isna().any():
+        print(f"\n==============\nSKIPPED: unknown equity ids {list(df.loc[df['ticker'].isna(), 'id'])}\n==============")
+        df = df[df['ticker'].notna()].reset_index(drop=True)
+    df['latest_price'] = r.stocks.get_latest_price(list(df['ticker']), priceType=None, includeExtendedHours=True)
+    df = df[['ticker', 'average_buy_price', 'quantity', 'latest_price']]
+
+    info_df = pd.DataFrame(r.stocks.get_quotes(list(df['ticker'])))
+    df = pd.concat([df, info_df], axis=1)
+    df['prev_close_price'] = df['adjusted_previous_close']
+    df['prev_close_unadjusted'] = df['previous_close']
+    if now is None:
+        df['datetime'] = pd.to_datetime(df['updated_at']).dt.tz_convert('US/Eastern')  #.dt.tz_localize(None)
+    else:  # snapshot time shared with the other tables of the cycle
+        df['datetime'] = now
+    df['previous_close_date'] = pd.to_datetime(df['previous_close_date']).dt.date
+
+    # convert type
+    numerical_cols = ['average_buy_price', 'quantity', 'prev_close_price', 'prev_close_unadjusted',
+                      'ask_price', 'ask_size', 'bid_price', 'bid_size', 'latest_price', 'last_trade_price',
+                      'last_extended_hours_trade_price']
+    df[numerical_cols] = df[numerical_cols].apply(pd.to_numeric)
+
+    df = df[['datetime', 'ticker'] + numerical_cols + ['previous_close_date']]
+    # df = df[['ticker'] + numerical_cols + ['previous_close_date']]
+
+    # insert one row at a time to prevent sqlite database malformed error
+    # for row in df.to_dict('records'):
+    #     dbms.write_row('portfolio',row)
+    # logging.debug(f'written to {DATABASE} db')
+
+    return df
+
+
+#### get crypto data
+
+def get_crypto_data(now=None):
+    def get_yesterday_midnight_price(ticker):
+        df = pd.DataFrame(
+            r.crypto.get_crypto_historicals(
+                ticker, interval='5minute', span='week'))
+        df['datetime'] = pd.to_datetime(df['begins_at']).dt.tz_convert('US/Eastern').dt.tz_localize(None)
+        df = df.set_index('datetime')['close_price'].resample('D').last()
+        yesterday = (datetime.today() - BDay(1)).strftime('%Y-%m-%d')
+        return df.loc[yesterday]
+
+    df = pd.DataFrame()
+    crypto_df = pd.DataFrame(r.crypto.get_crypto_positions())
+    df['id'] = crypto_df['currency'].apply(lambda x: x['id'])
+    df['datetime'] = now or datetime.now(tz=pytz.timezone('US/Eastern'))#.replace(tzinfo=None)
+    df['name'] = crypto_df['currency'].apply(lambda x: x['name'])
+    df['ticker'] = crypto_df['currency'].apply(lambda x: x['code'])
+    df['average_buy_price'] = crypto_df['cost_bases'].apply(lambda x: x[0]['direct_cost_basis'])
+    df['quantity'] = crypto_df['quantity']
+    df['prev_close_price'] = df['ticker'].apply(lambda x: get_yesterday_midnight_price(x))
+    df['latest_price'] = df['ticker'].apply(lambda x: r.crypto.get_crypto_quote(x, info='mark_price'))
+
+    # convert type
+    numerical_cols = ['average_buy_price', 'quantity', 'prev_close_price', 'latest_price']
+    df[numerical_cols] = df[numerical_cols].apply(pd.to_numeric)
+    df['average_buy_price'] = df['average_buy_price'] / df['quantity']
+
+    df = df[['datetime', 'name', 'ticker', 'average_buy_price', 'quantity', 'prev_close_price', 'latest_price']]
+    # df = df[['name', 'ticker', 'average_buy_price', 'quantity', 'prev_close_price', 'latest_price']]
+
+    return df
+
+
+#### batched option requests
+# the instruments and market data endpoints take many ids per request, ids missing from the batch
+# answers are requested one by one, concurrently. results come back as one frame in the order of the ids
+
+OPTION_INSTRUMENTS_URL = 'https://api.robinhood.com/options/instruments/'
+OPTION_MARKETDATA_URL = 'https://api.robinhood.com/marketdata/options/'
+RH_BATCH_SIZE = 50  # ids per request, keeps the instrument url lists well under url length limits
+RH_WORKERS = 8
+
+
+def request_batched(ids, batch_request, single_request, key):
+    # batch_request(ids) -> list of records, single_request(id) -> record, key(record) -> id
+    def batch_or_empty(chunk):
+        try:
+            return batch_request(chunk) or []
+        except Exception as e:
+            print(f'==============\nException at request_batched: {e}\n==============')
+            return []
+
+    def single_or_none(x):
+        try:
+            return single_request(x)
+        except Exception as e:
+            print(f'==============\nException at request_batched: {x}: {e}\n==============')
+            return None
+
+    unique = list(dict.fromkeys(ids))
+    records = {}
+    with ThreadPoolExecutor(max_workers=RH_WORKERS) as executor:
+        chunks = [unique[i:i + RH_BATCH_SIZE] for i in range(0, len(unique), RH_BATCH_SIZE)]
+        for batch in executor.map(batch_or_empty, chunks):
+            records.update((key(record), record) for record in batch if record)
+        missing = [x for x in unique if x not in records]
+        for x, record in zip(missing, executor.map(single_or_none, missing)):
+            if record:
+                records[x] = record
+    return pd.DataFrame([records.get(x, {}) for x in ids])
+
+
+def get_option_instruments(ids):
+    return request_batched(
+        ids,
+        lambda chunk: r.helper.request_get(OPTION_INSTRUMENTS_URL, 'pagination', {'ids': ','.join(chunk)}),
+        lambda x: r.options.get_option_instrument_data_by_id(x),
+        lambda record: record['id'])
+
+
+def get_option_market_data(ids):
+    return request_batched(
+        ids,
+        lambda chunk: r.helper.request_get(OPTION_MARKETDATA_URL, 'results', {
+            'instruments': ','.join(f'{OPTION_INSTRUMENTS_URL}{x}/' for x in chunk)}),
+        lambda x: (r.options.get_option_market_data_by_id(x) or [None])[0],
+        lambda record: record.get('instrument_id') or record['instrument'].split('/')[-2])
+
+
+#### instrument metadata
+# symbols, names and option contract terms never change, they are read from the instruments table
+# and only ids missing from it are requested (in bulk) and stored
+
+STOCK_INSTRUMENTS_URL = 'https://api.robinhood.com/instruments/'
+
+
+def fetch_instruments(ids, t_type):
+    def field(df, name):  # batch answers can lack a field entirely when every lookup failed
+        return df[name] if name in df.columns else pd.Series(None, index=df.index, dtype=object)
+
+    if t_type == 'option':
+        df = get_option_instruments(ids)
+        df = pd.DataFrame({'id': ids, 'ticker': field(df, 'chain_symbol'), 'option_type': field(df, 'type'),
+                           'strike_price': pd.to_numeric(field(df, 'strike_price')),
+                           'exp_date': pd.to_datetime(field(df, 'expiration_date')).dt.date})
+        # contracts are named after their underlying
+        symbols = list(df['ticker'].dropna().unique())
+        with ThreadPoolExecutor(max_workers=RH_WORKERS) as executor:
+            names = dict(zip(symbols, executor.map(r.stocks.get_name_by_symbol, symbols)))
+        df['name'] = df['ticker'].map(names)
+    else:
+        df = request_batched(
+            ids,
+            lambda chunk: r.helper.request_get(STOCK_INSTRUMENTS_URL, 'pagination', {'ids': ','.join(chunk)}),
+            lambda x: r.stocks.get_instrument_by_url(f'{STOCK_INSTRUMENTS_URL}{x}/'),
+            lambda record: record['id'])
+        # same choice as get_name_by_symbol, the simple name unless it is empty
+        names = field(df, 'simple_name')
+        names = names.where(names.notna() & (names != ''), field(df, 'name'))
+        df = pd.DataFrame({'id': ids, 'ticker': field(df, 'symbol'), 'name': names})
+    df['t_type'] = t_type
+    return df[df['ticker'].notna()]  # failed lookups are retried on the next cycle
+
+
+def get_instruments(ids, t_type):
+    # one row per id in the order of ids, NaN fields for ids that could not be resolved
+    cached = getInstruments(ids)
+    if cached is False:
+        cached = pd.DataFrame(columns=['id'])
+    missing = [x for x in dict.fromkeys(ids) if x not in set(cached['id'])]
+    if missing:
+        fetched = fetch_instruments(missing, t_type)
+        print(f"\n==============\nINSTRUMENTS: {len(fetched)} of {len(missing)} new {t_type} ids resolved\n==============")
+        if not fetched.empty:
+            updateData(instrumentsTable, fetched, DATABASE, ['id'])
+            cached = pd.concat([cached, fetched], ignore_index=True)
+    columns = [c.name for c in instrumentsTable.__table__.columns]
+    cached = cached.reindex(columns=columns).drop_duplicates(subset=['id'])
+    return pd.DataFrame({'id': ids}).merge(cached, on='id', how='left')
+
+
+#### get options data
+
+def get_options_data(now=None):
+    # get data
+    d = r.options.get_open_option_positions()
+    df = pd.DataFrame.from_dict(d)
+    df['option_id'] = df['option'].apply(lambda x: x.split('/')[-2])
+    df = df.rename(columns={'chain_symbol': 'ticker', 'average_price': 'average_buy_price'})
+
+    hold_ids = list(df['option_id'])
+
+    options = tickers_of_type('option')
+    if options is False:
+        return False
+    prev_hold_ids = list(options.loc[options['hold'] == True, 'id'])
+    if sorted(hold_ids) != sorted(prev_hold_ids):
+        update_portfolio_tickers(hold_ids, prev_hold_ids, 'option')
+        options = tickers_of_type('option')  # reloaded after the update
+        if options is False:
+            return False
+
+    all_ids = list(options['id'])
+    watchlist_df = pd.DataFrame(np.setdiff1d(all_ids, hold_ids), columns=['option_id'])
+    watchlist_df['ticker'] = lookupTickers(watchlist_df['option_id'])
+    if watchlist_df['ticker'].isna().any():
+        print(f"\n==============\nSKIPPED: unknown option ids {list(watchlist_df.loc[watchlist_df['ticker'].isna(), 'option_id'])}\n==============")
+        watchlist_df = watchlist_df[watchlist_df['ticker'].notna()]
+    df = df.append(watchlist_df).reset_index(drop=True)
+    print(f"\n==============\nOPTIONS WATCHLIST:\n{watchlist_df}\n==============")
+    info_df = get_instruments(list(df['option_id']), 'option')
+    df['exp_date'] = info_df['exp_date']
+    df['strike_price'] = info_df['strike_price']
+    df['option_type'] = info_df['option_type']
+    df = df[['option_id', 'ticker', 'option_type', 'exp_date', 'strike_price',
+             'quantity', 'average_buy_price']]
+
+    market_data_df = get_option_market_data(df['option_id'].to_list())
+    df = pd.concat([df, market_data_df], axis=1)
+    df = df.rename(columns={'previous_close_price': 'prev_close_price', 'adjusted_mark_price': 'latest_price'})
+
+    # convert type
+    numerical_cols = ['strike_price', 'quantity', 'average_buy_price', 'latest_price', 'prev_close_price',
+                      'break_even_price', 'ask_price', 'ask_size', 'bid_price', 'bid_size', 'high_price',
+                      'last_trade_price', 'last_trade_size', 'low_price', 'open_interest', 'volume',
+                      'chance_of_profit_long', 'chance_of_profit_short', 'delta', 'gamma',
+                      'implied_volatility', 'rho', 'theta', 'vega']
+    df[numerical_cols] = df[numerical_cols].apply(pd.to_numeric)
+
+    df['average_buy_price'] = df['average_buy_price'] / 100
+
+    df['datetime'] = now or datetime.now(tz=pytz.timezone('US/Eastern'))  #.replace(tzinfo=None)
+    df['exp_date'] = pd.to_datetime(df['exp_date']).dt.date
+    df['previous_close_date'] = pd.to_datetime(df['previous_close_date']).dt.date
+
+    df = df[['datetime', 'option_id', 'ticker', 'option_type', 'exp_date'] + numerical_cols + ['previous_close_date']]
+    # df = df[['option_id', 'ticker', 'option_type', 'exp_date'] + numerical_cols + ['previous_close_date']]
+    return df
+
+
+#### get portfolio summary data
+
+def get_portfolio_summary_data(crypto_df=None, stock_portfolio=None, now=None):
+    # the snapshot collector passes the crypto frame and portfolio profile it already fetched
+    d = {}
+    d['datetime'] = now or datetime.now(tz=pytz.timezone('US/Eastern'))#.replace(tzinfo=None)
+    # d['datetime'] = pd.to_datetime(d['datetime'])
+    d['username'] = 'sheryl'
+
+    if crypto_df is None:
+        crypto_df = get_crypto_data()
+    d['crypto_equity'] = (crypto_df['latest_price'] * crypto_df['quantity']).sum()
+    d['crypto_equity_prev_close'] = (crypto_df['prev_close_price'] * crypto_df['quantity']).sum()
+
+    if stock_portfolio is None:
+        stock_portfolio = r.profiles.load_portfolio_profile()
+
+    equity_ext_hrs = stock_portfolio['extended_hours_equity']
+    equity = stock_portfolio['equity']
+    d['equity_latest'] = float(equity_ext_hrs if equity_ext_hrs else equity)
+    d['equity_prev_close'] = float(stock_portfolio['adjusted_equity_previous_close'])
+
+    #     d['equity_after_hrs_gain'] = d['equity_extended_hrs'] - float(stock_portfolio['equity'])
+    d['withdrawable_amount'] = float(stock_portfolio['withdrawable_amount'])
+    d['excess_margin'] = float(stock_portfolio['excess_margin'])
+    d['excess_maintenance'] = float(stock_portfolio['excess_maintenance'])
+
+    return pd.DataFrame(d, index=[0])
+
+
+#### insert portfolio data
+# every source is fetched once, concurrently, the summary is derived from the crypto frame and the
+# profile, and the four tables are committed in one transaction under one snapshot timestamp
+
+def insert_portfolio_data():
+    login()  # custom robinhood login function
+    if getTickerMap(refresh=True) is False:  # one tickers table read for the whole cycle
+        print(f"==============\nTERMINATED: Exception at loading tickers\n==============")
+        return False
+    if not ensureCurrentTables(DATABASE):  # the dashboard reads history until they are built
+        print(f"==============\nWARNING: Exception at ensureCurrentTables, latest snapshots read from history\n==============")
+
+    now = datetime.now(tz=pytz.timezone('US/Eastern')).replace(microsecond=0)
+    sources = {'portfolio': (get_portfolio_data, now), 'crypto': (get_crypto_data, now),
+               'options': (get_options_data, now), 'profile': (r.profiles.load_portfolio_profile,)}
+    frames = {}
+    with ThreadPoolExecutor(max_workers=len(sources)) as executor:
+        futures = {name: executor.submit(*source) for name, source in sources.items()}
+        for name, future in futures.items():
+            try:
+                frames[name] = future.result()
+            except Exception as e:
+                print(f"==============\nTERMINATED: Exception at get {name} data: {e}\n==============")
+                return False
+            if frames[name] is False:
+                print(f"==============\nTERMINATED: Exception at get {name} data\n==============")
+                return False
+    summary_df = get_portfolio_summary_data(frames['crypto'], frames['profile'], now)
+
+    status = insertSnapshot([(portfolioTable, frames['portfolio']), (cryptoTable, frames['crypto']),
+                             (optionsTable, frames['options']), (portfolioSummaryTable, summary_df)], DATABASE)
+    if not status:
+        print(f"==============\nTERMINATED: Exception at insert portfolio snapshot\n==============")
+        return False
+
+    # status = insert_yf_data()
+    # if not status:
+    #     print(f"==============\nTERMINATED: Exception at insert yf data\n==============")
+    #     return False
+
+    return True
+
+
+if __name__ == "__main__":
+    setup_logging()
+    insert_portfolio_data()
@@ -0,0 +1,60 @@
+import re
+import math
+from datetime import date, datetime
+
+import numpy as np
+import pandas as pd
+
+#### query builder
+# sql is written with %s placeholders and the values are kept apart as bound parameters.
+# the same query renders as $n placeholders for PREPARE / asyncpg, or with quoted literals for
+# COPY (query) TO STDOUT, which cannot take parameters
+
+PLACEHOLDER = re.compile(r'%%|%s')
+
+
+def quote_literal(value):
+    if isinstance(value, np.generic):
+        value = value.item()
+    if value is None or value is pd.NaT:
+        return 'NULL'
+    if isinstance(value, bool):
+        return 'TRUE' if value else 'FALSE'
+    if isinstance(value, (int, float)):
+        return f"'{value}'::float8" if isinstance(value, float) and not math.isfinite(value) else repr(value)
+    if isinstance(value, (datetime, date, pd.Timestamp)):
+        return f"'{value.isoformat()}'"
+    if isinstance(value, (list, tuple)):
+        return f"ARRAY[{', '.join(quote_literal(v) for v in value)}]"
+    return "'" + str(value).replace("'", "''") + "'"
+
+
+class Query:
+    def __init__(self, sql='', *params):
+        self.parts = [sql]
+        self.params = list(params)
+
+    def add(self, sql, *params):
+        self.parts.append(sql)
+        self.params.extend(params)
+        return self
+
+    @property
+    def sql(self):
+        return ' '.join(self.parts)
+
+    def numbered(self):
+        # %s -> $1, $2 ... and %% -> %
+        counter = iter(range(1, len(self.params) + 1))
+        return PLACEHOLDER.sub(lambda m: '%' if m.group() == '%%' else f'${next(counter)}', self.sql)
+
+    def literal(self):
+        values = iter(self.params)
+        return PLACEHOLDER.sub(lambda m: '%' if m.group() == '%%' else quote_literal(next(values)), self.sql)
+
+    def normalized(self):
+        # whitespace-insensitive text of the query shape
+        return ' '.join(self.sql.split())
+
+    def __repr__(self):
+        return f'Query({self.normalized()!r}, params={self.params!r})'
@@ -0,0 +1,98 @@
+import os
+import time
+import threading
+from collections import OrderedDict
+
+#### process local query result cache
+# LRU + TTL cache of query results (DataFrames) keyed by the normalized query text and its params.
+# every entry is tagged with the tables its query reads, writes drop the entries of the tables they
+# touch. results are copied in and out so callers can keep mutating the frames they get back
+
+RESULT_CACHE_TTL = float(os.environ.get('RS_RESULT_CACHE_TTL', 10))  # seconds
+RESULT_CACHE_MAX_ENTRIES = 512
+RESULT_CACHE_MAX_BYTES = int(float(os.environ.get('RS_RESULT_CACHE_MB', 128)) * 1024 * 1024)
+
+
+class ResultCache:
+    def __init__(self, ttl=RESULT_CACHE_TTL, max_entries=RESULT_CACHE_MAX_ENTRIES, max_bytes=RESULT_CACHE_MAX_BYTES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # key: (expires_at, frame, nbytes, tables)
+        self.tags = {}  # table: set of keys
+        self.generations = {}  # table: number of invalidations, guards against caching a read that raced a write
+        self.nbytes = 0
+        self.counters = {'hits': 0, 'misses': 0, 'evictions': 0, 'expirations': 0, 'invalidations': 0}
+        self.lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.ttl > 0 and self.max_bytes > 0
+
+    def drop(self, key):
+        expires_at, df, nbytes, tables = self.entries.pop(key)
+        self.nbytes -= nbytes
+        for table in tables:
+            keys = self.tags.get(table)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.tags[table]
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.counters['misses'] += 1
+                return None
+            if entry[0] < time.monotonic():
+                self.drop(key)
+                self.counters['expirations'] += 1
+                self.counters['misses'] += 1
+                return None
+            self.entries.move_to_end(key)
+            self.counters['hits'] += 1
+            df = entry[1]
+        return df.copy()
+
+    def generation(self, tables):
+        with self.lock:
+            return tuple(self.generations.get(t, 0) for t in tables)
+
+    def put(self, key, df, tables, generation=None):
+        nbytes = int(df.memory_usage(deep=True, index=True).sum())
+        if nbytes > self.max_bytes // 4:  # one large history read would flush everything else
+            return
+        df = df.copy()
+        with self.lock:
+            if generation is not None and generation != tuple(self.generations.get(t, 0) for t in tables):
+                return  # a table was written while the query ran
+            if key in self.entries:
+                self.drop(key)
+            self.entries[key] = (time.monotonic() + self.ttl, df, nbytes, tables)
+            self.nbytes += nbytes
+            for table in tables:
+                self.tags.setdefault(table, set()).add(key)
+            while self.entries and (self.nbytes > self.max_bytes or len(self.entries) > self.max_entries):
+                self.drop(next(iter(self.entries)))
+                self.counters['evictions'] += 1
+
+    def invalidate(self, *tables):
+        with self.lock:
+            for table in tables:
+                self.generations[table] = self.generations.get(table, 0) + 1
+                for key in list(self.tags.get(table, ())):
+                    self.drop(key)
+                    self.counters['invalidations'] += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.tags.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        with self.lock:
+            lookups = self.counters['hits'] + self.counters['misses']
+            return dict(self.counters, entries=len(self.entries), bytes=self.nbytes,
+                        hit_rate=self.counters['hits'] / lookups if lookups else 0.0)
@@ -0,0 +1,94 @@
+import os
+import json
+import time
+import threading
+
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    import pyarrow.feather as feather
+    HAS_PYARROW = True
+except ImportError:
+    HAS_PYARROW = False
+
+#### local write spool
+# append-only directory of batches the database could not take. every batch is one segment file
+# (arrow ipc / feather, pickle without pyarrow) written to a temp name and renamed into place, so a
+# crash never leaves half a segment. segment names start with a sequence number, replaying them in
+# name order replays the writes in the order they were made
+
+SPOOL_DIR = os.environ.get('RS_SPOOL_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'robinhood_sheryl', 'spool'))
+SEGMENT_EXTENSIONS = ('.arrow', '.pkl')
+
+
+class WriteSpool:
+    def __init__(self, directory=SPOOL_DIR):
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.counter = 0
+        self.metrics = {'spooled_batches': 0, 'spooled_rows': 0, 'replayed_batches': 0, 'replayed_rows': 0,
+                        'replay_seconds': 0.0, 'replay_failures': 0, 'last_replay_rows_per_sec': 0.0}
+
+    def segments(self):
+        if not os.path.isdir(self.directory):
+            return []
+        return sorted(f for f in os.listdir(self.directory) if f.endswith(SEGMENT_EXTENSIONS))
+
+    def pending(self):
+        return len(self.segments()) > 0
+
+    def append(self, df, meta):
+        # meta: table, conflict, index_elements, db_name of the write being parked
+        os.makedirs(self.directory, exist_ok=True)
+        meta = dict(meta, rows=len(df), spooled_at=time.time())
+        with self.lock:
+            self.counter += 1
+            name = f'{time.time_ns():020d}_{os.getpid()}_{self.counter:06d}_{meta["table"]}'
+        df = df.reset_index(drop=True)
+        if HAS_PYARROW:
+            path = os.path.join(self.directory, name + '.arrow')
+            table = pa.Table.from_pandas(df, preserve_index=False)
+            table = table.replace_schema_metadata(dict(table.schema.metadata or {}, rs_spool=json.dumps(meta)))
+            feather.write_feather(table, path + '.tmp')
+        else:
+            path = os.path.join(self.directory, name + '.pkl')
+            df.attrs['rs_spool'] = meta
+            df.to_pickle(path + '.tmp')
+        with open(path + '.tmp', 'rb') as f:
+            os.fsync(f.fileno())
+        os.replace(path + '.tmp', path)
+        self.metrics['spooled_batches'] += 1
+        self.metrics['spooled_rows'] += len(df)
+        return path
+
+    def read(self, segment):
+        path = os.path.join(self.directory, segment)
+        if segment.endswith('.arrow'):
+            table = feather.read_table(path)
+            return table.to_pandas(), json.loads(table.schema.metadata[b'rs_spool'])
+        df = pd.read_pickle(path)
+        return df, df.attrs.pop('rs_spool')
+
+    def remove(self, segments):
+        for segment in segments:
+            os.remove(os.path.join(self.directory, segment))
+
+    def record_replay(self, batches, rows, seconds, failed=False):
+        self.metrics['replayed_batches'] += batches
+        self.metrics['replayed_rows'] += rows
+        self.metrics['replay_seconds'] += seconds
+        if failed:
+            self.metrics['replay_failures'] += 1
+        elif rows:
+            self.metrics['last_replay_rows_per_sec'] = rows / max(seconds, 1e-6)
+
+    def depth(self):
+        segments = self.segments()
+        size = sum(os.path.getsize(os.path.join(self.directory, s)) for s in segments)
+        oldest = int(segments[0][:20]) / 1e9 if segments else None
+        return {'segments': len(segments), 'bytes': size,
+                'oldest_age_seconds': time.time() - oldest if oldest else 0.0}
+
+    def stats(self):
+        return dict(self.metrics, **self.depth())
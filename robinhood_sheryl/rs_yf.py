@@ -0,0 +1,426 @@
+# database imports
+from robinhood_sheryl.rs_db import *
+
+# yfinance imports
+import yfinance as yf
+import requests
+
+import queue
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+##################
+# YFINANCE
+##################
+
+#### get yfinance data and read tickers
+
+def get_yf_data(ticker, start_date):
+    return split_yf_data(ticker, download_yf_data(ticker, start_date))
+
+
+def download_yf_data(ticker, start_date):
+    stock = yf.Ticker(ticker)
+    # df = stock.history(period='ytd', prepost=True)
+    if start_date:
+        return stock.history(interval="1m", start=start_date, prepost=True)
+    else:  # catchup
+        return stock.history(interval='1m', period='5d', prepost=True)
+
+
+def split_yf_data(ticker, df):
+    df = df[:-1]  # drop duplicate data with non 0 seconds
+    # logging.debug(f'getting data for {ticker}')
+    if df.empty:
+        logging.debug(f'{ticker}: No data found for this date range, symbol may be delisted')
+        return df
+    return format_yf_frame(ticker, df)
+
+
+def format_yf_frame(ticker, df):
+    df = df.reset_index()
+    df.insert(1, 'ticker', ticker)
+    logging.debug(f"columns for {ticker} are: {','.join(df.columns)}")
+    df.columns = ['datetime', 'ticker', 'open', 'high', 'low', 'close', 'volume', 'dividends', 'stock_splits']
+    if df['datetime'].dt.tz is None:  # older yfinance batch downloads come back in naive exchange time
+        df['datetime'] = df['datetime'].dt.tz_localize(YF_TIMEZONES.get(ticker, 'US/Eastern'))
+    df['datetime'] = df['datetime'].dt.tz_convert('US/Eastern').dt.tz_convert('UTC')
+    # df['datetime'] = df['datetime'].dt.tz_localize(None)
+    return df
+
+
+#### batch download
+# one multi symbol request for a group of tickers, split back into the per ticker long format.
+# the wide frame has a row for every minute any symbol traded, a symbol's empty minutes are all NaN
+# and are dropped (dividend rows keep their NaN prices, like in the single symbol history). a symbol
+# that failed inside the batch comes back as all NaN columns and is retried on its own
+
+YF_FIELDS = ['Open', 'High', 'Low', 'Close', 'Volume', 'Dividends', 'Stock Splits']
+YF_TIMEZONES = {INDEXES['FTSE']: 'Europe/London', INDEXES['Nikkei']: 'Asia/Tokyo'}  # exchange time of non US symbols
+
+
+def get_yf_batch(tickers, start_date):
+    return split_yf_batch(tickers, download_yf_batch(tickers, start_date))
+
+
+def download_yf_batch(tickers, start_date):
+    kwargs = dict(start=start_date) if start_date else dict(period='5d')
+    return yf.download(tickers, interval='1m', prepost=True, actions=True, auto_adjust=True,
+                       group_by='ticker', threads=False, progress=False, ignore_tz=False, **kwargs)
+
+
+def split_yf_batch(tickers, wide):
+    # returns {ticker: frame}, tickers missing from the response, all NaN or failing to split are left out
+    # for a single symbol retry, an empty frame means no data like in get_yf_data
+    if wide.empty:  # nothing traded in the range (weekend, holiday)
+        return {ticker: pd.DataFrame() for ticker in tickers}
+    frames = {}
+    for ticker in tickers:
+        if ticker not in wide.columns.get_level_values(0):
+            continue
+        try:
+            df = wide[ticker].reindex(columns=YF_FIELDS)
+            if df.isna().all().all():  # failed inside the batch, or nothing in the range, the single request tells
+                continue
+            df = df[df[['Open', 'High', 'Low', 'Close']].notna().any(axis=1) | (df['Dividends'].fillna(0) != 0)][:-1]
+            # [:-1] drops duplicate data with non 0 seconds, like get_yf_data
+            frames[ticker] = format_yf_frame(ticker, df) if not df.empty else pd.DataFrame()
+        except Exception as e:
+            logging.debug(f'{ticker}: could not split batch frame ({e}), fetching on its own')
+    return frames
+
+
+#### concurrent fetch
+# history requests are network bound, a worker pool overlaps them and a token bucket keeps the
+# request rate under what yahoo tolerates. requests failing on the network are retried with exponential
+# backoff, only the download is retried, a frame that does not parse fails the same way every time
+
+FETCH_WORKERS = int(os.environ.get('RS_YF_WORKERS', 8))
+FETCH_RATE = float(os.environ.get('RS_YF_RATE', 5))  # requests per second, also the burst size
+FETCH_RETRIES = 3
+FETCH_BACKOFF = 1.0  # seconds, doubled on every retry
+BATCH_SIZE = int(os.environ.get('RS_YF_BATCH', 50))  # symbols per batch download, 0 or 1 fetches one by one
+BATCH_WINDOW = OVERLAP_WINDOW - timedelta(minutes=10)  # watermarks this close share a request starting at the
+# oldest one, the overlap window (rs_db) covers it plus the 5 minute refetch margin
+RETRY_ERRORS = (requests.exceptions.RequestException, OSError)  # connection, timeout and http errors
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+def retry_request(label, request, limiter, retries=FETCH_RETRIES, backoff=FETCH_BACKOFF):
+    for attempt in range(retries + 1):
+        limiter.acquire()
+        try:
+            return request()
+        except RETRY_ERRORS as e:
+            if attempt == retries:
+                print(f'==============\nException at retry_request: {label} failed after {retries + 1} attempts: {e}\n==============')
+                return None
+            delay = backoff * 2 ** attempt * (1 + random.random())  # jitter spreads the retries of a throttled batch
+            logging.debug(f'{label}: fetch failed ({e}), retrying in {delay:.1f}s')
+            time.sleep(delay)
+        except Exception as e:
+            print(f'==============\nException at retry_request: {label}: {e}\n==============')
+            return None
+
+
+def fetch_yf_data(ticker, start_date, limiter):
+    df = retry_request(ticker, lambda: download_yf_data(ticker, start_date), limiter)
+    if df is None:
+        return {ticker: None}
+    try:
+        return {ticker: split_yf_data(ticker, df)}
+    except Exception as e:
+        print(f'==============\nException at fetch_yf_data: {ticker}: {e}\n==============')
+        return {ticker: None}
+
+
+def fetch_yf_batch(tickers, start_date, limiter):
+    wide = retry_request(f'batch of {len(tickers)}', lambda: download_yf_batch(tickers, start_date), limiter)
+    return split_yf_batch(tickers, wide) if wide is not None else {}
+
+
+def group_by_watermark(starts, batch_size=BATCH_SIZE, window=BATCH_WINDOW):
+    # starts: {ticker: start_date or '' for a 5d catchup}, returns [(start_date, tickers)]
+    groups = []
+    catchup = [t for t, start in starts.items() if not start]
+    for i in range(0, len(catchup), max(batch_size, 1)):
+        groups.append(('', catchup[i:i + max(batch_size, 1)]))
+    dated = sorted((start, t) for t, start in starts.items() if start)
+    for start, ticker in dated:
+        if groups and groups[-1][0] and start - groups[-1][0] <= window and len(groups[-1][1]) < batch_size:
+            groups[-1][1].append(ticker)
+        else:
+            groups.append((start, [ticker]))
+    return groups
+
+
+#### ingestion pipeline
+# fetch -> transform -> write, connected by bounded queues so network fetches overlap database
+# writes and a slow database pushes back on the fetchers. the single writer coalesces the frames of
+# several tickers into one copy per table and one bar refresh, a ticker's dividend upsert is
+# always written before its minutes. writes that hit an unreachable database land in the local
+# write spool (rs_db.spoolWrite), the run keeps going and the spool is drained at the start of the next one
+
+SPOOL_LOOKBACK = timedelta(days=1)  # fetch window per ticker when the watermarks cannot be read
+PIPELINE_QUEUE_SIZE = 32  # frames buffered between two stages
+WRITE_BATCH_ROWS = 50000  # rows coalesced into one write
+WRITE_LINGER = 0.5  # seconds the writer waits for more frames before writing a partial batch
+PIPELINE_STATS = {}  # stage: counters of the last run
+VALUE_COLUMNS = ['open', 'high', 'low', 'close', 'volume', 'dividends', 'stock_splits']
+
+
+def new_stage_stats():
+    # max_depth is the deepest the queue the stage feeds got
+    return {'items': 0, 'rows': 0, 'batches': 0, 'seconds': 0.0, 'max_depth': 0}
+
+
+def put_item(q, item, stats):
+    q.put(item)
+    stats['max_depth'] = max(stats['max_depth'], q.qsize())
+
+
+def pipelineStats():
+    # rows/sec counts the time a stage spent working, not waiting on its queue
+    return {stage: dict(s, rows_per_sec=s['rows'] / s['seconds'] if s['seconds'] else 0.0)
+            for stage, s in PIPELINE_STATS.items()}
+
+
+def trim_overlap(df, stored):
+    # split the refetched rows against the stored rows of the overlap window: rows matching a stored
+    # bar are dropped, revised bars are returned separately for an upsert, the rest is new
+    if stored is None or stored.empty:
+        return df, df.iloc[0:0]
+    stored = stored[['datetime'] + VALUE_COLUMNS].astype({'datetime': df['datetime'].dtype})
+    merged = df.merge(stored, on='datetime', how='left', suffixes=('', '_stored'), indicator=True)
+    is_stored = (merged['_merge'] == 'both').to_numpy()
+    same = np.ones(len(merged), dtype=bool)
+    for c in VALUE_COLUMNS:
+        same &= np.isclose(merged[c].astype(float), merged[f'{c}_stored'].astype(float), rtol=1e-9, equal_nan=True)
+    return df[~is_stored], df[is_stored & ~same]
+
+
+def transform_yf_data(ticker, df, stored=None):
+    # split a fetched frame into new minute rows, dividend rows (NaN prices) and revised minute rows
+    df_dividends = df[df.isna().any(axis=1)]  # get dividends row if any
+    if df_dividends.empty is False:
+        df_dividends = df_dividends.fillna(0)
+        df = df.dropna()  #drop na dividend rows
+    df, df_changed = trim_overlap(df, stored)
+    return ticker, df, df_dividends, df_changed
+
+
+def write_yf_batch(items, bulk=True):
+    # items: [(ticker, df, df_dividends, df_changed)] of different tickers
+    dividends = [d for _, _, d, _ in items if not d.empty]
+    if dividends:
+        df_dividends = pd.concat(dividends, ignore_index=True)
+        if not updateDividendsData(equitiesTable, df_dividends, DATABASE, ['datetime', 'ticker'], bulk=bulk):
+            return False
+        if COMPACT_EQUITIES:
+            insertCompactData(df_dividends, DATABASE, conflict='dividends')
+    changed = [c for _, _, _, c in items if not c.empty]
+    if changed:  # revised bars, only the rows whose values differ from the stored ones
+        df_changed = pd.concat(changed, ignore_index=True)
+        if not updateData(equitiesTable, df_changed, DATABASE, ['datetime', 'ticker'], bulk=bulk):
+            return False
+        if COMPACT_EQUITIES:
+            insertCompactData(df_changed, DATABASE, conflict='update')
+    df = pd.concat([df for _, df, _, _ in items], ignore_index=True)
+    touched = pd.concat([df['datetime']] + [d['datetime'] for d in dividends + changed])
+    status = insertData(equitiesTable, df, DATABASE, bulk=bulk) if not df.empty else True
+    if status and COMPACT_EQUITIES and not df.empty:  # secondary copy, gaps are filled by migrateCompactEquities
+        insertCompactData(df, DATABASE)
+    if status:
+        # one refresh over the union of the ranges, stale buckets are repaired by the next refresh or backfillBars
+        refreshBars([item[0] for item in items], touched.min(), touched.max())
+    return status
+
+
+def transform_stage(source, sink, stats, statuses, overlap):
+    while True:
+        item = source.get()
+        if item is None:
+            break
+        ticker, df = item
+        if df.empty:
+            # no data for ticker, remove from ticker list
+            # deleteRow(tickersTable,'ticker',ticker,DATABASE)
+            print(f"\n==============\nSKIPPED: no data for {ticker}\n==============")
+            continue
+        start = time.time()
+        try:
+            item = transform_yf_data(ticker, df, overlap.get(ticker))
+        except Exception as e:
+            print(f'==============\nException at transform_stage: {ticker}: {e}\n==============')
+            statuses[ticker] = False
+            continue
+        stats['items'] += 1
+        stats['rows'] += len(df)
+        stats['seconds'] += time.time() - start
+        written = len(item[1]) + len(item[2]) + len(item[3])
+        stats['trimmed'] += len(df) - written
+        stats['changed'] += len(item[3])
+        if written:
+            put_item(sink, item, stats)
+    sink.put(None)
+
+
+def write_stage(source, stats, statuses, bulk=True, batch_rows=WRITE_BATCH_ROWS, linger=WRITE_LINGER):
+    batch, rows, done = [], 0, False
+    while not done:
+        flush = False
+        try:
+            item = source.get(timeout=linger if batch else None)
+            if item is None:
+                done = True
+            else:
+                batch.append(item)
+                rows += len(item[1]) + len(item[2]) + len(item[3])
+        except queue.Empty:
+            flush = True  # the upstream stages are slower than the writer, write what we have
+        if batch and (done or flush or rows >= batch_rows):
+            start = time.time()
+            try:
+                status = write_yf_batch(batch, bulk=bulk)
+            except Exception as e:
+                print(f'==============\nException at write_stage: {e}\n==============')
+                status = False
+            tickers = [item[0] for item in batch]
+            if not status:
+                print(f"\n==============\nSKIPPED: Exception during write of {', '.join(tickers)}\n==============")
+            statuses.update(dict.fromkeys(tickers, status))
+            stats['items'] += len(batch)
+            stats['rows'] += rows
+            stats['batches'] += 1
+            stats['seconds'] += time.time() - start
+            batch, rows = [], 0
+
+
+def yf_start_date(watermark):
+    # watermarks are utc, yfinance reads a naive start as exchange time
+    return pd.Timestamp(watermark).tz_convert('US/Eastern').tz_localize(None) - timedelta(minutes=5)
+
+
+def insert_yf_data(tickers_list=None, catchup=False, print_details=False, bulk=True,
+                   workers=FETCH_WORKERS, rate=FETCH_RATE, batch_size=BATCH_SIZE):
+    start = time.time()
+    if tickers_list is None:
+        tickers_list = getData(tickersTable, column='ticker', profile='ingest')
+        tickers_list = list(set(tickers_list))
+        tickers_list.extend(list(INDEXES.values()))
+    if catchup is True:
+        print(f"\n==============\nCATCHUP: getting data for equities for catchup run from period 5d\n==============")
+    replaySpool(DATABASE)  # earlier batches go first, a failed replay keeps new writes queued behind them
+    if not ensurePartitions(equitiesTable):
+        print(f"\n==============\nWARNING: Exception at ensurePartitions, writes may be spooled\n==============")
+    # last stored rows of every ticker in one query, their max datetime is the watermark of the ticker
+    stored = getOverlapRows(equitiesTable, tickers_list, OVERLAP_WINDOW)
+    if stored is False:
+        # database unreachable, refetch a fixed window, the DO NOTHING inserts make the overlap harmless
+        print(f"\n==============\nWARNING: Exception at getOverlapRows, fetching the last {SPOOL_LOOKBACK}\n==============")
+        fallback = get_UTC_datetime_now() - SPOOL_LOOKBACK
+        watermarks = {ticker: fallback for ticker in tickers_list}
+        overlap = {}
+    else:
+        overlap = dict(tuple(stored.groupby('ticker'))) if not stored.empty else {}
+        watermarks = {ticker: rows['datetime'].max() for ticker, rows in overlap.items()}
+    if catchup is True:
+        overlap = {}  # a catchup refetches days, let the DO NOTHING inserts sort them out
+
+    starts = {}
+    for ticker in tickers_list:
+        start_time = watermarks.get(ticker, pd.NaT)
+        if pd.isnull(start_time) or catchup is True:  # no prior data, first time catchup run
+            start_date = ''
+            if print_details:
+                print(f"\n==============\nREQUEST: getting data for equities {ticker} from period 5d\n==============")
+        else:
+            start_date = yf_start_date(start_time)
+            if print_details:
+                print(
+                    f"\n==============\nREQUEST: getting data for equities {ticker} from {start_date}\n==============")
+        starts[ticker] = start_date
+
+    PIPELINE_STATS.clear()
+    PIPELINE_STATS.update(fetch=new_stage_stats(), transform=dict(new_stage_stats(), trimmed=0, changed=0),
+                          write=new_stage_stats())
+    fetched, transformed = queue.Queue(PIPELINE_QUEUE_SIZE), queue.Queue(PIPELINE_QUEUE_SIZE)
+    statuses = {}
+    stages = [threading.Thread(target=transform_stage, args=(fetched, transformed, PIPELINE_STATS['transform'], statuses, overlap),
+                               name='rs_yf_transform', daemon=True),
+              threading.Thread(target=write_stage, args=(transformed, PIPELINE_STATS['write'], statuses, bulk),
+                               name='rs_yf_write', daemon=True)]
+    for stage in stages:
+        stage.start()
+
+    # fetch stage, runs on the calling thread and feeds the pipeline as requests complete
+    limiter = TokenBucket(rate)
+    fetch_stats = PIPELINE_STATS['fetch']
+    fetch_start = time.time()
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='rs_yf') as executor:
+        pending = {}  # future: tickers it fetches
+        for start_date, tickers in group_by_watermark(starts, batch_size):
+            if len(tickers) > 1:
+                pending[executor.submit(fetch_yf_batch, tickers, start_date, limiter)] = tickers
+            else:
+                pending[executor.submit(fetch_yf_data, tickers[0], start_date, limiter)] = tickers
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                tickers = pending.pop(future)
+                fetch_stats['batches'] += 1
+                frames = future.result()
+                for ticker in tickers:
+                    df = frames.get(ticker)
+                    if df is None and len(tickers) > 1:  # straggler of a batch, retried on its own
+                        pending[executor.submit(fetch_yf_data, ticker, starts[ticker], limiter)] = [ticker]
+                    elif df is None:
+                        print(f"\n==============\nSKIPPED: Exception at {ticker} during fetch\n==============")
+                        statuses[ticker] = False
+                    else:
+                        fetch_stats['items'] += 1
+                        fetch_stats['rows'] += len(df)
+                        put_item(fetched, (ticker, df), fetch_stats)
+    fetch_stats['seconds'] = time.time() - fetch_start
+    fetched.put(None)
+    for stage in stages:
+        stage.join()
+
+    stats = pipelineStats()
+    print(f"\n==============\n{len(tickers_list)} tickers fetched in {stats['fetch']['batches']} requests and written in "
+          f"{stats['write']['batches']} batches in {time.time() - start:.1f}s ({workers} workers, {rate:g} requests/sec)\n" +
+          '\n'.join(f"{stage}: {s['items']} frames, {s['rows']} rows, {s['rows_per_sec']:,.0f} rows/sec, "
+                    f"max queue depth {s['max_depth']}" for stage, s in stats.items()) +
+          f"\n{stats['transform']['trimmed']} refetched rows matched stored bars, {stats['transform']['changed']} revised"
+          "\n==============")
+    stats = spoolStats()
+    if stats['segments']:
+        print(f"\n==============\nSPOOL: {stats['segments']} batches ({stats['bytes'] / 1024:,.0f} KiB) waiting, "
+              f"oldest {stats['oldest_age_seconds']:,.0f}s\n==============")
+    return all(statuses.values())
+
+
+if __name__ == "__main__":
+    setup_logging()
+    insert_yf_data()
@@ -0,0 +1,86 @@
+import pandas as pd
+import pytest
+
+pytest.importorskip('pyarrow')
+
+from robinhood_sheryl import rs_bar_cache
+from robinhood_sheryl.rs_bar_cache import BarCache, CacheUnavailable, invalidate_ticker
+
+
+class FakeTable:
+    # minute rows of one ticker standing in for the database, loader() is the BarCache loader
+    def __init__(self, start='2026-10-16 13:30', periods=120):
+        index = pd.date_range(start, periods=periods, freq='min', tz='UTC')
+        self.rows = pd.DataFrame({'datetime': index, 'ticker': 'A', 'close': 1.0, 'dividends': 0.0})
+        self.calls = []
+        self.down = False
+
+    def loader(self, ticker, start, end):
+        self.calls.append((start, end))
+        if self.down:
+            return False
+        df = self.rows
+        if start is not None:
+            df = df[df['datetime'] >= start]
+        if end is not None:
+            df = df[df['datetime'] < end]
+        return df.reset_index(drop=True)
+
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(rs_bar_cache, 'SYNC_INTERVAL', -1)  # sync on every read
+    return BarCache('equities', overlap=pd.Timedelta(minutes=40), cache_dir=str(tmp_path))
+
+
+def test_first_read_loads_everything_then_syncs_from_the_overlap(cache):
+    table = FakeTable()
+    df = cache.get('A', None, None, table.loader)
+    assert len(df) == 120
+    table.calls.clear()
+    cache.get('A', None, None, table.loader)
+    assert table.calls == [(table.rows['datetime'].max() - pd.Timedelta(minutes=40), None)]
+
+
+def test_sync_picks_up_rows_revised_inside_the_overlap(cache):
+    table = FakeTable()
+    cache.get('A', None, None, table.loader)
+    table.rows.loc[table.rows.index[-30], 'close'] = 2.0  # revised by the ingestion overlap refetch
+    df = cache.get('A', None, None, table.loader)
+    assert df['close'].iloc[-30] == 2.0
+    assert len(df) == 120
+
+
+def test_invalidate_rereads_rows_older_than_the_overlap(cache, tmp_path):
+    table = FakeTable()
+    cache.get('A', None, None, table.loader)
+    table.rows.loc[table.rows.index[5], 'dividends'] = 0.5  # dividend upsert on an old minute
+    assert cache.get('A', None, None, table.loader)['dividends'].iloc[5] == 0.0
+    invalidate_ticker('A', table.rows['datetime'].iloc[5], cache_dir=str(tmp_path))
+    df = cache.get('A', None, None, table.loader)
+    assert df['dividends'].iloc[5] == 0.5
+    assert len(df) == 120
+
+
+def test_invalidate_skips_tickers_not_cached(cache, tmp_path):
+    invalidate_ticker('B', pd.Timestamp('2026-10-16', tz='UTC'), cache_dir=str(tmp_path))
+    assert not (tmp_path / 'equities' / 'B').exists()
+
+
+def test_stale_rows_are_served_while_the_database_is_down(cache, monkeypatch):
+    table = FakeTable()
+    cache.get('A', None, None, table.loader)
+    table.down = True
+    assert len(cache.get('A', None, None, table.loader)) == 120
+    monkeypatch.setattr(rs_bar_cache, 'MAX_STALENESS', -1)
+    with pytest.raises(CacheUnavailable):
+        cache.get('A', None, None, table.loader)
+
+
+def test_read_range_is_inclusive_and_spans_days(cache):
+    table = FakeTable(start='2026-10-15 19:00', periods=24 * 60)
+    start, end = pd.Timestamp('2026-10-15 23:00', tz='UTC'), pd.Timestamp('2026-10-16 05:00', tz='UTC')
+    cache.get('A', None, None, table.loader)
+    df = cache.get('A', start, end, table.loader)
+    assert df['datetime'].min() == start and df['datetime'].max() == end
+    assert len(df) == 6 * 60 + 1
@@ -0,0 +1,134 @@
+import struct
+
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip('sqlalchemy')
+
+from robinhood_sheryl import rs_db
+
+
+def minutes(start, periods, tz='US/Eastern'):
+    index = pd.date_range(start, periods=periods, freq='min', tz=tz, name='datetime')
+    values = np.arange(periods, dtype=float)
+    return pd.DataFrame({'open': values, 'high': values + 1, 'low': values - 1, 'close': values + 0.5,
+                         'volume': 10.0, 'dividends': 0.0}, index=index)
+
+
+#### resample_frame
+
+def test_resample_frame_aggregates_ohlcv():
+    out = rs_db.resample_frame(minutes('2026-10-16 09:30', 10), '5m')
+    assert len(out) == 2
+    first = out.iloc[0]
+    assert (first['open'], first['high'], first['low'], first['close'], first['volume']) == (0, 5, -1, 4.5, 50)
+
+
+def test_resample_frame_takes_the_last_dividend():
+    df = minutes('2026-10-16 09:30', 5)
+    df.iloc[1, df.columns.get_loc('dividends')] = 0.25
+    df.iloc[2:, df.columns.get_loc('dividends')] = np.nan
+    assert rs_db.resample_frame(df, '5m')['dividends'].iloc[0] == 0.25
+
+
+def test_resample_frame_hourly_buckets_start_on_the_half_hour():
+    out = rs_db.resample_frame(minutes('2026-10-16 09:30', 120), '1h')
+    assert list(out.index.strftime('%H:%M')) == ['09:30', '10:30']
+
+
+def test_resample_frame_daily_buckets_are_business_days_of_the_timezone():
+    df = pd.concat([minutes('2026-10-16 23:30', 2, tz='UTC'), minutes('2026-10-17 15:00', 1, tz='UTC')])
+    out = rs_db.resample_frame(df, '1d')  # friday evening and saturday rows are all friday in new york
+    assert list(out.index.strftime('%Y-%m-%d')) == ['2026-10-16']
+    out = rs_db.resample_frame(df, '1d', timezone='Asia/Tokyo')
+    assert list(out.index.strftime('%Y-%m-%d')) == ['2026-10-16']
+    assert out['volume'].iloc[0] == 30
+
+
+def test_resample_frame_leaves_out_empty_buckets():
+    df = pd.concat([minutes('2026-10-16 09:30', 1), minutes('2026-10-16 09:50', 1)])
+    assert len(rs_db.resample_frame(df, '5m')) == 2
+
+
+#### sql buckets
+
+def test_bucket_select_uses_the_request_aggregates():
+    select, positions = rs_db.bucket_select(rs_db.equitiesTable, 'b')
+    assert 'sum(volume)::BIGINT AS volume' in select
+    assert '(array_agg(dividends ORDER BY datetime DESC) FILTER (WHERE dividends IS NOT NULL))[1]' in select
+    assert '(array_agg(open ORDER BY datetime) FILTER (WHERE open IS NOT NULL))[1]' in select
+    assert positions == '1, 2'
+
+
+def test_interval_bucket_daily_buckets_in_the_given_timezone():
+    bucket = rs_db.interval_bucket('1d', 'Europe/London')
+    assert "AT TIME ZONE 'Europe/London'" in bucket and 'isodow' in bucket
+    assert rs_db.interval_bucket('1h').endswith('+ 1800)')
+    assert rs_db.interval_bucket('1wk') is None
+
+
+#### bulk write data
+
+def test_copy_buffer_keeps_empty_strings_apart_from_nulls():
+    df = pd.DataFrame({'id': ['a', 'b'], 't_type': ['', None], 'ticker': ['X', np.nan], 'name': ['n', 'm'],
+                       'option_type': [None, None], 'strike_price': [1.0, np.nan], 'exp_date': [None, None]})
+    lines = rs_db.frame_to_copy_buffer(rs_db.instrumentsTable, df).read().splitlines()
+    assert lines == ['a,,X,n,\\N,1.0,\\N', 'b,\\N,\\N,m,\\N,\\N,\\N']
+
+
+def test_copy_buffer_casts_float_integer_columns():
+    df = pd.DataFrame({'datetime': ['2026-10-16 13:30:00+0000'], 'ticker': ['A'], 'open': [1.0], 'high': [1.0],
+                       'low': [1.0], 'close': [1.0], 'volume': [10.0], 'dividends': [0.0], 'stock_splits': [0.0]})
+    line = rs_db.frame_to_copy_buffer(rs_db.equitiesTable, df).read().strip()
+    assert line.endswith(',10,0.0,0')
+
+
+#### read sql binary
+
+def binary_body(rows, oids):
+    # COPY BINARY tuples (without the file header and trailer) of rows of python values, None is NULL
+    formats = {20: '>q', 23: '>i', 701: '>d', 1184: '>q'}
+    body = b''
+    for row in rows:
+        body += struct.pack('>h', len(row))
+        for value, oid in zip(row, oids):
+            if value is None:
+                body += struct.pack('>i', -1)
+                continue
+            data = value.encode() if oid in rs_db.PG_TEXT_TYPES else struct.pack(formats[oid], value)
+            body += struct.pack('>i', len(data)) + data
+    return body
+
+
+OIDS = [1184, 25, 701, 20]  # timestamptz, text, float8, int8
+EPOCH_2026 = 1792108800 * 1000000 - rs_db.PG_EPOCH_US  # 2026-10-16 in postgres microseconds
+
+
+def test_binary_fixed_layout_decodes_constant_width_rows():
+    body = binary_body([(EPOCH_2026, 'AAPL', 1.5, 10), (EPOCH_2026 + 60000000, 'AAPL', 2.5, 20)], OIDS)
+    datetimes, tickers, closes, volumes = rs_db.decode_binary_fixed_layout(body, OIDS)
+    assert list(pd.to_datetime(datetimes, unit='us', utc=True)) == [pd.Timestamp('2026-10-16', tz='UTC'),
+                                                                    pd.Timestamp('2026-10-16 00:01', tz='UTC')]
+    assert list(tickers) == ['AAPL', 'AAPL']
+    assert list(closes) == [1.5, 2.5] and list(volumes) == [10, 20]
+
+
+def test_binary_fixed_layout_declines_nulls_and_varying_widths():
+    assert rs_db.decode_binary_fixed_layout(binary_body([(EPOCH_2026, 'A', None, 1)], OIDS), OIDS) is None
+    body = binary_body([(EPOCH_2026, 'A', 1.0, 1), (EPOCH_2026, 'MSFT', 1.0, 1)], OIDS)
+    assert rs_db.decode_binary_fixed_layout(body, OIDS) is None
+
+
+def test_binary_rows_decodes_nulls_like_the_csv_reader():
+    body = binary_body([(EPOCH_2026, 'A', None, 1), (None, None, 2.0, None)], OIDS)
+    datetimes, tickers, closes, volumes = rs_db.decode_binary_rows(body, OIDS)
+    assert datetimes[0] == EPOCH_2026 + rs_db.PG_EPOCH_US and datetimes[1] is pd.NA
+    assert tickers[0] == 'A' and np.isnan(tickers[1])
+    assert np.isnan(closes[0]) and closes[1] == 2.0
+    assert volumes[0] == 1 and np.isnan(volumes[1])
+
+
+def test_binary_decoders_agree_on_an_empty_body():
+    assert [len(c) for c in rs_db.decode_binary_fixed_layout(b'', OIDS)] == [0, 0, 0, 0]
+    assert [len(c) for c in rs_db.decode_binary_rows(b'', OIDS)] == [0, 0, 0, 0]
@@ -0,0 +1,153 @@
+from datetime import datetime, timezone
+
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip('sqlalchemy')
+pytest.importorskip('yfinance')
+
+from robinhood_sheryl import rs_yf
+
+
+def wide_frame(tickers, start='2026-10-16 09:30', periods=4, tz=None):
+    index = pd.date_range(start, periods=periods, freq='min', name='Datetime', tz=tz)
+    columns = pd.MultiIndex.from_product([tickers, rs_yf.YF_FIELDS])
+    wide = pd.DataFrame(1.0, index=index, columns=columns)
+    wide.loc[:, (slice(None), ['Dividends', 'Stock Splits'])] = 0.0
+    return wide
+
+
+def test_split_yf_batch_splits_per_ticker_and_drops_last_row():
+    frames = rs_yf.split_yf_batch(['A', 'B'], wide_frame(['A', 'B']))
+    assert set(frames) == {'A', 'B'}
+    assert len(frames['A']) == 3
+    assert list(frames['A'].columns) == ['datetime', 'ticker', 'open', 'high', 'low', 'close', 'volume',
+                                         'dividends', 'stock_splits']
+    assert (frames['B']['ticker'] == 'B').all()
+
+
+def test_split_yf_batch_drops_empty_minutes_of_one_symbol():
+    wide = wide_frame(['A', 'B'])
+    wide.loc[wide.index[1], 'B'] = np.nan
+    frames = rs_yf.split_yf_batch(['A', 'B'], wide)
+    assert len(frames['A']) == 3
+    assert len(frames['B']) == 2
+
+
+def test_split_yf_batch_leaves_failed_and_missing_symbols_for_single_retry():
+    wide = wide_frame(['A', 'B'])
+    wide['B'] = np.nan  # failed inside the batch
+    frames = rs_yf.split_yf_batch(['A', 'B', 'C'], wide)
+    assert set(frames) == {'A'}
+
+
+def test_split_yf_batch_empty_download_means_no_data():
+    frames = rs_yf.split_yf_batch(['A', 'B'], pd.DataFrame())
+    assert set(frames) == {'A', 'B'}
+    assert all(df.empty for df in frames.values())
+
+
+def test_naive_batch_index_is_localized_in_exchange_time():
+    frames = rs_yf.split_yf_batch(['A', '^N225'], wide_frame(['A', '^N225']))
+    assert frames['A']['datetime'].iloc[0] == pd.Timestamp('2026-10-16 13:30', tz='UTC')
+    assert frames['^N225']['datetime'].iloc[0] == pd.Timestamp('2026-10-16 00:30', tz='UTC')
+
+
+def test_aware_batch_index_is_converted_to_utc():
+    frames = rs_yf.split_yf_batch(['^FTSE'], wide_frame(['^FTSE'], start='2026-10-16 13:30', tz='UTC'))
+    assert frames['^FTSE']['datetime'].iloc[0] == pd.Timestamp('2026-10-16 13:30', tz='UTC')
+
+
+#### group_by_watermark
+
+def test_group_by_watermark_batches_close_watermarks():
+    t0 = pd.Timestamp('2026-10-16 09:30')
+    starts = {'A': t0, 'B': t0 + pd.Timedelta(minutes=10), 'C': t0 + pd.Timedelta(hours=2), 'D': '', 'E': ''}
+    groups = rs_yf.group_by_watermark(starts, batch_size=50)
+    assert groups == [('', ['D', 'E']), (t0, ['A', 'B']), (t0 + pd.Timedelta(hours=2), ['C'])]
+
+
+def test_group_by_watermark_splits_full_batches():
+    t0 = pd.Timestamp('2026-10-16 09:30')
+    starts = {t: t0 for t in 'ABCDE'}
+    assert [tickers for _, tickers in rs_yf.group_by_watermark(starts, batch_size=2)] == [['A', 'B'], ['C', 'D'], ['E']]
+    assert [tickers for _, tickers in rs_yf.group_by_watermark(starts, batch_size=0)] == [[t] for t in 'ABCDE']
+
+
+#### trim_overlap
+
+def long_frame(closes, start='2026-10-16 13:30'):
+    index = pd.date_range(start, periods=len(closes), freq='min', tz='UTC')
+    return pd.DataFrame({'datetime': index, 'ticker': 'A', 'open': 1.0, 'high': 1.0, 'low': 1.0, 'close': closes,
+                         'volume': 10, 'dividends': 0.0, 'stock_splits': 0})
+
+
+def test_trim_overlap_drops_stored_rows_and_returns_revised_ones():
+    stored = long_frame([1.0, 1.0, 1.0])
+    fetched = long_frame([1.0, 1.5, 1.0, 1.0, 1.0])
+    new, changed = rs_yf.trim_overlap(fetched, stored)
+    assert list(new['datetime']) == list(fetched['datetime'][3:])
+    assert list(changed['datetime']) == [fetched['datetime'][1]]
+    assert changed['close'].iloc[0] == 1.5
+
+
+def test_trim_overlap_without_stored_rows_keeps_everything():
+    fetched = long_frame([1.0, 1.0])
+    new, changed = rs_yf.trim_overlap(fetched, pd.DataFrame())
+    assert len(new) == 2 and changed.empty
+
+
+def test_trim_overlap_compares_across_datetime_resolutions():
+    stored = long_frame([1.0, 1.0])
+    stored['datetime'] = stored['datetime'].astype('datetime64[us, UTC]')
+    new, changed = rs_yf.trim_overlap(long_frame([1.0, 1.0, 1.0]), stored)
+    assert len(new) == 1 and changed.empty
+
+
+#### fetch start
+
+def test_yf_start_date_is_naive_exchange_time_before_the_watermark():
+    assert rs_yf.yf_start_date(pd.Timestamp('2026-10-16 19:59', tz='UTC')) == pd.Timestamp('2026-10-16 15:54')
+    assert rs_yf.yf_start_date(pd.Timestamp('2026-01-16 19:59', tz='UTC')) == pd.Timestamp('2026-01-16 14:54')
+    # the spool lookback fallback starts from get_UTC_datetime_now, a python datetime
+    assert rs_yf.yf_start_date(datetime(2026, 10, 16, 19, 59, tzinfo=timezone.utc)) == pd.Timestamp('2026-10-16 15:54')
+
+
+#### retry_request
+
+class NoLimit:
+    def acquire(self):
+        pass
+
+
+def failing(errors, result='frame'):
+    calls = []
+
+    def request():
+        calls.append(1)
+        if len(calls) <= len(errors):
+            raise errors[len(calls) - 1]
+        return result
+    return request, calls
+
+
+def test_retry_request_retries_network_errors(monkeypatch):
+    monkeypatch.setattr(rs_yf.time, 'sleep', lambda seconds: None)
+    request, calls = failing([ConnectionError('reset'), TimeoutError('slow')])
+    assert rs_yf.retry_request('A', request, NoLimit(), retries=3) == 'frame'
+    assert len(calls) == 3
+
+
+def test_retry_request_gives_up_after_the_last_retry(monkeypatch):
+    monkeypatch.setattr(rs_yf.time, 'sleep', lambda seconds: None)
+    request, calls = failing([ConnectionError('reset')] * 5)
+    assert rs_yf.retry_request('A', request, NoLimit(), retries=2) is None
+    assert len(calls) == 3
+
+
+def test_retry_request_does_not_retry_data_errors(monkeypatch):
+    monkeypatch.setattr(rs_yf.time, 'sleep', lambda seconds: pytest.fail('data errors are not retried'))
+    request, calls = failing([TypeError('tz-naive')])
+    assert rs_yf.retry_request('A', request, NoLimit(), retries=3) is None
+    assert len(calls) == 1